@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupCatalog
+#
+# A module that provides the `backup_catalog` class, a local record of the
+# backups that exist in each destination
+
+import os
+import sqlite3
+
+## \class backup.BackupCatalog.backup_catalog
+#  A local SQLite catalog of backups
+#
+# Records the backups in each destination, keyed by `(host, dest, prefix)`,
+# along with the generation of the destination they were last reconciled with.
+# Every change made to a destination writes a new generation marker there, so
+# as long as the marker matches the catalog's generation the catalog can be
+# used instead of listing the destination.
+#
+# Every operation uses its own short-lived connection, so a catalog can be
+# shared by several threads (and processes).
+class backup_catalog:
+
+    ## Creates a `backup_catalog` object, creating the database if necessary
+    #  \param path Path of the SQLite database
+    def __init__(self, path):
+        ## path of the SQLite database
+        self.path = os.path.expanduser(path)
+        with self._connect() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS snapshots (host TEXT, '
+                'dest TEXT, prefix TEXT, name TEXT, timestamp TEXT, '
+                'status TEXT, size INTEGER, files INTEGER, fingerprint TEXT, '
+                'PRIMARY KEY (host, dest, prefix, name))')
+            # Catalogs created before fingerprints were recorded
+            columns = [r[1] for r in c.execute('PRAGMA table_info(snapshots)')]
+            if 'fingerprint' not in columns:
+                c.execute('ALTER TABLE snapshots ADD COLUMN fingerprint TEXT')
+            c.execute('CREATE TABLE IF NOT EXISTS generations (host TEXT, '
+                'dest TEXT, prefix TEXT, generation TEXT, '
+                'PRIMARY KEY (host, dest, prefix))')
+
+    ## Opens a connection to the database
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    ## Generation of a destination the catalog is up to date with
+    #  \param key `(host, dest, prefix)` tuple
+    #  \returns The generation (None if unknown)
+    def generation(self, key):
+        with self._connect() as c:
+            r = c.execute('SELECT generation FROM generations WHERE host=? AND '
+                'dest=? AND prefix=?', key).fetchone()
+        return r[0] if r else None
+
+    ## Records the generation of a destination the catalog is up to date with
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param generation The generation (None if unknown)
+    def set_generation(self, key, generation):
+        with self._connect() as c:
+            c.execute('INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)',
+                key + (generation,))
+
+    ## Names of the complete (or otherwise) backups in a destination
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param status Status of the backups to list
+    #  \returns List of backup names (sorted by timestamp, oldest first)
+    def snapshots(self, key, status='complete'):
+        with self._connect() as c:
+            return [r[0] for r in c.execute('SELECT name FROM snapshots WHERE '
+                'host=? AND dest=? AND prefix=? AND status=? ORDER BY '
+                'timestamp, name', key + (status,))]
+
+    ## Information recorded about a backup
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param name Name of the backup
+    #  \returns Dictionary of the backup's columns (None if it isn't recorded)
+    def snapshot(self, key, name):
+        with self._connect() as c:
+            c.row_factory = sqlite3.Row
+            r = c.execute('SELECT * FROM snapshots WHERE host=? AND dest=? AND '
+                'prefix=? AND name=?', key + (name,)).fetchone()
+        return dict(r) if r else None
+
+    ## Records a backup (replacing anything recorded about it before)
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param name Name of the backup
+    #  \param timestamp The backup's timestamp (`datetime`)
+    #  \param status Status of the backup ('complete' for usable backups,
+    #  'inprogress' for ones still being transferred)
+    #  \param size Total size of the backup in bytes (if known)
+    #  \param files Number of files in the backup (if known)
+    def add(self, key, name, timestamp, status='complete', size=None,
+            files=None):
+        with self._connect() as c:
+            c.execute('INSERT OR REPLACE INTO snapshots (host, dest, prefix, '
+                'name, timestamp, status, size, files) VALUES (?, ?, ?, ?, ?, '
+                '?, ?, ?)', key + (name, timestamp.isoformat(), status, size,
+                files))
+
+    ## Updates the size and number of files recorded for a backup
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param name Name of the backup
+    #  \param size Total size of the backup in bytes
+    #  \param files Number of files in the backup
+    def update(self, key, name, size, files):
+        with self._connect() as c:
+            c.execute('UPDATE snapshots SET size=?, files=? WHERE host=? AND '
+                'dest=? AND prefix=? AND name=?', (size, files) + key + (name,))
+
+    ## Records the fingerprint of the sources a backup was made from
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param name Name of the backup
+    #  \param fingerprint The fingerprint (see `source_fingerprint()`)
+    def set_fingerprint(self, key, name, fingerprint):
+        with self._connect() as c:
+            c.execute('UPDATE snapshots SET fingerprint=? WHERE host=? AND '
+                'dest=? AND prefix=? AND name=?', (fingerprint,) + key + (name,))
+
+    ## Forgets backups
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param names List of backup names
+    def remove(self, key, names):
+        with self._connect() as c:
+            c.executemany('DELETE FROM snapshots WHERE host=? AND dest=? AND '
+                'prefix=? AND name=?', [key + (n,) for n in names])
+
+    ## Replaces the backups recorded for a destination with an actual listing
+    #  \param key `(host, dest, prefix)` tuple
+    #  \param names List of the backups that exist in the destination
+    #  \param timestamp Function mapping a backup name to its timestamp
+    #  \param generation Generation of the destination the listing is from
+    #  \param staging List of the backups in progress in the destination
+    #
+    # Backups that are already recorded keep their recorded information.
+    def reconcile(self, key, names, timestamp, generation, staging=()):
+        known = set(self.snapshots(key))
+        with self._connect() as c:
+            c.executemany('DELETE FROM snapshots WHERE host=? AND dest=? AND '
+                'prefix=? AND name=?', [key + (n,) for n in known - set(names)])
+            c.executemany('INSERT OR REPLACE INTO snapshots (host, dest, '
+                'prefix, name, timestamp, status) VALUES (?, ?, ?, ?, ?, ?)',
+                [key + (n, timestamp(n).isoformat(),
+                'complete') for n in names if n not in known])
+            c.execute('DELETE FROM snapshots WHERE host=? AND dest=? AND '
+                'prefix=? AND status=?', key + ('inprogress',))
+            c.executemany('INSERT OR REPLACE INTO snapshots (host, dest, '
+                'prefix, name, timestamp, status) VALUES (?, ?, ?, ?, ?, ?)',
+                [key + (n, timestamp(n).isoformat(), 'inprogress')
+                for n in staging])
+            c.execute('INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)',
+                key + (generation,))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupDeleter
+#
+# A module that provides the `backup_deleter` class to delete large numbers of
+# (possibly large) remote directories in parallel, and `local_deleter` to do
+# the same with local directories
+
+import concurrent.futures
+import os
+import shlex
+import stat
+
+## Splits a list of paths into batches
+#  \param paths List of paths
+#  \param size Maximum number of paths in a batch
+#  \param max_bytes Maximum total length of the (quoted) paths in a batch
+#  \returns List of batches (lists of paths)
+#
+# Keeps every batch small enough to be passed to a single remote command line
+# without running into the system's argument size limits.
+def batches(paths, size, max_bytes=64 * 1024):
+    r = []
+    batch = []
+    length = 0
+    for p in paths:
+        l = len(shlex.quote(p)) + 1
+        if batch and (len(batch) >= size or length + l > max_bytes):
+            r.append(batch)
+            batch = []
+            length = 0
+        batch.append(p)
+        length += l
+    if batch:
+        r.append(batch)
+    return r
+
+## \class backup.BackupDeleter.backup_deleter
+#  Deletes remote directories in parallel batches
+#
+# Splits the directories to delete (and, if there are only a few of them, their
+# subtrees) into batches that are deleted by several remote commands at once.
+# Each batch reports how many inodes and bytes it freed or the error it ran
+# into. Directories and files are counted as they are deleted, and only files
+# whose last link is removed are counted, so space still shared with other
+# backups is not. The totals are lower bounds: when concurrent batches remove
+# the last two links of a file at the same time neither may count it.
+class backup_deleter:
+
+    ## Creates a `backup_deleter` object
+    #  \param run Function that runs a shell script on the remote machine and
+    #  returns its exit status, stdout and stderr
+    #  \param printer `backup_printer` to use for output
+    #  \param workers Maximum number of batches deleted concurrently
+    #  \param batch_size Maximum number of paths in a batch
+    #  \param max_depth Maximum depth directories are split into subtrees to
+    #  (see `delete()`)
+    def __init__(self, run, printer, workers=4, batch_size=64, max_depth=4):
+        ## function that runs remote shell scripts
+        self._run = run
+        ## `backup_printer` object used for output
+        self._out = printer
+        ## maximum number of batches deleted concurrently
+        self._workers = workers
+        ## maximum number of paths in a batch
+        self._batch_size = batch_size
+        ## maximum depth directories are split into subtrees to
+        self._max_depth = max_depth
+
+    ## Deletes directories
+    #  \param paths List of directories to delete
+    #  \returns Number of inodes freed
+    #  \returns Number of bytes freed
+    #  \returns List of error messages of the batches that failed
+    #
+    # When there are fewer directories than workers they are split into their
+    # entries, level by level (up to `max_depth` levels deep), until there are
+    # at least as many entries as workers. The entries are deleted as separate
+    # batches first, so a few very large directories (e.g. backups of a single
+    # source, which hold just one subdirectory) are still deleted in parallel,
+    # and then the (now nearly empty) directories themselves.
+    def delete(self, paths):
+        roots = []
+        if len(paths) < self._workers:
+            expanded, errors = self._expand(paths)
+            if not errors:
+                roots = paths
+                paths = expanded
+        inodes, size, errors = self._delete_all(paths)
+        if roots and not errors:
+            i, s, errors = self._delete_all(roots)
+            inodes += i
+            size += s
+        return inodes, size, errors
+
+    ## Splits directories into subtrees
+    #  \returns List of the subtrees' paths
+    #  \returns List of error messages (empty on success)
+    #
+    # Replaces directories by their entries until there are at least as many
+    # paths as workers, there are no directories left or `max_depth` levels
+    # have been split.
+    def _expand(self, paths):
+        level = [(p, True) for p in paths]
+        for _ in range(self._max_depth):
+            dirs = [p for p, isdir in level if isdir]
+            if len(level) >= self._workers or not dirs:
+                break
+            entries, errors = self._list(dirs)
+            if errors:
+                return [], errors
+            level = [(p, isdir) for p, isdir in level if not isdir] + entries
+        return [p for p, isdir in level], []
+
+    ## Lists the entries of directories
+    #  \returns List of (path, is a directory) tuples
+    #  \returns List of error messages (empty on success)
+    def _list(self, paths):
+        entries = []
+        for b in batches(paths, self._batch_size):
+            res, o, e = self._run('find {0} -mindepth 1 -maxdepth 1 '
+                '-printf \'%y%p\\0\''.format(' '.join(shlex.quote(p) for p in b)))
+            if res != 0:
+                return [], [e]
+            entries.extend((x[1:], x[0] == 'd')
+                for x in o.rstrip('\n').split('\0') if x)
+        return entries, []
+
+    ## Deletes paths in concurrent batches
+    #  \returns Number of inodes freed
+    #  \returns Number of bytes freed
+    #  \returns List of error messages of the batches that failed
+    def _delete_all(self, paths):
+        inodes = size = 0
+        errors = []
+        work = batches(paths, self._batch_size)
+        if not work:
+            return inodes, size, errors
+        with concurrent.futures.ThreadPoolExecutor(
+                min(self._workers, len(work))) as pool:
+            futures = {pool.submit(self._delete_batch, b): b for b in work}
+            for f in concurrent.futures.as_completed(futures):
+                b = futures[f]
+                i, s, e = f.result()
+                inodes += i
+                size += s
+                if e is not None:
+                    errors.append(e)
+                    self._out.error('Unable to delete: {0}: {1}\n'.format(
+                        ' '.join(b), e))
+                else:
+                    self._out.debug('Deleted {0} path(s)\n'.format(len(b)))
+        return inodes, size, errors
+
+    ## Deletes a single batch of paths
+    #  \returns Number of inodes freed
+    #  \returns Number of bytes freed
+    #  \returns Error message (None on success)
+    #
+    # A single `find` pass deletes the paths and prints the type, link count
+    # and size of every inode right before deleting it, which are summed up
+    # on the remote machine. Paths that don't exist are skipped (like with
+    # `rm -f`).
+    def _delete_batch(self, batch):
+        script = '\n'.join([
+            'set -- {0}'.format(' '.join(shlex.quote(p) for p in batch)),
+            'for p do shift; if [ -e "$p" ] || [ -L "$p" ]; then '
+            'set -- "$@" "$p"; fi; done',
+            '[ $# -gt 0 ] || { echo \'freed=0 0\'; exit 0; }',
+            '{ find "$@" -printf \'%y %n %b\\n\' -delete; echo "status $?"; } | '
+            'awk \'$1 == "status" {s = $2; next} $1 == "d" || $2 == 1 '
+            '{n++; b += $3} END {printf "freed=%.0f %.0f\\n", n, b * 512; '
+            'exit s}\''])
+        res, o, e = self._run(script)
+        inodes = size = 0
+        for l in o.splitlines():
+            if l.startswith('freed='):
+                inodes, size = [int(x) for x in l[len('freed='):].split()]
+        if res != 0:
+            return inodes, size, e.strip() or 'exit status {0}'.format(res)
+        return inodes, size, None
+
+## \class backup.BackupDeleter.local_deleter
+#  Deletes local directories in parallel batches
+#
+# A `backup_deleter` that does its work in-process instead of with shell
+# scripts, counting freed inodes and bytes the same way (directories and files
+# whose last link is removed, as they are deleted).
+class local_deleter(backup_deleter):
+
+    ## Creates a `local_deleter` object
+    #  \param printer `backup_printer` object to use for output
+    #  \param workers Maximum number of batches deleted concurrently
+    #  \param batch_size Maximum number of paths in a batch
+    #  \param max_depth Maximum depth directories are split into subtrees to
+    def __init__(self, printer, workers=4, batch_size=64, max_depth=4):
+        super().__init__(None, printer, workers, batch_size, max_depth)
+
+    ## Lists the entries of directories
+    #  \returns List of (path, is a directory) tuples
+    #  \returns List of error messages (empty on success)
+    def _list(self, paths):
+        try:
+            return [(e.path, e.is_dir(follow_symlinks=False)) for p in paths
+                for e in os.scandir(p)], []
+        except OSError as e:
+            return [], [str(e)]
+
+    ## Deletes a single batch of paths
+    #  \returns Number of inodes freed
+    #  \returns Number of bytes freed
+    #  \returns Error message (None on success)
+    def _delete_batch(self, batch):
+        inodes = size = 0
+        errors = []
+        for p in batch:
+            i, s, e = _remove(p)
+            inodes += i
+            size += s
+            if e is not None:
+                errors.append(e)
+        return inodes, size, '; '.join(errors) or None
+
+## Deletes a tree, counting the space it frees
+#  \returns Number of inodes freed (directories and files whose last link was
+#  removed)
+#  \returns Number of bytes allocated to them
+#  \returns Error message (None on success)
+#
+# Walks the tree once, deleting every entry after its contents (like
+# `find -delete`). A root that doesn't exist is skipped.
+def _remove(root):
+    inodes = size = 0
+    stack = [(root, False)]
+    try:
+        while stack:
+            p, emptied = stack.pop()
+            try:
+                st = os.lstat(p)
+            except FileNotFoundError:
+                continue
+            isdir = stat.S_ISDIR(st.st_mode)
+            if isdir and not emptied:
+                stack.append((p, True))
+                stack.extend((e.path, False) for e in os.scandir(p))
+                continue
+            if isdir:
+                os.rmdir(p)
+            else:
+                os.unlink(p)
+            if isdir or st.st_nlink == 1:
+                inodes += 1
+                size += st.st_blocks * 512
+    except OSError as e:
+        return inodes, size, str(e)
+    return inodes, size, None
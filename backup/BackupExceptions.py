@@ -31,6 +31,10 @@
 class Error(Exception):
     pass
 
+class HostError(Error):
+    def __init__(self, message):
+        self.msg = message
+
 class DestDirError(Error):
     def __init__(self, message):
         self.msg = message
@@ -42,3 +46,7 @@ class RsyncError(Error):
 class BackupError(Error):
     def __init__(self, message):
         self.msg = message
+
+class JournalError(Error):
+    def __init__(self, message):
+        self.msg = message
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupFingerprint
+#
+# A module that provides functions to compute a cheap fingerprint of source
+# directories, used to tell whether they changed since the last backup without
+# running `rsync`
+
+import concurrent.futures
+import hashlib
+import os
+
+## Adds an entry's metadata to a digest
+#  \param h `hashlib` object
+#  \param rel Path of the entry relative to the walk's root
+#  \param st The entry's `os.stat_result` (from `lstat`)
+#  \param path Path of the entry (to read symbolic links with)
+#
+# Uses the size, modification and change times and mode of the entry, so any
+# change to a file's content, its metadata or a directory's list of entries
+# (which updates the directory's times) changes the digest.
+def _add_entry(h, rel, st, path):
+    h.update('{0}\0{1}\0{2}\0{3}\0{4}\0'.format(rel, st.st_mode, st.st_size,
+        st.st_mtime_ns, st.st_ctime_ns).encode(errors='surrogateescape'))
+    if os.path.islink(path):
+        h.update(os.readlink(path).encode(errors='surrogateescape') + b'\0')
+
+## Computes the digest of an entry and everything below it
+#  \param path Path of the entry
+#  \returns Hex digest (None if part of the entry couldn't be read)
+#
+# Walks the entry without following symbolic links, visiting the entries of
+# every directory in sorted order so the digest doesn't depend on the order the
+# file system returns them in.
+def tree_digest(path):
+    h = hashlib.sha1()
+    stack = [(path, '')]
+    try:
+        while stack:
+            p, rel = stack.pop()
+            st = os.lstat(p)
+            _add_entry(h, rel, st, p)
+            if not os.path.isdir(p) or os.path.islink(p):
+                continue
+            with os.scandir(p) as it:
+                names = sorted(e.name for e in it)
+            stack.extend((os.path.join(p, x), os.path.join(rel, x))
+                for x in reversed(names))
+    except OSError:
+        return None
+    return h.hexdigest()
+
+## Computes the fingerprint of source directories
+#  \param sources List of source directories
+#  \param extra List of strings that also affect a backup (i.e. settings)
+#  \param workers Number of top-level entries to walk concurrently
+#  \returns Hex digest (None if part of a source couldn't be read)
+#
+# The top-level entries of every source are walked in parallel (`scandir` and
+# `lstat` release the GIL) and their digests combined in sorted order with the
+# sources themselves and `extra`.
+def source_fingerprint(sources, extra=(), workers=4):
+    h = hashlib.sha1()
+    for x in extra:
+        h.update(x.encode(errors='surrogateescape') + b'\0')
+    paths = []
+    try:
+        for src in sources:
+            _add_entry(h, src, os.lstat(src), src)
+            if os.path.isdir(src) and not os.path.islink(src):
+                with os.scandir(src) as it:
+                    paths.extend(sorted(e.path for e in it))
+    except OSError:
+        return None
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for p, d in zip(paths, pool.map(tree_digest, paths)):
+            if d is None:
+                return None
+            h.update('{0}\0{1}\0'.format(p, d).encode(
+                errors='surrogateescape'))
+    return h.hexdigest()
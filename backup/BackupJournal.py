@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupJournal
+#
+# A module that provides the `change_journal` class, an on-disk record of the
+# paths that changed in a source directory since its last backup, and the
+# `source_watcher` class that keeps it up to date using inotify
+
+from backup.BackupExceptions import JournalError
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import uuid
+
+## Kinds of journal entries, the entry's path has to be...
+#
+# 'a': transferred on its own (a directory whose own metadata changed)
+# 'f': removed from the previous backup's copy and transferred on its own
+# 'd': removed from the previous backup's copy and transferred recursively
+#
+# An entry recorded with more than one kind keeps the last one in this order.
+kinds = ('a', 'f', 'd')
+
+## \class backup.BackupJournal.change_journal
+#  The paths that changed in a source directory
+#
+# Kept in a directory shared by the watcher (the writer) and `backup_manager`
+# (the reader) as a few files named after the source:
+#
+# - `.state`: the journal's epoch and the watcher's pid. A watcher starts a new
+#   epoch whenever it (re)starts or may have missed a change (i.e. inotify's
+#   queue overflowed), and clears it if it can't watch the source.
+# - `.log`: the changed paths (relative to the source) since the journal was
+#   last taken, each prefixed with its kind and terminated by a NUL.
+# - `.<destination>.last`: the epoch and name of the last backup made in a
+#   destination while the journal was taken, and the number of backups made
+#   from the journal since the last full walk of the source.
+#
+# The changes since a backup are only known if the journal is still in the
+# epoch the backup was made in (and its watcher is running). A log that grows
+# past `max_log` bytes (because nothing takes it) starts a new epoch.
+class change_journal:
+
+    ## Creates a `change_journal` object
+    #  \param directory Directory the journals are kept in
+    #  \param src Source directory
+    def __init__(self, directory, src, max_log=64 * 1024 * 1024):
+        ## maximum size of the log in bytes
+        self.max_log = max_log
+        ## source directory
+        self.src = os.path.abspath(src)
+        name = hashlib.sha1(os.fsencode(self.src)).hexdigest()[:16]
+        ## path of the journal's files (without their extensions)
+        self.path = os.path.join(os.path.expanduser(directory), name)
+
+    ## Locks the journal
+    #
+    # A context manager: the watcher only appends to the log and the reader
+    # only takes it while holding the lock.
+    def _lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return _flock('{0}.lock'.format(self.path))
+
+    ## Replaces one of the journal's files atomically
+    def _write(self, ext, text):
+        path = '{0}.{1}'.format(self.path, ext)
+        tmp = '{0}.{1}'.format(path, os.getpid())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    ## Reads one of the journal's files (None if it doesn't exist)
+    def _read(self, ext):
+        try:
+            with open('{0}.{1}'.format(self.path, ext)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    ## Starts a new epoch (called by the watcher)
+    #  \param valid False if changes can't be recorded (the epoch is cleared)
+    #  \returns The new epoch (None if cleared)
+    def start(self, valid=True):
+        epoch = uuid.uuid4().hex if valid else None
+        with self._lock():
+            self._write('state', '{0} {1}\n'.format(epoch or '-', os.getpid()))
+            open('{0}.log'.format(self.path), 'wb').close()
+        return epoch
+
+    ## Appends changes to the log (called by the watcher)
+    #  \param changes Dictionary mapping changed paths (bytes, relative to the
+    #  source) to their kinds
+    def record(self, changes):
+        if not changes:
+            return
+        data = b''.join(k.encode() + p + b'\0' for p, k in changes.items())
+        with self._lock():
+            with open('{0}.log'.format(self.path), 'ab') as f:
+                f.write(data)
+                full = f.tell() > self.max_log
+        if full:
+            self.start()
+
+    ## Current epoch of the journal
+    #  \returns The epoch (None if there is none or its watcher isn't running)
+    def epoch(self):
+        state = (self._read('state') or '').split()
+        if len(state) != 2 or state[0] == '-':
+            return None
+        try:
+            os.kill(int(state[1]), 0)
+        except (ValueError, ProcessLookupError):
+            return None
+        except PermissionError:
+            pass
+        return state[0]
+
+    ## Takes the changes recorded so far
+    #  \param consume Empty the log (False leaves it as it is, i.e. dry runs)
+    #  \returns The current epoch (see `epoch()`)
+    #  \returns Dictionary mapping changed paths (bytes) to their kinds
+    def take(self, consume=True):
+        with self._lock():
+            epoch = self.epoch()
+            try:
+                with open('{0}.log'.format(self.path), 'rb+') as f:
+                    data = f.read()
+                    if consume:
+                        f.truncate(0)
+            except FileNotFoundError:
+                data = b''
+        return epoch, parse_log(data)
+
+    ## Extension of the file holding the last backup made in a destination
+    def _last_ext(self, dest):
+        return '{0}.last'.format(hashlib.sha1(dest.encode(
+            errors='surrogateescape')).hexdigest()[:16])
+
+    ## The last backup made in a destination while the journal was taken
+    #  \param dest Name of the destination
+    #  \returns Tuple of the epoch, the backup's name and the number of backups
+    #  made from the journal since the last full walk (None if unknown)
+    def last(self, dest):
+        last = (self._read(self._last_ext(dest)) or '').split('\n')
+        if len(last) < 3:
+            return None
+        try:
+            return last[0], last[1], int(last[2])
+        except ValueError:
+            return None
+
+    ## Records the last backup made in a destination while the journal was taken
+    #  \param dest Name of the destination
+    #  \param epoch Epoch of the journal when it was taken (None forgets the
+    #  last backup)
+    #  \param name Name of the backup
+    #  \param runs Number of backups made from the journal since the last full
+    #  walk of the source
+    def set_last(self, dest, epoch, name=None, runs=0):
+        ext = self._last_ext(dest)
+        if epoch is None:
+            try:
+                os.remove('{0}.{1}'.format(self.path, ext))
+            except FileNotFoundError:
+                pass
+            return
+        self._write(ext, '{0}\n{1}\n{2}\n'.format(epoch, name, runs))
+
+## Parses the entries of a journal's log
+#  \param data Contents of the log
+#  \returns Dictionary mapping changed paths (bytes) to their kinds
+#
+# Every path keeps the last of its kinds in `kinds` order. A path below a 'd'
+# entry is covered by it and left out.
+def parse_log(data):
+    changes = {}
+    for e in data.split(b'\0'):
+        k, p = e[:1].decode(errors='replace'), e[1:]
+        if k in kinds and p:
+            merge_change(changes, p, k)
+    trees = sorted(p for p, k in changes.items() if k == 'd')
+    return {p: k for p, k in changes.items()
+        if not any(p.startswith(t + b'/') for t in trees)}
+
+## Adds a changed path to a dictionary of changes
+#  \param changes Dictionary mapping changed paths to their kinds
+#  \param path The changed path
+#  \param kind Kind of the change (see `kinds`)
+def merge_change(changes, path, kind):
+    if kinds.index(kind) >= kinds.index(changes.get(path, 'a')):
+        changes[path] = kind
+
+## \class backup.BackupJournal._flock
+#  Holds an exclusive `flock` on a file for the duration of a `with` block
+class _flock:
+
+    ## Creates a `_flock` object
+    #  \param path Path of the lock file (created if necessary)
+    def __init__(self, path):
+        ## path of the lock file
+        self._path = path
+        ## file descriptor of the lock file
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.close(self._fd)
+        self._fd = None
+        return False
+
+## inotify event flags (see inotify(7))
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+## Events watched in every directory of a source
+_watch_mask = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+## Layout of the fixed part of an inotify event (wd, mask, cookie, len)
+_event = struct.Struct('iIII')
+
+## The C library's inotify functions (loaded on first use)
+_libc = None
+
+## Loads the C library's inotify functions
+#  \returns The C library (raises `JournalError` if inotify isn't available)
+def _inotify():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError):
+            raise JournalError('inotify is not available on this system')
+        _libc = libc
+    return _libc
+
+## \class backup.BackupJournal.source_watcher
+#  Records the changes made to a source directory in its `change_journal`
+#
+# Watches every directory of the source with inotify (adding watches for new
+# directories as they appear) and records the changed paths in the journal.
+# Changes are collected in memory (so a file written many times is recorded
+# once) until `flush()` is called.
+#
+# If inotify's queue overflows, the source itself is moved or deleted, or a
+# directory can't be watched (i.e. fs.inotify.max_user_watches is too low)
+# changes may have been missed, and the journal's epoch is restarted (or
+# cleared until the watcher is restarted) so the next backup walks the whole
+# source.
+class source_watcher:
+
+    ## Creates a `source_watcher` object and starts watching
+    #  \param journal `change_journal` of the source
+    #  \param printer `backup_printer` object to use for output
+    def __init__(self, journal, printer):
+        ## `change_journal` of the source
+        self.journal = journal
+        ## `backup_printer` object used for output
+        self._out = printer
+        ## path of the source (bytes)
+        self._root = os.fsencode(journal.src)
+        ## path (relative to the source) of each watched directory by wd
+        self._paths = {}
+        ## changes not yet recorded in the journal
+        self._changes = {}
+        ## inotify file descriptor
+        self._fd = _inotify().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise JournalError('Unable to initialize inotify: {0}'.format(
+                os.strerror(ctypes.get_errno())))
+        self._start()
+
+    ## inotify file descriptor (readable when there are events)
+    def fileno(self):
+        return self._fd
+
+    ## Stops watching
+    def close(self):
+        os.close(self._fd)
+
+    ## (Re)starts watching the whole source in a new epoch
+    def _start(self):
+        for wd in list(self._paths):
+            _inotify().inotify_rm_watch(self._fd, wd)
+        self._paths = {}
+        self._changes = {}
+        # Watch first so nothing done during the walk is missed
+        ok = self._watch_tree(b'')
+        self.journal.start(ok)
+        if ok:
+            self._out.info('Watching: {0} ({1} directories)\n'.format(
+                self.journal.src, len(self._paths)))
+
+    ## Watches a directory and every directory below it
+    #  \param rel Path of the directory relative to the source
+    #  \returns False if a directory that exists couldn't be watched
+    def _watch_tree(self, rel):
+        stack = [rel]
+        while stack:
+            r = stack.pop()
+            path = os.path.join(self._root, r) if r else self._root
+            wd = _inotify().inotify_add_watch(self._fd, path, _watch_mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                # A directory removed during the walk (but not the source)
+                if r and err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                self._out.error('Unable to watch: {0}: {1}\n'.format(
+                    os.fsdecode(path), os.strerror(err)))
+                return False
+            self._paths[wd] = r
+            try:
+                with os.scandir(path) as it:
+                    stack.extend(os.path.join(r, e.name) for e in it
+                        if e.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        return True
+
+    ## Stops watching a directory and every directory below it
+    def _unwatch_tree(self, rel):
+        for wd, r in list(self._paths.items()):
+            if r == rel or r.startswith(rel + b'/'):
+                _inotify().inotify_rm_watch(self._fd, wd)
+                del self._paths[wd]
+
+    ## Reads and handles all of the pending events
+    def read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        restart = False
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, i)
+            name = data[i + _event.size:i + _event.size + length].rstrip(b'\0')
+            i += _event.size + length
+            if mask & IN_Q_OVERFLOW:
+                self._out.warn('Event queue overflowed: {0}\n'.format(
+                    self.journal.src))
+                restart = True
+                continue
+            base = self._paths.get(wd)
+            if base is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._paths[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if base == b'':
+                    restart = True
+                continue
+            # Events of a directory itself have no name (those of the source
+            # itself are covered by walking it)
+            rel = os.path.join(base, name) if base and name else base or name
+            if not rel:
+                continue
+            isdir = mask & IN_ISDIR or not name
+            if isdir and mask & (IN_CREATE | IN_MOVED_TO):
+                merge_change(self._changes, rel, 'd')
+                if not self._watch_tree(rel):
+                    restart = True
+            elif isdir and mask & (IN_MOVED_FROM | IN_DELETE):
+                merge_change(self._changes, rel, 'd')
+                self._unwatch_tree(rel)
+            else:
+                merge_change(self._changes, rel, 'a' if isdir else 'f')
+        if restart:
+            self._out.warn('Changes may have been missed, restarting: '
+                '{0}\n'.format(self.journal.src))
+            self._start()
+
+    ## Records the collected changes in the journal
+    def flush(self):
+        self.journal.record(self._changes)
+        self._changes = {}
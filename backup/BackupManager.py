@@ -34,46 +34,266 @@
 
 from backup.BackupPrinter import backup_printer
 from backup.BackupExceptions import *
+from backup.BackupCatalog import backup_catalog
+from backup.BackupFingerprint import source_fingerprint
+from backup.BackupJournal import change_journal
+from backup.BackupMetrics import (parse_rsync_stats, run_metrics, write_json,
+    write_prometheus)
+from backup.BackupRetention import retention_policy
+from backup.BackupShards import shard_source, weights
+from backup.BackupSpace import (created_size, estimate_from_index,
+    estimate_from_stats, format_index, free_space, index_name, linked_file,
+    parse_index, parse_size, space_report)
+from backup.BackupThrottle import adaptive_throttle
+from backup.BackupTransport import local_transport, ssh_transport, transports
+from backup.BackupTuning import (drifted, load_tunings, mark_stale,
+    pick_fastest, rsync_compressions, sample_files, save_tuning, ssh_ciphers,
+    strip_compression)
+from backup.BackupVerify import (hash_cache, pick_files, source_digests,
+    transferred_file, verify_modes)
 
 import os
+import collections
+import concurrent.futures
+import inspect
 import re
+import selectors
+import shlex
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
+import uuid
 
 from datetime import datetime
 
+## Number of bytes to read from a command's output at a time
+_read_size = 64 * 1024
+
+## What to do instead of a transfer when the sources are unchanged since the
+#  most recent backup: keep that backup as it is, or rename it to the new name
+unchanged_actions = ('reuse', 'redate')
+
+## Prefix of the name a backup is transferred under (in dest) until it is
+#  complete
+staging_prefix = '.inprogress-'
+
+## Directory (relative to each directory rsync transfers into) that partially
+#  transferred files are kept in, for an interrupted backup to resume them
+partial_dir = '.rsync-partial'
+
+## Maximum number of `--link-dest` directories rsync accepts
+max_link_dests = 20
+
+## Options of `ionice` for each I/O scheduling class rsync can be run with
+ionice_classes = {'idle': ['-c3'], 'best-effort': ['-c2', '-n7']}
+
+## Default format of the timestamp in backup names (sorts lexicographically)
+default_name_format = '%Y-%m-%dT%H:%M:%S'
+
+## Formats of backup names created by older versions (still recognised)
+legacy_name_formats = ('%m-%d-%Y-%H:%M:%S',)
+
+## Fields a timestamp in a backup name can have (most significant first) and
+#  the regex matching each of them
+_name_fields = (('Y', r'\d{4}'), ('m', r'\d{2}'), ('d', r'\d{2}'),
+    ('H', r'\d{2}'), ('M', r'\d{2}'), ('S', r'\d{2}'))
+
+## Builds a regex matching the timestamps generated by a strftime format
+#  \param fmt strftime format using only the directives in `_name_fields`
+#  \returns Compiled regex with a named group for each field (None if `fmt` is
+#  unsupported)
+#
+# A format is unsupported if it uses any other directive, repeats one, lacks
+# the date (`%Y`, `%m` and `%d`) or would generate names containing a `/`.
+def _timestamp_regex(fmt):
+    fields = dict(_name_fields)
+    regex = ''
+    for p in re.split(r'(%.)', fmt):
+        if p == '%%':
+            regex += '%'
+        elif len(p) == 2 and p[0] == '%':
+            if p[1] not in fields or '(?P<{0}>'.format(p[1]) in regex:
+                return None
+            regex += '(?P<{0}>{1})'.format(p[1], fields[p[1]])
+        else:
+            regex += re.escape(p)
+    if '/' in fmt or any('(?P<{0}>'.format(f) not in regex for f in 'Ymd'):
+        return None
+    return re.compile(regex)
+
+## \class backup.BackupManager._line_collector
+#  Splits a command's output into lines as it arrives
+#
+# Fed raw chunks of a command's output, passes every complete line (prefixed
+# with `label`) to `emit` and keeps the lines for `text()`. If `tail` is not None
+# only the last `tail` lines are kept. A line that grows past `_read_size`
+# without a newline is emitted in pieces so memory use stays bounded.
+class _line_collector:
+
+    ## Creates a `_line_collector`
+    #  \param label Prefix written in front of every emitted line
+    #  \param tail Number of lines to keep (None keeps all of them)
+    #  \param emit Function called with every complete line
+    #  \param on_line Function also called with every complete line (without
+    #  the label), or None
+    def __init__(self, label, tail, emit, on_line=None):
+        ## prefix for emitted lines
+        self._label = label
+        ## function emitted lines are passed to
+        self._emit = emit
+        ## function every line is passed to (None for none)
+        self._on_line = on_line
+        ## lines kept for `text()`
+        self._lines = [] if tail is None else collections.deque(maxlen=tail)
+        ## incomplete last line
+        self._partial = b''
+
+    ## Adds a chunk of output, an empty chunk marks the end of the output
+    def feed(self, chunk):
+        if not chunk:
+            if self._partial:
+                self._add(self._partial)
+                self._partial = b''
+            return
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        if len(self._partial) > _read_size:
+            lines.append(self._partial)
+            self._partial = b''
+        for l in lines:
+            self._add(l)
+
+    ## Decodes, emits and keeps a single line
+    def _add(self, line):
+        line = line.decode(errors='replace')
+        self._emit('{0}{1}\n'.format(self._label, line))
+        if self._on_line is not None:
+            self._on_line(line)
+        self._lines.append(line)
+
+    ## Returns the kept lines as a single string
+    def text(self):
+        return ''.join(l + '\n' for l in self._lines)
+
 ## \class backup.BackupManager.backup_manager
 #  A class to create and remove backups
 #
 # A class to effeciently create and manage remote backups using `rsync` and
 # `ssh`. This includes creating new backups named using a prefix and timestamp
 # and removing old backups.
+#
+# All ssh connections made by a `backup_manager` (including the one `rsync`
+# uses as its transport) can share a single multiplexed ssh session. The session
+# is opened with `open_session()` and closed with `close_session()`, or by using
+# the object as a context manager:
+#
+#     with backup_manager(src, host, dest) as bm:
+#         bm.create_backup()
+#         bm.remove_backups()
 class backup_manager:
 
     ## Creates a `backup_manager` object to use to create and remove backups.
     #
     #  For more information about one of the parameters refer to the
     #  corrensponding member variable's documentation.
-    #  \param src Source directory to back up
+    #  \param src Source directory (or list of source directories) to back up
     #  \param host Destination (remote) host
     #  \param dest Destination directory (on `host`)
     #  \param user Username to use to connect to `host`
-    #  \param num_backups Number of backups to keep
+    #  \param num_backups Number of (most recent) backups to keep
     #  \param rsync_bin Path to `rsync` binary to use
     #  \param rsync_flags Flags to use with rsync
     #  \param exclude Exclude file for `rsync`
     #  \param ssh_bin Path to `ssh` binary to use
     #  \param ssh_key Path to ssh identity to use
     #  \param prefix Backup prefix
+    #  \param name_format strftime format of the timestamp in backup names
+    #  \param nice Niceness to run rsync with (None leaves it alone)
+    #  \param ionice I/O scheduling class to run rsync with ('idle',
+    #  'best-effort' or None to leave it alone)
+    #  \param bwlimit Bandwidth limit passed to rsync's --bwlimit (None for no
+    #  limit)
+    #  \param nocache Keep rsync's reads out of the page cache
+    #  \param throttle Slow rsync down while the host is busy
+    #  \param throttle_load Load average per CPU above which rsync is slowed
+    #  \param throttle_latency Disk latency (ms) above which rsync is slowed
+    #  \param job Name of the job (labels the run report)
+    #  \param report_json Path to write a JSON run report to (None for none)
+    #  \param report_prom Path to write the run report to in Prometheus' text
+    #  format (None for none)
+    #  \param transport How dest is reached ('ssh' or 'local')
     #  \param dry_run Execute dry run(s)
     #  \param log_excludes Log excluded files with backup
     #  \param printer An existing `backup_printer` object to use for output
+    #  \param multiplex Share one ssh connection between all remote commands
+    #  \param session_dir Directory of ssh sessions shared with other
+    #  `backup_manager` objects (None for a session of its own)
+    #  \param session_persist Seconds an idle ssh session lingers
+    #  \param tune_file Path of the file of the ssh ciphers and rsync
+    #  compressions tuned for each host (None to use the defaults)
+    #  \param autotune Tune the host before a backup if it needs to be
+    #  \param tune_sample Size (MiB) of the sample of the sources tuned with
+    #  \param verify Verify the files transferred into a backup ('sample',
+    #  'full' or None for no verification)
+    #  \param verify_sample Number of files verified with 'sample'
+    #  \param verify_cache Path of a local cache of the hashes of source files
+    #  (None for no cache)
+    #  \param space_index Keep an index of the space each backup introduced
+    #  \param capacity_prune Remove old backups before a backup that wouldn't
+    #  fit in dest otherwise
+    #  \param min_free Bytes to keep free in dest (with `capacity_prune`)
+    #  \param min_free_inodes Inodes to keep free in dest (with
+    #  `capacity_prune`)
+    #  \param min_backups Number of backups `capacity_prune` always keeps
+    #  \param link_dests Number of most recent backups used as link-dest
+    #  \param link_dest_tiers Also use the oldest backup each retention bucket
+    #  keeps as link-dest
+    #  \param link_dest_stats Count the bytes each extra link-dest saved (an
+    #  expensive diagnostic, see `link_dest_stats`)
+    #  \param workers Maximum number of concurrent rsync processes
+    #  \param destinations List of destinations to replicate backups to
+    #  \param shards Number of shards to split each source directory into
+    #  \param shard_weight How to weigh entries when sharding ('size'/'count')
+    #  \param shard_retries Number of times to retry failed transfers
+    #  \param async_prune Delete removed backups in the background
+    #  \param delete_workers Maximum number of concurrent remote deletions
+    #  \param delete_batch Maximum number of paths deleted by one command
+    #  \param keep_hourly Number of hours to keep a backup for
+    #  \param keep_daily Number of days to keep a backup for
+    #  \param keep_weekly Number of weeks to keep a backup for
+    #  \param keep_monthly Number of months to keep a backup for
+    #  \param keep_yearly Number of years to keep a backup for
+    #  \param catalog Path of a local catalog of backups (None for no catalog)
+    #  \param unchanged What to do when the sources are unchanged since the most
+    #  recent backup ('reuse', 'redate' or None to always transfer)
+    #  \param journal Directory the sources' change journals are kept in (None
+    #  to always walk the whole sources)
+    #  \param journal_full_every Maximum number of consecutive backups made
+    #  from a source's journal (0 for no limit)
+    #  \param journal_max Maximum number of changes transferred from a journal
     def __init__(self, src, host, dest, user=None, num_backups=1,
             rsync_bin='rsync', rsync_flags='-az', exclude=None, ssh_bin='ssh',
             ssh_key=None, prefix=None, dry_run=False, log_excludes=False,
-            printer=backup_printer()):
+            printer=backup_printer(), multiplex=True, workers=4,
+            destinations=None, shards=1, shard_weight='size', shard_retries=0,
+            async_prune=True, delete_workers=4, delete_batch=64, keep_hourly=0,
+            keep_daily=0, keep_weekly=0, keep_monthly=0, keep_yearly=0,
+            catalog=None, name_format=default_name_format, nice=None,
+            ionice=None, bwlimit=None, nocache=False, throttle=False,
+            throttle_load=1.0, throttle_latency=50.0, job=None,
+            report_json=None, report_prom=None, transport='ssh',
+            unchanged=None, journal=None, journal_full_every=24,
+            journal_max=10000, session_dir=None, session_persist=60,
+            tune_file=None, autotune=False, tune_sample=64, verify=None,
+            verify_sample=100, verify_cache=None, space_index=False,
+            capacity_prune=False, min_free=0, min_free_inodes=0,
+            min_backups=1, link_dests=1, link_dest_tiers=False,
+            link_dest_stats=False):
         ## `backup_printer` to use for output
         self.printer = printer
-        ## source directory
+        ## source directory (or list of source directories)
         self.src = src
         ## user on remote host
         self.user = user
@@ -81,8 +301,29 @@ class backup_manager:
         self.host = host
         ## destination directory on remote host
         self.dest = dest
-        ## number of backups to keep
+        ## how dest is reached ('ssh' or 'local')
+        #
+        #  With 'local' dest is a directory on this machine (e.g. a mounted
+        #  disk): `host` is ignored and every operation on dest is done
+        #  in-process instead of over ssh (see `local_transport`).
+        self.transport = transport
+        ## number of (most recent) backups to keep
         self.num_backups = num_backups
+        ## number of hours to keep a backup for
+        #
+        #  This and the other `keep_*` members make up a
+        #  grandfather-father-son retention policy on top of `num_backups`:
+        #  for each of the given number of most recent hours (days, ...) that
+        #  have a backup, the most recent backup is kept. 0 disables a bucket.
+        self.keep_hourly = keep_hourly
+        ## number of days to keep a backup for
+        self.keep_daily = keep_daily
+        ## number of weeks to keep a backup for
+        self.keep_weekly = keep_weekly
+        ## number of months to keep a backup for
+        self.keep_monthly = keep_monthly
+        ## number of years to keep a backup for
+        self.keep_yearly = keep_yearly
         ## path to rsync binary
         self.rsync_bin = rsync_bin
         ## rsync flags
@@ -101,14 +342,222 @@ class backup_manager:
         self.ssh_key = ssh_key
         ## backup prefix
         self.prefix = prefix
+        ## format of the timestamp in backup names
+        self.name_format = name_format
         ## dry run flag
         self.dry_run = dry_run
         ## log excluded files flag
         self.log_excludes = log_excludes
-        ## timestamp format string
-        self._date_fmt_str = '%m-%d-%Y-%H:%M:%S'
-        # Perhaps make this configurable? If they can change this then the regex
-        # to list backups also has to change though and that might be a mess
+        ## ssh connection multiplexing flag
+        self.multiplex = multiplex
+        ## directory of ssh sessions shared with other `backup_manager` objects
+        #
+        #  If set (and `multiplex` is) the session is opened in this directory,
+        #  which holds one master connection per remote host, instead of a
+        #  directory of its own. The session outlives `close_session()`, so the
+        #  next `backup_manager` using the directory starts with a warm
+        #  connection. Whoever created the directory ends the sessions (see
+        #  `stop_master()`).
+        self.session_dir = session_dir
+        ## seconds an idle ssh master connection lingers before exiting
+        self.session_persist = session_persist
+        ## path of the file of the transport tuned for each host
+        #
+        #  If set (and dest is reached over ssh) the ssh cipher and rsync
+        #  compression stored in this file for `host` (see `tune()`) are used
+        #  instead of ssh's default cipher and the compression in
+        #  `rsync_flags`. A transfer much slower than the tuning's throughput
+        #  marks it stale.
+        self.tune_file = tune_file
+        ## automatic tuning flag
+        #
+        #  If set `create_backup()` tunes the host first when it has no tuning
+        #  in `tune_file` or its tuning is stale.
+        self.autotune = autotune
+        ## size (MiB) of the sample of the sources `tune()` measures with
+        self.tune_sample = tune_sample
+        ## verification of new backups
+        #
+        #  If set, the files rsync transferred into a new backup (all of them
+        #  with 'full', a random sample of `verify_sample` of them with
+        #  'sample') are hashed on both ends and compared before the backup is
+        #  committed. Files rsync didn't transfer are hard links to files that
+        #  were verified when they were transferred.
+        self.verify = verify
+        ## number of files verified with `verify` set to 'sample'
+        self.verify_sample = verify_sample
+        ## path of the local cache of the hashes of source files
+        #
+        #  If set, the hashes of source files are kept in a local SQLite
+        #  database (see `hash_cache`), so files that haven't changed since
+        #  they were hashed (i.e. for another destination) aren't hashed again.
+        self.verify_cache = verify_cache
+        ## space accounting flag
+        #
+        #  If set, the inodes and bytes every new backup introduced (the
+        #  entries rsync created rather than hard linked to link-dest, as
+        #  reported in its itemized output) are recorded in an index file in
+        #  dest (see `space_report()`). Sizes are apparent sizes, and the
+        #  directories copied for backups made from journals aren't counted.
+        self.space_index = space_index
+        ## capacity driven pruning flag
+        #
+        #  If set, the free space and inodes of dest's file system are checked
+        #  along with its listing, and before a backup is transferred the
+        #  oldest backups are deleted (synchronously, never the link-dest or
+        #  the `min_backups` most recent ones) until the backup, estimated
+        #  from the space index or else a dry run, fits with `min_free` bytes
+        #  and `min_free_inodes` inodes to spare.
+        self.capacity_prune = capacity_prune
+        ## bytes to keep free in dest (a number, optionally with a K, M, G or T
+        #  suffix)
+        self.min_free = min_free
+        ## inodes to keep free in dest
+        self.min_free_inodes = min_free_inodes
+        ## number of most recent backups `capacity_prune` always keeps
+        self.min_backups = min_backups
+        ## number of most recent backups used as link-dest
+        #
+        #  rsync looks for each file in the link-dest directories in order and
+        #  hard links it to the first identical one, so older backups catch
+        #  files that were deleted (or changed) and then restored, at the cost
+        #  of rsync checking up to this many directories for every new or
+        #  changed file.
+        self.link_dests = link_dests
+        ## also use the oldest backup each retention bucket (see `keep_hourly`,
+        #  ...) keeps as link-dest
+        self.link_dest_tiers = link_dest_tiers
+        ## count the bytes each extra link-dest saved
+        #
+        #  rsync then lists every unchanged file too, and the files it linked
+        #  are checked against each link-dest in dest afterwards.
+        self.link_dest_stats = link_dest_stats
+        ## maximum number of concurrent rsync processes
+        self.workers = workers
+        ## destinations to replicate backups to
+        #
+        #  A list of dictionaries, each one describing a destination using any
+        #  of the keys in `_destination_keys` (the constructor parameters of the
+        #  same names). Missing keys are taken from this object. If this is
+        #  None (or empty), `host` and `dest` are the only destination.
+        self.destinations = destinations
+        ## number of shards to split each source directory into
+        #
+        #  Sharding splits a source directory's top-level entries into this
+        #  many groups of roughly equal weight, each transferred by its own
+        #  rsync process (up to `workers` at a time) into the same backup.
+        self.shards = shards
+        ## how to weigh a source's entries when sharding ('size' or 'count')
+        self.shard_weight = shard_weight
+        ## number of times failed transfers (i.e. shards) are retried
+        self.shard_retries = shard_retries
+        ## background deletion flag
+        #
+        #  If set `remove_backups()` renames old backups into a trash
+        #  directory and deletes them in the background on the remote machine
+        #  instead of waiting for `rm -r` to finish.
+        self.async_prune = async_prune
+        ## maximum number of concurrent remote deletion commands
+        self.delete_workers = delete_workers
+        ## maximum number of paths deleted (or moved) by one remote command
+        self.delete_batch = delete_batch
+        ## path of the local catalog of backups
+        #
+        #  If set, the backups in the destination are recorded in a local
+        #  SQLite database (see `backup_catalog`) and `preflight()` only lists
+        #  the destination when its generation marker shows it was changed by
+        #  someone else.
+        self.catalog = catalog
+        ## what to do when the sources are unchanged since the last backup
+        #
+        #  If set (and there is a `catalog`) a fingerprint of the sources (see
+        #  `source_fingerprint()`) is recorded for every backup, and
+        #  `create_backup()` skips rsync when it matches the most recent
+        #  backup's. With 'reuse' that backup is kept as the latest one, with
+        #  'redate' it is renamed to the new backup's name.
+        self.unchanged = unchanged
+        ## directory the sources' change journals are kept in
+        #
+        #  If set, and a `source_watcher` (see watch_sources.py) has been
+        #  recording the changes made to a source since the most recent backup,
+        #  that backup is copied (with hard links) and only the changed paths
+        #  are transferred with `--files-from`, instead of rsync walking the
+        #  whole source. See `change_journal` for when the whole source is
+        #  walked anyway.
+        self.journal = journal
+        ## maximum number of consecutive backups made from a source's journal
+        #  before the whole source is walked again (0 for no limit)
+        self.journal_full_every = journal_full_every
+        ## maximum number of changes transferred from a journal (more changes
+        #  than this are transferred by walking the whole source)
+        self.journal_max = journal_max
+        ## niceness to run rsync with (None leaves it alone)
+        self.nice = nice
+        ## I/O scheduling class to run rsync with (None leaves it alone)
+        self.ionice = ionice
+        ## bandwidth limit passed to rsync's --bwlimit (None for no limit)
+        self.bwlimit = bwlimit
+        ## page cache friendly reads flag
+        #
+        #  If set rsync is run under `nocache`, which tells the kernel to drop
+        #  the pages rsync reads from the cache, so a backup doesn't evict the
+        #  working set of the applications running on the host.
+        self.nocache = nocache
+        ## load average per CPU above which rsync is slowed (with `throttle`)
+        self.throttle_load = throttle_load
+        ## disk latency (ms) above which rsync is slowed (with `throttle`)
+        self.throttle_latency = throttle_latency
+        ## adaptive throttling flag
+        #
+        #  If set the local rsync processes are paused for part of every second
+        #  while the host's load average per CPU or its disk latency is above
+        #  `throttle_load` or `throttle_latency` (see `adaptive_throttle`).
+        self.throttle = throttle
+        ## name of the job (labels the run report, defaults to the destination)
+        self.job = job
+        ## path to write a JSON run report to (None for no report)
+        self.report_json = report_json
+        ## path to write a Prometheus textfile collector report to (None for no
+        #  report)
+        self.report_prom = report_prom
+        ## timings and rsync counters of this run
+        self._metrics = run_metrics()
+        ## directory holding the ssh control socket (None if no session is open)
+        self._control_dir = None
+        ## sorted list of backups in dest (None until dest has been listed)
+        self._backups_cache = None
+        ## sorted list of the interrupted backups in dest (see
+        #  `staging_prefix`)
+        self._staging = []
+        ## whether the new backup resumes an interrupted one (see
+        #  `_stage_backup()`)
+        self._resumed = False
+        ## lines of output kept from long running commands (i.e. rsync)
+        self._tail_lines = 100
+        ## backup the `latest` link in dest points to (None if unknown)
+        self._latest = None
+        ## fingerprint of the sources computed for the next backup (if any)
+        self._fingerprint = None
+        ## journals of the sources taken for the next backup (if any)
+        self._journals_taken = None
+        ## tuning of the host (None until read from `tune_file`, empty if it
+        #  has none)
+        self._tuning = None
+        ## local path of each file transferred into the next backup (by its
+        #  path in the backup), collected while `verify` is set
+        self._transferred = {}
+        ## bytes and inodes available in dest (see `free_space()`, None if
+        #  unknown)
+        self._free = None
+        ## backups used as link-dest (after the most recent one) by the next
+        #  backup
+        self._link_extra = []
+        ## size of each file rsync linked to a link-dest (by its path in the
+        #  backup), collected while `link_dest_stats` is set
+        self._linked = {}
+        ## journal of each source, with its epoch, changes since link-dest
+        #  (None for a full walk) and number of backups made from it
+        self._journal_plan = {}
 
     # Getters / setters --------------------------------------------------------
 
@@ -138,7 +587,7 @@ class backup_manager:
         # FIXME: remove validation here
         #if not os.path.exists(s):
         #    self._out.warn('Source directory: {0} does not exist\n'.format(s))
-        # source directory
+        # source directory (or list of source directories)
         self._src = s
 
     ## Get `user`
@@ -273,6 +722,25 @@ class backup_manager:
             return
         self._prefix = v
 
+    ## Get `name_format`
+    @property
+    def name_format(self):
+        return self._name_format
+    ## Set `name_format`
+    @name_format.setter
+    def name_format(self, v):
+        regex = _timestamp_regex(v)
+        if regex is None:
+            self._out.warn('Unsupported backup name format: {0}, using {1} '
+                'instead\n'.format(v, default_name_format))
+            v = default_name_format
+            regex = _timestamp_regex(v)
+        ## format of the timestamp in backup names
+        self._name_format = v
+        ## regexes matching timestamps in backup names (current format first)
+        self._name_regexes = [regex] + [_timestamp_regex(x)
+            for x in legacy_name_formats if x != v]
+
     ## Get `dry_run`
     @property
     def dry_run(self):
@@ -292,24 +760,714 @@ class backup_manager:
     def log_excludes(self, v):
         ## log excluded files flag
         self._log_excludes = v
+
+    ## Get `multiplex`
+    @property
+    def multiplex(self):
+        return self._multiplex
+    ## Set `multiplex`
+    @multiplex.setter
+    def multiplex(self, v):
+        ## ssh connection multiplexing flag
+        self._multiplex = v
+
+    ## Get `workers`
+    @property
+    def workers(self):
+        return self._workers
+    ## Set `workers`
+    @workers.setter
+    def workers(self, v):
+        i = int(v)
+        if i < 1:
+            self._out.warn('Number of workers must be >= 1, {} specified, using'
+            ' 1 instead\n'.format(v))
+            ## maximum number of concurrent rsync processes
+            self._workers = 1
+            return
+        self._workers = i
+
+    ## Get `destinations`
+    @property
+    def destinations(self):
+        return self._destinations
+    ## Set `destinations`
+    @destinations.setter
+    def destinations(self, v):
+        if v is not None:
+            for d in v:
+                unknown = set(d) - set(self._destination_keys)
+                if unknown:
+                    raise BackupError('Unknown destination setting(s): '
+                        '{0}'.format(' '.join(sorted(unknown))))
+        ## destinations to replicate backups to
+        self._destinations = v
+        ## `backup_manager` for each destination (built when first needed)
+        self._replica_list = None
+
+    ## Get `shards`
+    @property
+    def shards(self):
+        return self._shards
+    ## Set `shards`
+    @shards.setter
+    def shards(self, v):
+        i = int(v)
+        if i < 1:
+            self._out.warn('Number of shards must be >= 1, {} specified, using'
+            ' 1 instead\n'.format(v))
+            ## number of shards to split each source directory into
+            self._shards = 1
+            return
+        self._shards = i
+
+    ## Get `shard_weight`
+    @property
+    def shard_weight(self):
+        return self._shard_weight
+    ## Set `shard_weight`
+    @shard_weight.setter
+    def shard_weight(self, v):
+        if v not in weights:
+            self._out.warn('Unknown shard weight: {}, using size instead\n'.format(v))
+            ## how to weigh a source's entries when sharding
+            self._shard_weight = 'size'
+            return
+        self._shard_weight = v
+
+    ## Get `shard_retries`
+    @property
+    def shard_retries(self):
+        return self._shard_retries
+    ## Set `shard_retries`
+    @shard_retries.setter
+    def shard_retries(self, v):
+        ## number of times failed transfers are retried
+        self._shard_retries = max(int(v), 0)
+
+    ## Get `async_prune`
+    @property
+    def async_prune(self):
+        return self._async_prune
+    ## Set `async_prune`
+    @async_prune.setter
+    def async_prune(self, v):
+        ## background deletion flag
+        self._async_prune = v
+
+    ## Get `delete_workers`
+    @property
+    def delete_workers(self):
+        return self._delete_workers
+    ## Set `delete_workers`
+    @delete_workers.setter
+    def delete_workers(self, v):
+        ## maximum number of concurrent remote deletion commands
+        self._delete_workers = max(int(v), 1)
+
+    ## Get `delete_batch`
+    @property
+    def delete_batch(self):
+        return self._delete_batch
+    ## Set `delete_batch`
+    @delete_batch.setter
+    def delete_batch(self, v):
+        ## maximum number of paths deleted by one remote command
+        self._delete_batch = max(int(v), 1)
+
+    ## Get `keep_hourly`
+    @property
+    def keep_hourly(self):
+        return self._keep_hourly
+    ## Set `keep_hourly`
+    @keep_hourly.setter
+    def keep_hourly(self, v):
+        ## number of hours to keep a backup for
+        self._keep_hourly = max(int(v), 0)
+
+    ## Get `keep_daily`
+    @property
+    def keep_daily(self):
+        return self._keep_daily
+    ## Set `keep_daily`
+    @keep_daily.setter
+    def keep_daily(self, v):
+        ## number of days to keep a backup for
+        self._keep_daily = max(int(v), 0)
+
+    ## Get `keep_weekly`
+    @property
+    def keep_weekly(self):
+        return self._keep_weekly
+    ## Set `keep_weekly`
+    @keep_weekly.setter
+    def keep_weekly(self, v):
+        ## number of weeks to keep a backup for
+        self._keep_weekly = max(int(v), 0)
+
+    ## Get `keep_monthly`
+    @property
+    def keep_monthly(self):
+        return self._keep_monthly
+    ## Set `keep_monthly`
+    @keep_monthly.setter
+    def keep_monthly(self, v):
+        ## number of months to keep a backup for
+        self._keep_monthly = max(int(v), 0)
+
+    ## Get `keep_yearly`
+    @property
+    def keep_yearly(self):
+        return self._keep_yearly
+    ## Set `keep_yearly`
+    @keep_yearly.setter
+    def keep_yearly(self, v):
+        ## number of years to keep a backup for
+        self._keep_yearly = max(int(v), 0)
+
+    ## Get `catalog`
+    @property
+    def catalog(self):
+        return self._catalog_path
+    ## Set `catalog`
+    @catalog.setter
+    def catalog(self, v):
+        ## path of the local catalog of backups
+        self._catalog_path = v
+        ## `backup_catalog` object (None if there is no catalog)
+        self._catalog = backup_catalog(v) if v else None
+
+    ## Get `unchanged`
+    @property
+    def unchanged(self):
+        return self._unchanged
+    ## Set `unchanged`
+    @unchanged.setter
+    def unchanged(self, v):
+        if v is not None and v not in unchanged_actions:
+            self._out.warn('Unknown action for unchanged sources: {}, '
+                'ignoring it\n'.format(v))
+            v = None
+        ## what to do when the sources are unchanged since the last backup
+        self._unchanged = v
+
+    ## Get `session_dir`
+    @property
+    def session_dir(self):
+        return self._session_dir
+    ## Set `session_dir`
+    @session_dir.setter
+    def session_dir(self, v):
+        ## directory of ssh sessions shared with other `backup_manager` objects
+        self._session_dir = v
+
+    ## Get `session_persist`
+    @property
+    def session_persist(self):
+        return self._control_persist
+    ## Set `session_persist`
+    @session_persist.setter
+    def session_persist(self, v):
+        v = int(v)
+        if v < 1:
+            self._out.warn('Invalid session lifetime: {}, using 60 '
+                'instead\n'.format(v))
+            v = 60
+        ## seconds an idle ssh master lingers (guards against leaked masters)
+        self._control_persist = v
+
+    ## Get `tune_file`
+    @property
+    def tune_file(self):
+        return self._tune_file
+    ## Set `tune_file`
+    @tune_file.setter
+    def tune_file(self, v):
+        ## path of the file of the transport tuned for each host
+        self._tune_file = v
+        self._tuning = None
+
+    ## Get `autotune`
+    @property
+    def autotune(self):
+        return self._autotune
+    ## Set `autotune`
+    @autotune.setter
+    def autotune(self, v):
+        ## automatic tuning flag
+        self._autotune = bool(v)
+
+    ## Get `tune_sample`
+    @property
+    def tune_sample(self):
+        return self._tune_sample
+    ## Set `tune_sample`
+    @tune_sample.setter
+    def tune_sample(self, v):
+        v = int(v)
+        if v < 1:
+            self._out.warn('Invalid tuning sample size: {}, using 64 '
+                'instead\n'.format(v))
+            v = 64
+        ## size (MiB) of the sample of the sources tuned with
+        self._tune_sample = v
+
+    ## Get `verify`
+    @property
+    def verify(self):
+        return self._verify
+    ## Set `verify`
+    @verify.setter
+    def verify(self, v):
+        if v is not None and v not in verify_modes:
+            self._out.warn('Unknown verification: {}, ignoring it\n'.format(v))
+            v = None
+        ## verification of new backups
+        self._verify = v
+
+    ## Get `verify_sample`
+    @property
+    def verify_sample(self):
+        return self._verify_sample
+    ## Set `verify_sample`
+    @verify_sample.setter
+    def verify_sample(self, v):
+        v = int(v)
+        if v < 1:
+            self._out.warn('Invalid number of files to verify: {}, using 100 '
+                'instead\n'.format(v))
+            v = 100
+        ## number of files verified with 'sample'
+        self._verify_sample = v
+
+    ## Get `verify_cache`
+    @property
+    def verify_cache(self):
+        return self._verify_cache_path
+    ## Set `verify_cache`
+    @verify_cache.setter
+    def verify_cache(self, v):
+        ## path of the local cache of the hashes of source files
+        self._verify_cache_path = v
+        ## `hash_cache` object (None if there is no cache)
+        self._verify_cache = hash_cache(v) if v else None
+
+    ## Get `space_index`
+    @property
+    def space_index(self):
+        return self._space_index
+    ## Set `space_index`
+    @space_index.setter
+    def space_index(self, v):
+        ## space accounting flag
+        self._space_index = bool(v)
+
+    ## Get `capacity_prune`
+    @property
+    def capacity_prune(self):
+        return self._capacity_prune
+    ## Set `capacity_prune`
+    @capacity_prune.setter
+    def capacity_prune(self, v):
+        ## capacity driven pruning flag
+        self._capacity_prune = bool(v)
+
+    ## Get `min_free`
+    @property
+    def min_free(self):
+        return self._min_free
+    ## Set `min_free`
+    @min_free.setter
+    def min_free(self, v):
+        try:
+            v = parse_size(v)
+        except ValueError:
+            self._out.warn('Invalid free space: {}, using 0 instead\n'.format(
+                v))
+            v = 0
+        ## bytes to keep free in dest
+        self._min_free = v
+
+    ## Get `min_free_inodes`
+    @property
+    def min_free_inodes(self):
+        return self._min_free_inodes
+    ## Set `min_free_inodes`
+    @min_free_inodes.setter
+    def min_free_inodes(self, v):
+        v = int(v)
+        if v < 0:
+            self._out.warn('Invalid number of free inodes: {}, using 0 '
+                'instead\n'.format(v))
+            v = 0
+        ## inodes to keep free in dest
+        self._min_free_inodes = v
+
+    ## Get `min_backups`
+    @property
+    def min_backups(self):
+        return self._min_backups
+    ## Set `min_backups`
+    @min_backups.setter
+    def min_backups(self, v):
+        v = int(v)
+        if v < 1:
+            self._out.warn('Invalid minimum number of backups: {}, using 1 '
+                'instead\n'.format(v))
+            v = 1
+        ## number of most recent backups `capacity_prune` always keeps
+        self._min_backups = v
+
+    ## Get `link_dests`
+    @property
+    def link_dests(self):
+        return self._link_dests
+    ## Set `link_dests`
+    @link_dests.setter
+    def link_dests(self, v):
+        v = int(v)
+        if v < 1 or v > max_link_dests:
+            self._out.warn('Invalid number of link-dest backups: {0}, using '
+                '{1} instead\n'.format(v, min(max(v, 1), max_link_dests)))
+            v = min(max(v, 1), max_link_dests)
+        ## number of most recent backups used as link-dest
+        self._link_dests = v
+
+    ## Get `link_dest_tiers`
+    @property
+    def link_dest_tiers(self):
+        return self._link_dest_tiers
+    ## Set `link_dest_tiers`
+    @link_dest_tiers.setter
+    def link_dest_tiers(self, v):
+        ## retention bucket link-dest flag
+        self._link_dest_tiers = bool(v)
+
+    ## Get `link_dest_stats`
+    @property
+    def link_dest_stats(self):
+        return self._link_dest_stats
+    ## Set `link_dest_stats`
+    #
+    # This is an expensive diagnostic: rsync lists every unchanged file, and
+    # after the transfer the new backup and each link-dest are listed (with
+    # their inode numbers) on the destination to tell where the linked files
+    # came from, which can take about as long as the backup itself.
+    @link_dest_stats.setter
+    def link_dest_stats(self, v):
+        ## link-dest savings flag
+        self._link_dest_stats = bool(v)
+
+    ## Get `journal`
+    @property
+    def journal(self):
+        return self._journal
+    ## Set `journal`
+    @journal.setter
+    def journal(self, v):
+        ## directory the sources' change journals are kept in
+        self._journal = v
+
+    ## Get `journal_full_every`
+    @property
+    def journal_full_every(self):
+        return self._journal_full_every
+    ## Set `journal_full_every`
+    @journal_full_every.setter
+    def journal_full_every(self, v):
+        v = int(v)
+        if v < 0:
+            self._out.warn('Invalid number of backups between full walks: {}, '
+                'using 0 instead\n'.format(v))
+            v = 0
+        ## maximum number of consecutive backups made from a journal
+        self._journal_full_every = v
+
+    ## Get `journal_max`
+    @property
+    def journal_max(self):
+        return self._journal_max
+    ## Set `journal_max`
+    @journal_max.setter
+    def journal_max(self, v):
+        v = int(v)
+        if v < 1:
+            self._out.warn('Invalid maximum number of journal changes: {}, '
+                'using 1 instead\n'.format(v))
+            v = 1
+        ## maximum number of changes transferred from a journal
+        self._journal_max = v
+
+    ## Get `nice`
+    @property
+    def nice(self):
+        return self._nice
+    ## Set `nice`
+    @nice.setter
+    def nice(self, v):
+        ## niceness to run rsync with (None leaves it alone)
+        self._nice = None if v is None else min(max(int(v), -20), 19)
+
+    ## Get `ionice`
+    @property
+    def ionice(self):
+        return self._ionice
+    ## Set `ionice`
+    @ionice.setter
+    def ionice(self, v):
+        if v is not None and v not in ionice_classes:
+            self._out.warn('Unknown I/O scheduling class: {}, ignoring '
+                'it\n'.format(v))
+            v = None
+        ## I/O scheduling class to run rsync with (None leaves it alone)
+        self._ionice = v
+
+    ## Get `bwlimit`
+    @property
+    def bwlimit(self):
+        return self._bwlimit
+    ## Set `bwlimit`
+    @bwlimit.setter
+    def bwlimit(self, v):
+        ## bandwidth limit passed to rsync's --bwlimit (None for no limit)
+        self._bwlimit = None if v is None else str(v)
+
+    ## Get `nocache`
+    @property
+    def nocache(self):
+        return self._nocache
+    ## Set `nocache`
+    @nocache.setter
+    def nocache(self, v):
+        ## page cache friendly reads flag
+        self._nocache = bool(v)
+
+    ## Get `throttle`
+    @property
+    def throttle(self):
+        return self._throttle is not None
+    ## Set `throttle`
+    @throttle.setter
+    def throttle(self, v):
+        ## `adaptive_throttle` the rsync processes are watched by (None for no
+        #  throttling)
+        self._throttle = adaptive_throttle(self._throttle_load,
+            self._throttle_latency, printer=self._out) if v else None
+
+    ## Get `throttle_load`
+    @property
+    def throttle_load(self):
+        return self._throttle_load
+    ## Set `throttle_load`
+    @throttle_load.setter
+    def throttle_load(self, v):
+        ## load average per CPU above which rsync is slowed
+        self._throttle_load = float(v)
+        if getattr(self, '_throttle', None) is not None:
+            self._throttle.max_load = self._throttle_load
+
+    ## Get `throttle_latency`
+    @property
+    def throttle_latency(self):
+        return self._throttle_latency
+    ## Set `throttle_latency`
+    @throttle_latency.setter
+    def throttle_latency(self, v):
+        ## disk latency (ms) above which rsync is slowed
+        self._throttle_latency = float(v)
+        if getattr(self, '_throttle', None) is not None:
+            self._throttle.max_latency = self._throttle_latency
+
+    ## Get `job`
+    @property
+    def job(self):
+        return self._job
+    ## Set `job`
+    @job.setter
+    def job(self, v):
+        ## name of the job
+        self._job = v
+
+    ## Get `report_json`
+    @property
+    def report_json(self):
+        return self._report_json
+    ## Set `report_json`
+    @report_json.setter
+    def report_json(self, v):
+        ## path to write a JSON run report to
+        self._report_json = v
+
+    ## Get `report_prom`
+    @property
+    def report_prom(self):
+        return self._report_prom
+    ## Set `report_prom`
+    @report_prom.setter
+    def report_prom(self, v):
+        ## path to write a Prometheus textfile collector report to
+        self._report_prom = v
+
+    ## Get `transport`
+    @property
+    def transport(self):
+        return self._transport_name
+    ## Set `transport`
+    @transport.setter
+    def transport(self, v):
+        if v not in transports:
+            self._out.warn('Unknown transport: {}, using ssh\n'.format(v))
+            v = 'ssh'
+        ## how dest is reached
+        self._transport_name = v
+        ## object performing the operations on dest
+        self._transport = (local_transport(self._out) if v == 'local' else
+            ssh_transport(self))
     ##@}
 
+    ## Settings that can be given for each one of `destinations`
+    _destination_keys = ('host', 'dest', 'user', 'ssh_key', 'num_backups',
+        'keep_hourly', 'keep_daily', 'keep_weekly', 'keep_monthly',
+        'keep_yearly', 'bwlimit', 'transport')
+
+    # Session management -------------------------------------------------------
+
+    ## Opens the session when used as a context manager
+    def __enter__(self):
+        self.open_session()
+        return self
+
+    ## Closes the session when leaving the context (even on error)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_session()
+        return False
+
+    ## Opens a multiplexed ssh session
+    #
+    # Creates a private directory for the ssh control socket. Once it exists,
+    # every command built by `_ssh_cmd()` and `_rsync_cmd()` asks ssh to use
+    # (and if necessary start) a master connection on that socket, so only the
+    # first remote command pays for key exchange and authentication. Does
+    # nothing if multiplexing is disabled or a session is already open.
+    def open_session(self):
+        if self._destinations:
+            self._fan_out(lambda r: r.open_session())
+            return
+        if (not self._multiplex or self._control_dir is not None or
+                self._transport_name != 'ssh'):
+            return
+        if self._session_dir is not None:
+            os.makedirs(self._session_dir, mode=0o700, exist_ok=True)
+            self._control_dir = self._session_dir
+            self._out.debug('Using ssh session: {}\n'.format(
+                self._control_path()))
+            return
+        self._control_dir = tempfile.mkdtemp(prefix='backup-ssh-')
+        self._out.debug('Opened ssh session: {}\n'.format(self._control_path()))
+
+    ## Closes the multiplexed ssh session
+    #
+    # Asks the master connection (if one was started) to exit and removes the
+    # control socket directory. Safe to call when no session is open.
+    def close_session(self):
+        if self._replica_list is not None:
+            self._fan_out(lambda r: r.close_session())
+            return
+        if self._control_dir is None:
+            return
+        if self._session_dir is None:
+            self.stop_master()
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._out.debug('Closed ssh session: {}\n'.format(
+                self._control_path()))
+        self._control_dir = None
+
+    ## Asks the ssh master connection of the session (if one was started) to
+    #  exit
+    #
+    # Used by `close_session()`, and by the owner of a `session_dir` to end the
+    # sessions in it (with a session opened in it).
+    def stop_master(self):
+        if self._replica_list is not None:
+            self._fan_out(lambda r: r.stop_master())
+            return
+        if self._control_dir is None:
+            return
+        self._run_cmd([self._ssh_bin, '-o',
+            'ControlPath={}'.format(self._control_path()), '-O', 'exit',
+            self._ssh_target()])
+
+    ## Path to the ssh control socket of the open session
+    #
+    # A shared `session_dir` holds a socket per remote host and user (named by
+    # ssh, see ControlPath in ssh_config(5)).
+    def _control_path(self):
+        if self._session_dir is not None:
+            return os.path.join(self._control_dir, '%C')
+        return os.path.join(self._control_dir, 'master')
+
     ## Runs a single command.
     #  \param cmd List of command-line elements to pass to Popen
+    #  \param tail Number of trailing output lines to keep (None keeps all)
+    #  \param throttled Let the `throttle` (if any) slow the command down
     #  \returns command's exit status
     #  \returns command's stdout
     #  \returns command's stderr
     #
-    # Runs a single command displaying it and its return code, stdout and stderr
-    # on the debugging stream.
-    def _run_cmd(self, cmd):
+    # Runs a single command displaying it and its return code on the debugging
+    # stream. stdout and stderr are read as the command produces them and each
+    # line is forwarded to the debugging stream as soon as it is complete. If
+    # `tail` is given only that many of the most recent lines of each stream
+    # are kept (and returned), so commands with very large output (like
+    # `rsync -v` over a big tree) run in constant memory.
+    #
+    # A throttled command is started in a session of its own, so the throttle
+    # can stop it together with its children (i.e. rsync's ssh). It then
+    # doesn't get the terminal's signals, and is terminated here if collecting
+    # its output is interrupted.
+    def _run_cmd(self, cmd, tail=None, throttled=False, on_line=None):
         self._out.debug('CMD : {0}\n'.format(' '.join(cmd)))
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        o, e = proc.communicate()
+        throttle = self._throttle if throttled else None
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=throttle is not None)
+        if throttle is not None:
+            throttle.watch(proc)
+        try:
+            return self._collect_output(proc, tail, on_line)
+        except BaseException:
+            if throttle is not None and proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+            raise
+        finally:
+            if throttle is not None:
+                throttle.unwatch(proc)
+
+    ## Collects the output of a command until it exits
+    #  \param proc `subprocess.Popen` object of the command
+    #  \param tail Number of lines of each output to keep (None keeps all)
+    #  \param on_line Function called with every line of standard output (None
+    #  for none)
+    #  \returns Tuple of the exit code, standard output and standard error
+    def _collect_output(self, proc, tail, on_line=None):
+        streams = {
+            proc.stdout: _line_collector('OUT : ', tail, self._out.debug,
+                on_line),
+            proc.stderr: _line_collector('ERR : ', tail, self._out.debug),
+        }
+        with selectors.DefaultSelector() as sel:
+            for f in streams:
+                sel.register(f, selectors.EVENT_READ)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    chunk = os.read(key.fd, _read_size)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                    streams[key.fileobj].feed(chunk)
+        proc.wait()
         self._out.debug('EXIT: {0}\n'.format(proc.returncode))
-        self._out.debug('OUT : {0}\n'.format(o.decode().rstrip()))
-        self._out.debug('ERR : {0}\n'.format(e.decode().rstrip()))
-        return proc.returncode, o.decode(), e.decode()
+        return (proc.returncode, streams[proc.stdout].text(),
+            streams[proc.stderr].text())
 
 
     ## Generate a backup name using prefix and a timestamp
@@ -322,7 +1480,7 @@ class backup_manager:
     # (This can be done easily by using the same API to generate and sort the
     # dates)
     def _generate_backup_name(self):
-        timestamp = datetime.now().strftime(self._date_fmt_str)
+        timestamp = datetime.now().strftime(self._name_format)
         return '{0}{1}'.format(self._prefix, timestamp)
 
     ## Sort a list of backup names into chronological order (oldest first)
@@ -333,11 +1491,42 @@ class backup_manager:
     # `_generate_backup_name()` function. If one changes, the other must change
     # such that this function sorts a list of backup names generated
     # by `_generate_backup_name()` into chronological order (oldest first).
+    # Names are compared by their timestamp fields, so backups named in a
+    # legacy format sort correctly among the others.
     def _sort_backup_names(self, backups):
-        ts = lambda s: datetime.strptime(s, self._date_fmt_str)
-        backups.sort(key=lambda x: ts(x.lstrip(self._prefix)))
+        backups.sort(key=self._parse_backup_name)
         return backups
 
+    ## Split a backup name into the fields of its timestamp
+    #  \param name Backup name (in the current or a legacy format)
+    #  \returns Tuple of the fields (most significant first, missing ones are
+    #  0), or None if `name` isn't a backup name
+    def _parse_backup_name(self, name):
+        if not name.startswith(self._prefix):
+            return None
+        for regex in self._name_regexes:
+            m = regex.fullmatch(name, len(self._prefix))
+            if m is not None:
+                g = m.groupdict()
+                return tuple(int(g.get(f, 0)) for f, _ in _name_fields)
+        return None
+
+    ## Parse the timestamp of a backup name
+    #  \param name Backup name (in the current or a legacy format)
+    #  \returns The backup's timestamp (`datetime`)
+    def _backup_timestamp(self, name):
+        return datetime(*self._parse_backup_name(name))
+
+    ## Name of the link in dest that points to the most recent backup
+    def _latest_link(self):
+        return '{0}latest'.format(self._prefix)
+
+    ## Builds the retention policy described by `num_backups` and `keep_*`
+    def _retention_policy(self):
+        return retention_policy(self._backups, self._keep_hourly,
+            self._keep_daily, self._keep_weekly, self._keep_monthly,
+            self._keep_yearly)
+
     ## Builds base ssh command
     #  \returns List containing base ssh command
     #
@@ -345,37 +1534,373 @@ class backup_manager:
     # user, and host members. This list is designed to be extended with the
     # specifics of an ssh command execution and passed to `_run_cmd()`
     def _ssh_cmd(self):
-        r = [self._ssh_bin]
+        return [self._ssh_bin] + self._ssh_opts() + [self._ssh_target()]
+
+    ## Builds the ssh options shared by `_ssh_cmd()` and `_rsync_cmd()`
+    #  \returns List of ssh options
+    #
+    # Includes the identity file, the tuned cipher (if any) and, while a session
+    # is open, the options needed to share the session's master connection.
+    def _ssh_opts(self):
+        r = []
         if self._ssh_key is not None:
             r.extend(['-i', self._ssh_key])
-        if self._user is not None:
-            r.append('{}@{}'.format(self._user, self._host))
-        else:
-            r.append(self._host)
+        tuning = self._host_tuning()
+        if tuning is not None and tuning.get('cipher') is not None:
+            r.extend(['-c', tuning['cipher']])
+        if self._control_dir is not None:
+            r.extend(['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}'.format(self._control_path()),
+                '-o', 'ControlPersist={}'.format(self._control_persist)])
         return r
 
+    ## Builds the ssh destination (`[user@]host`)
+    def _ssh_target(self):
+        if self._user is not None:
+            return '{}@{}'.format(self._user, self._host)
+        return self._host
+
     ## Builds base rsync command
     #  \returns List containing base rsync command
     #
     # Builds the base of an rsync command into a list using the rsync_bin,
-    # rsync_flags, dry_run, and ssh_key members. This list is designed to be
-    # extended with the specifics of an rsync command exection and passed to
-    # `_run_cmd()`
+    # rsync_flags, dry_run, and ssh_key members (and the open session, if any).
+    # The host's tuned compression (if any) replaces the one in rsync_flags.
+    # This list is designed to be extended with the specifics of an rsync
+    # command exection and passed to `_run_cmd()`
     def _rsync_cmd(self):
-        r = [self._rsync_bin, '-v', self._rsync_flags]
+        tuning = self._host_tuning()
+        if tuning is None:
+            r = self._priority_cmd() + [self._rsync_bin, '-v',
+                self._rsync_flags]
+        else:
+            flags = strip_compression(self._rsync_flags)
+            r = self._priority_cmd() + [self._rsync_bin, '-v'] + (
+                [flags] if flags else []) + tuning.get('rsync_flags', [])
         if self._dry_run:
             r.append('-n')
-        if self._ssh_key is not None:
-            r.extend(['-e', '{} -i {}'.format(self._ssh_bin, self._ssh_key)])
+        if self._bwlimit is not None:
+            r.append('--bwlimit={0}'.format(self._bwlimit))
+        # Itemized names (and sizes) of the transferred files, for `verify`
+        # and `space_index`, and of the unchanged ones for `link_dest_stats`
+        watch_links = self._link_dest_stats and self._link_extra
+        if self._verify is not None or self._space_index or watch_links:
+            r.append('--out-format=%i %l %n')
+        if watch_links:
+            r.append('-ii')
+        r.extend(self._transport.rsync_shell())
+        # Counters for the run report, printed at the very end so they are in
+        # the tail of the output that is kept
+        r.append('--stats')
         return r
 
+    ## Builds the commands rsync is run under to lower its priority
+    #  \returns List to put in front of the rsync command (possibly empty)
+    #
+    # `ionice` and `nocache` are only used if they are installed, otherwise a
+    # warning is printed and rsync runs without them.
+    def _priority_cmd(self):
+        r = []
+        if self._nice is not None:
+            r.extend(['nice', '-n', str(self._nice)])
+        if self._ionice is not None:
+            if shutil.which('ionice'):
+                r.extend(['ionice'] + ionice_classes[self._ionice])
+            else:
+                self._out.warn('ionice not found, ignoring I/O scheduling '
+                    'class\n')
+        if self._nocache:
+            if shutil.which('nocache'):
+                r.append('nocache')
+            else:
+                self._out.warn('nocache not found, reads will go through the '
+                    'page cache\n')
+        return r
+
+    ## Tuning of the host (see `tune()`)
+    #  \returns Dictionary of the tuning (None if there is none, or dest isn't
+    #  reached over ssh)
+    def _host_tuning(self):
+        if self._tune_file is None or self._transport_name != 'ssh':
+            return None
+        if self._tuning is None:
+            self._tuning = load_tunings(self._tune_file).get(
+                self._ssh_target(), {})
+        return self._tuning or None
+
+    ## Measures the fastest ssh cipher and rsync compression for the host
+    #  \returns The tuning stored in `tune_file` (see `save_tuning()`), or with
+    #  `destinations` a dictionary mapping each destination to its tuning
+    #
+    # Copies a sample of the sources (`tune_sample` MiB) to a temporary
+    # directory in dest with each cipher ssh supports (without compression)
+    # and then with each compression rsync supports using the fastest cipher.
+    # Every copy sends all of the data (`--ignore-times --whole-file`) over a
+    # connection of its own, since a shared master connection keeps its
+    # cipher. A first copy creates the files and isn't measured.
+    def tune(self):
+        if self._destinations:
+            return self._fan_out(lambda r: r.tune())
+        if self._transport_name != 'ssh':
+            raise BackupError('Only destinations reached over ssh can be tuned')
+        if self._tune_file is None:
+            raise BackupError('No tune_file to store the tuning in')
+        files, size = sample_files(self._sources(), self._tune_sample << 20)
+        if not size:
+            raise BackupError('No data to tune with in the sources')
+        self._out.info('Tuning {0} with {1} file(s), {2} bytes\n'.format(
+            self._ssh_target(), len(files), size))
+        tmp = os.path.join(self._dest, '.tune-{0}'.format(uuid.uuid4().hex))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'\0'.join(os.fsencode(x.lstrip('/')) for x in files))
+            f.flush()
+
+            # Throughput of a copy of the sample (None if it failed)
+            def copy(cipher, flags):
+                ssh = [self._ssh_bin, '-o', 'ControlMaster=no', '-o',
+                    'ControlPath=none']
+                if self._ssh_key is not None:
+                    ssh.extend(['-i', self._ssh_key])
+                if cipher is not None:
+                    ssh.extend(['-c', cipher])
+                cmd = [self._rsync_bin, '-a', '--ignore-times', '--whole-file',
+                    '--from0', '--files-from={0}'.format(f.name)] + flags + [
+                    '-e', ' '.join(ssh), '/',
+                    self._transport.rsync_target(tmp + '/')]
+                start = time.monotonic()
+                res, _, e = self._run_cmd(cmd, self._tail_lines)
+                seconds = time.monotonic() - start
+                label = '{0}, {1}'.format(cipher or 'default cipher',
+                    ' '.join(flags) or 'no compression')
+                if res != 0:
+                    self._out.warn('Tuning with {0} failed: {1}\n'.format(label,
+                        e.strip()))
+                    return None
+                self._out.info('Tuning with {0}: {1:.1f} MB/s\n'.format(label,
+                    size / seconds / 1e6))
+                return size / seconds
+
+            try:
+                with self._metrics.timer('tune'):
+                    if copy(None, []) is None:
+                        raise BackupError('Could not copy the sample to: '
+                            '{0}'.format(self._location()))
+                    ciphers = ssh_ciphers(self._ssh_bin) or [None]
+                    speeds = {c: copy(c, []) for c in ciphers}
+                    cipher = pick_fastest(ciphers, speeds)
+                    compressions = collections.OrderedDict(
+                        rsync_compressions(self._rsync_bin))
+                    # No compression was measured with every cipher already
+                    results = {'none': speeds.get(cipher)}
+                    for label, flags in list(compressions.items())[1:]:
+                        results[label] = copy(cipher, flags)
+                    compression = pick_fastest(compressions, results)
+            finally:
+                self._transport.run('rm -rf {0}'.format(shlex.quote(tmp)))
+        if compression is None:
+            raise BackupError('Could not copy the sample to: {0}'.format(
+                self._location()))
+        self._tuning = save_tuning(self._tune_file, self._ssh_target(), cipher,
+            compression, compressions[compression], results[compression],
+            {'ciphers': {str(c): s for c, s in speeds.items()},
+            'compressions': results})
+        self._out.info('Tuned {0}: {1}, {2} compression ({3:.1f} MB/s)\n'.format(
+            self._ssh_target(), cipher or 'default cipher', compression,
+            results[compression] / 1e6))
+        return self._tuning
+
+    ## Tunes the host if it has no tuning or its tuning is stale
+    #
+    # A failed tuning is only a warning, the backup goes on with what there is.
+    def _autotune_host(self):
+        if self._tune_file is None or self._transport_name != 'ssh':
+            return
+        tuning = self._host_tuning()
+        if tuning is not None and not tuning.get('stale'):
+            return
+        try:
+            self.tune()
+        except BackupError as e:
+            self._out.warn('Could not tune {0}: {1}\n'.format(
+                self._ssh_target(), e.msg))
+
+    ## Marks the host's tuning stale if a transfer was much slower than it
+    #  \param stats rsync counters of the transfer
+    #  \param seconds How long the transfer took
+    #
+    # Only transfers of at least as much new data as the tuning sample are
+    # measured, smaller ones are dominated by building the file list.
+    def _check_drift(self, stats, seconds):
+        tuning = self._host_tuning()
+        literal = stats.get('literal_bytes', 0)
+        if (tuning is None or tuning.get('stale') or seconds <= 0 or
+                literal < self._tune_sample << 20):
+            return
+        throughput = literal / seconds
+        if not drifted(tuning, throughput):
+            return
+        mark_stale(self._tune_file, self._ssh_target(), throughput)
+        tuning['stale'] = True
+        self._out.warn('Transfer to {0} ran at {1:.1f} MB/s instead of {2:.1f} '
+            'MB/s, {3}\n'.format(self._ssh_target(), throughput / 1e6,
+            tuning['throughput'] / 1e6, 'it will be tuned again' if
+            self._autotune else 'it should be tuned again (create_backup '
+            '--tune)'))
+
+    ## Check host and destination and list backups in one round trip
+    #  \returns List of backups in the destination directory (sorted), or with
+    #  `destinations` a dictionary mapping each destination to its list
+    #
+    # Runs a single remote script that does the work of `check_host()`,
+    # `check_dest()` and `list_dest_backups()`: it makes sure the destination
+    # directory exists (creating it unless this is a dry run), checks that it is
+    # writable and lists its contents. The script replies with `key=value`
+    # lines, a `--` separator and then the directory listing. The resulting list
+    # of backups is cached and kept up to date by `create_backup()` and
+    # `remove_backups()`, so a normal run never lists the destination again.
+    # With a `catalog` the listing is skipped altogether (and the backups are
+    # taken from the catalog) if the destination's generation marker matches
+    # the catalog's.
+    def preflight(self):
+        if self._destinations:
+            return self._fan_out(lambda r: r.preflight())
+        known = generations = None
+        if self._catalog is not None:
+            known = self._catalog.generation(self._catalog_key())
+            generations = (known,
+                None if self._dry_run else uuid.uuid4().hex)
+        # With a session this is also when the ssh connection is established
+        with self._metrics.timer('preflight'):
+            status, listing, e = self._transport.probe(self._dest,
+                not self._dry_run, self._latest_link(), generations,
+                self._capacity_prune)
+        if 'exists' not in status:
+            raise HostError('Unable to reach host: {}: {}'.format(self._host, e))
+        self._free = free_space(status)
+
+        o = 'Destination directory: {0} does not exist {1}\n'
+        if status['exists'] != '1':
+            if self._dry_run:
+                self._out.info(o.format(self._dest, '(DRY-RUN)'))
+                self._backups_cache = []
+                self._staging = []
+                return []
+            self._out.info(o.format(self._dest, 'attempting to create'))
+            if status.get('created') != '1':
+                raise DestDirError('Cannot create destination directory: {}'.format(e))
+            self._out.info('Destination directory created successfully\n')
+        if status.get('writable') != '1':
+            raise DestDirError('Destination directory is not writable')
+
+        self._latest = status.get('latest') or None
+        if status.get('listed') == '0':
+            self._out.debug('Destination unchanged (generation {0}), using the '
+                'catalog\n'.format(known))
+            self._backups_cache = self._catalog.snapshots(self._catalog_key())
+            self._staging = self._catalog.snapshots(self._catalog_key(),
+                'inprogress')
+            return list(self._backups_cache)
+        self._backups_cache = self._filter_backups(listing)
+        self._staging = self._filter_staging(listing)
+        if self._catalog is not None:
+            self._catalog.reconcile(self._catalog_key(), self._backups_cache,
+                self._backup_timestamp, status.get('generation') or None,
+                self._staging)
+        return list(self._backups_cache)
+
+    ## Key of the destination in the catalog
+    def _catalog_key(self):
+        return (self._host or '', self._dest, self._prefix)
+
+    ## Records a change made to the destination
+    #  \param added List of backups that were created
+    #  \param removed List of backups that were removed
+    #  \param latest Backup the `latest` link should point to (None leaves it
+    #  alone)
+    #
+    # Writes a new generation marker into the destination (so other runs know
+    # their catalogs need to be reconciled), points the `latest` link at
+    # `latest` and brings this run's catalog, if any, up to date with the
+    # change. Both the marker and the link are replaced atomically (written
+    # under a temporary name and renamed into place), so readers never see
+    # them missing or half written.
+    def _commit(self, added=(), removed=(), latest=None):
+        g = uuid.uuid4().hex
+        with self._metrics.timer('commit'):
+            e = self._transport.commit(self._dest, g, self._latest_link(),
+                latest)
+        if e is not None:
+            self._out.warn('Unable to update generation marker or latest link: '
+                '{0}\n'.format(e))
+            g = None
+        elif latest is not None:
+            self._latest = latest
+        if self._catalog is not None:
+            key = self._catalog_key()
+            for name in added:
+                self._catalog.add(key, name, self._backup_timestamp(name))
+            self._catalog.remove(key, removed)
+            self._catalog.set_generation(key, g)
+
+    ## The `backup_manager` for each one of `destinations`
+    #
+    # Each one is built from this object's current settings (every
+    # constructor parameter, read through the property of the same name)
+    # overridden by the destination's own settings. All of the transfers run
+    # on this host, so the replicas share this object's throttle.
+    def _replicas(self):
+        if self._replica_list is None:
+            self._replica_list = []
+            params = list(inspect.signature(backup_manager).parameters)
+            for d in self._destinations:
+                settings = {p: getattr(self, p) for p in params}
+                settings.update(destinations=None, throttle=False)
+                settings.update(d)
+                r = backup_manager(**settings)
+                r._throttle = self._throttle
+                self._replica_list.append(r)
+        return self._replica_list
+
+    ## Human readable location of the destination directory (`[user@]host:dest`)
+    def _location(self):
+        return self._transport.location(self._dest)
+
+    ## Runs an operation on every destination concurrently
+    #  \param fn Function called with the `backup_manager` of each destination
+    #  \returns Dictionary mapping each destination's location to `fn`'s result
+    #
+    # Waits for the operation to finish everywhere, so one slow or failing
+    # destination doesn't hold up or cancel the others. The outcome for each
+    # destination is reported as soon as it is known and if any of them failed
+    # a `BackupError` listing the failures is raised at the end.
+    def _fan_out(self, fn):
+        replicas = self._replicas()
+        results = {}
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(len(replicas)) as pool:
+            futures = {pool.submit(fn, r): r for r in replicas}
+            for f in concurrent.futures.as_completed(futures):
+                loc = futures[f]._location()
+                try:
+                    results[loc] = f.result()
+                except Error as e:
+                    failed.append('{0}: {1}'.format(loc, e.msg))
+                    self._out.error('Destination: {0} failed: {1}\n'.format(
+                        loc, e.msg))
+                    continue
+                self._out.debug('Destination: {0} done\n'.format(loc))
+        if failed:
+            raise BackupError('{0}/{1} destination(s) failed: {2}'.format(
+                len(failed), len(replicas), '; '.join(failed)))
+        return results
+
     ## Test connection to host
     #  \returns True if the test command is successful, False otherwise
     #
-    # Performs a test ssh command to make sure we can reach host
+    # Performs a test ssh command to make sure we can reach host (see
+    # `preflight()` to check host and destination with a single command)
     def check_host(self):
-        res, _, _ = self._run_cmd(self._ssh_cmd() + ['exit 0'])
-        return (res == 0)
+        return self._transport.reachable()
 
     ## Check if the destination directory exists
     #
@@ -385,19 +1910,17 @@ class backup_manager:
     def check_dest(self):
         # Existence
         o = 'Destination directory: {0} does not exist {1}\n'
-        res, _ , _ = self._run_cmd(self._ssh_cmd() + ['test -d {}'.format(self._dest)])
-        if res != 0:
+        if not self._transport.is_dir(self._dest):
             if self._dry_run:
                 self._out.info(o.format(self._dest, '(DRY-RUN)'))
                 return
             self._out.info(o.format(self._dest, 'attempting to create'))
-            res, _ , e = self._run_cmd(self._ssh_cmd() + ['mkdir', '-p', self._dest])
-            if res != 0:
+            e = self._transport.makedirs([self._dest])
+            if e is not None:
                 raise DestDirError('Cannot create destination directory: {}'.format(e))
             self._out.info('Destination directory created successfully\n')
         # Writability
-        res, _, _ = self._run_cmd(self._ssh_cmd() + ['test -w {}'.format(self._dest)])
-        if res != 0:
+        if not self._transport.is_writable(self._dest):
             raise DestDirError('Destination directory is not writable')
         return
 
@@ -405,16 +1928,44 @@ class backup_manager:
     #  \returns List of backups in the destination directory (sorted)
     #
     # Lists the files in the destination directory and then passes them through
-    # a regex to isolate only backups, then sorts that list.
+    # a regex to isolate only backups, then sorts that list. This always asks
+    # the remote machine and refreshes the cached list of backups.
     def list_dest_backups(self):
-        res, o, e = self._run_cmd(self._ssh_cmd() + ['ls {0}'.format(self._dest)])
-        if res != 0:
+        with self._metrics.timer('listing'):
+            names, e = self._transport.listdir(self._dest)
+        if names is None:
             raise DestDirError("'{}' does not exist".format(self._dest))
-        regex = self._prefix + '\d{2}-\d{2}-\d{4}-\d{2}:\d{2}:\d{2}'
-        e = re.compile(regex)
-        backups = [f for f in o.split() if e.search(f)]
+        self._backups_cache = self._filter_backups(names)
+        self._staging = self._filter_staging(names)
+        return list(self._backups_cache)
+
+    ## Isolate backups in a list of file names
+    #  \param names List of file names in the destination directory
+    #  \returns List of backups in `names` (sorted)
+    def _filter_backups(self, names):
+        backups = [f for f in names if self._parse_backup_name(f) is not None]
         return self._sort_backup_names(backups)
 
+    ## Isolate interrupted backups in a list of file names
+    #  \param names List of file names in the destination directory
+    #  \returns List of the names of the backups being transferred into the
+    #  staging directories in `names` (sorted)
+    def _filter_staging(self, names):
+        staged = [f[len(staging_prefix):] for f in names
+            if f.startswith(staging_prefix)]
+        return self._filter_backups(staged)
+
+    ## Backups in the destination directory
+    #  \returns List of backups in the destination directory (sorted)
+    #
+    # Returns a copy of the cached list of backups, only listing the destination
+    # directory if it hasn't been listed yet (by `preflight()` or
+    # `list_dest_backups()`).
+    def _dest_backups(self):
+        if self._backups_cache is None:
+            return self.list_dest_backups()
+        return list(self._backups_cache)
+
     ## Find the most recent backup in the list of backups
     #  \returns The name of the most recent backup (string)
     #
@@ -428,80 +1979,967 @@ class backup_manager:
             return backups[-1]
 
     ## Create a new backup
+    #  \param name Name for the backup (generated from prefix and timestamp by
+    #  default)
+    #  \returns Dictionary mapping each source to None (success) or its error
     #
     #  Create a new backup based on the values of all of the attributes. This
     #  includes generating a backup name, ensuring that the backup doesn't
-    #  aleady exist, and then setting up and executing the actual rsync command
-    #  to create the backup.
-    def create_backup(self):
+    #  aleady exist, and then setting up and executing the actual rsync
+    #  command(s) to create the backup. When there are several sources they are
+    #  transferred concurrently (see `workers`) into the same backup, each in a
+    #  subdirectory named after it, and share the same link-dest. If any of them
+    #  fails an `RsyncError` listing the failed sources is raised once all of
+    #  the transfers are done. The backup is transferred into a staging
+    #  directory (see `staging_prefix`) that is only renamed to `name` once
+    #  every transfer succeeded, and an interrupted backup is resumed by the
+    #  next one. With `destinations` the backup is created on all
+    #  of them concurrently (with the same name) and a dictionary mapping each
+    #  destination to its per-source results is returned.
+    def create_backup(self, name=None):
         # Get a name for the backup
-        name = self._generate_backup_name()
+        if name is None:
+            name = self._generate_backup_name()
+        if self._destinations:
+            # The sources are only walked once for all of the destinations
+            fp = self._source_fingerprint()
+            taken = self._take_journals()
+            for r in self._replicas():
+                r._fingerprint = fp
+                r._journals_taken = taken
+            return self._fan_out(lambda r: r.create_backup(name))
         self._out.info('Attempting to creating backup: {0}\n'.format(name))
 
         # Check to make sure the backup doesn't already exist
-        backups = self.list_dest_backups()
+        backups = self._dest_backups()
         if name in backups:
             raise BackupError('Backup: {0} already exists'.format(name))
 
+        # Each source is stored in a subdirectory named after it
+        sources = self._sources()
+        subdirs = [self._source_subdir(x) for x in sources]
+        if len(set(subdirs)) != len(subdirs):
+            raise BackupError('Source directories must have different names: '
+                '{0}'.format(' '.join(sources)))
+
+        # Link-dest, the backup the `latest` link points to (or failing that
+        # the most recent one in the list from above, to avoid extra ssh)
+        link = self._latest
+        if link not in backups:
+            link = self.most_recent_backup(backups)
+        if link is not None:
+            lp = os.path.join(self._dest, link)
+            self._out.info('Most recent backup (link-dest): {0}\n'.format(lp))
+        else:
+            self._out.info('No backups were found, creating initial backup\n')
+
+        # Changes to the sources since link-dest (from their journals)
+        self._journal_plan = self._plan_journals(sources, link)
+
+        # Nothing to transfer if the sources haven't changed since link-dest
+        fp = self._source_fingerprint()
+        if fp is not None and link is not None:
+            s = self._catalog.snapshot(self._catalog_key(), link)
+            if s is not None and s['fingerprint'] == fp:
+                self._keep_unchanged(link, name, s)
+                return {x: None for x in sources}
+
+        # Split the sources into units of work, either whole sources or shards
+        # of them
+        units = self._transfer_units(sources)
+
+        # Transfer into a staging directory, resuming an interrupted backup.
+        # Concurrent rsyncs would race to create it (and the directories of
+        # sharded sources)
+        self._resumed = False
+        if not self._dry_run:
+            self._stage_backup(name, set(self._source_subdir(u[0])
+                for u in units if u[3] is not None))
+
+        # Make room for the backup if dest is nearly full
+        if self._capacity_prune and not self._dry_run:
+            with self._metrics.timer('prune'):
+                self._make_room(sources, name, link)
+
+        # Pick the cipher and compression for the host if they need to be
+        if self._autotune and not self._dry_run:
+            self._autotune_host()
+
+        # Older backups to look for unchanged files in
+        self._link_extra = self._link_candidates(self._dest_backups(), link)
+        if self._link_extra:
+            self._out.info('Extra link-dest backup(s): {0}\n'.format(
+                ' '.join(self._link_extra)))
+
+        start = time.monotonic()
+        started = time.time()
+        self._transferred = {}
+        self._linked = {}
+        with self._metrics.timer('transfer'):
+            results = self._transfer(sources, units, name, link)
+        failed = [x for x in sources if results[x] is not None]
+        if len(sources) == 1 and failed:
+            raise RsyncError(results[failed[0]])
+        if failed:
+            raise RsyncError('{0}/{1} source(s) failed: {2}'.format(
+                len(failed), len(sources), '; '.join(
+                    '{0}: {1}'.format(x, results[x].strip()) for x in failed)))
+        if not self._dry_run:
+            if self._linked:
+                with self._metrics.timer('link_stats'):
+                    self._link_savings(name, link)
+            if self._verify is not None:
+                with self._metrics.timer('verify'):
+                    self._verify_backup(name, started)
+            _, errors = self._transport.rename(self._dest,
+                {staging_prefix + name: name}, self._delete_batch)
+            if errors:
+                raise BackupError('Unable to move backup: {0} into place: '
+                    '{1}'.format(name, '; '.join(errors)))
+            self._backups_cache.append(name)
+            self._sort_backup_names(self._backups_cache)
+            self._commit(added=[name], latest=name)
+            stats = self._metrics.rsync(name)
+            if self._catalog is not None and stats:
+                self._catalog.update(self._catalog_key(), name,
+                    stats.get('total_bytes'), stats.get('files'))
+            if fp is not None:
+                self._catalog.set_fingerprint(self._catalog_key(), name, fp)
+            self._finish_journals(name)
+            self._check_drift(stats, time.monotonic() - start)
+            if self._space_index:
+                self._update_space_index(add={name: (stats.get('new_inodes',
+                    0), stats.get('new_bytes', 0))})
+            self._out.info('Backup: {} created successfully\n'.format(name))
+        return results
+
+    ## Fingerprint of the sources (None if `unchanged` isn't used)
+    #
+    # Computed before the transfer, so changes made during it make the next
+    # backup transfer again. Settings that change what rsync copies are part of
+    # the fingerprint. A fingerprint handed over by the `backup_manager` this
+    # one is a replica of is used (once) instead of walking the sources again.
+    def _source_fingerprint(self):
+        fp, self._fingerprint = self._fingerprint, None
+        if fp is not None or self._unchanged is None:
+            return fp
+        if self._catalog is None:
+            self._out.warn('Skipping unchanged sources needs a catalog\n')
+            return None
+        extra = [self._rsync_flags, str(self._log_excludes)]
+        if self._exclude is not None:
+            try:
+                with open(self._exclude, errors='replace') as f:
+                    extra.append(f.read())
+            except OSError:
+                return None
+        with self._metrics.timer('fingerprint'):
+            fp = source_fingerprint(self._sources(), extra, self._workers)
+        if fp is None:
+            self._out.warn('Unable to fingerprint the sources\n')
+        return fp
+
+    ## Keeps a backup of unchanged sources instead of creating a new one
+    #  \param link The most recent backup (made from the same sources)
+    #  \param name Name for the new backup
+    #  \param s Information recorded about `link` in the catalog
+    def _keep_unchanged(self, link, name, s):
+        self._out.info('Sources unchanged since backup: {0}\n'.format(link))
+        if self._unchanged == 'reuse':
+            self._out.info('Keeping backup: {0}{1}\n'.format(link,
+                ' (DRY-RUN)' if self._dry_run else ''))
+            if self._latest != link and not self._dry_run:
+                self._commit(latest=link)
+            self._finish_journals(link)
+            return
+        if self._dry_run:
+            self._out.info('Would have renamed backup: {0} to {1} '
+                '(DRY-RUN)\n'.format(link, name))
+            return
+        renamed, errors = self._transport.rename(self._dest, {link: name},
+            self._delete_batch)
+        if not renamed:
+            raise BackupError('Unable to rename backup: {0}: {1}'.format(link,
+                '; '.join(errors)))
+        self._backups_cache.remove(link)
+        self._backups_cache.append(name)
+        self._sort_backup_names(self._backups_cache)
+        self._commit(added=[name], removed=[link], latest=name)
+        if self._space_index:
+            self._update_space_index(renames={link: name})
+        self._catalog.update(self._catalog_key(), name, s['size'], s['files'])
+        self._catalog.set_fingerprint(self._catalog_key(), name,
+            s['fingerprint'])
+        self._finish_journals(name)
+        self._out.info('Backup: {0} renamed to {1}\n'.format(link, name))
+
+    ## Takes the changes recorded in the sources' journals
+    #  \returns Dictionary mapping each source to the epoch of its journal and
+    #  the changes taken from it (empty if `journal` isn't used)
+    #
+    # A journal is taken once for all of the destinations (by the
+    # `backup_manager` they are replicas of), and not emptied in dry runs.
+    def _take_journals(self):
+        if self._journal is None:
+            return {}
+        return {x: change_journal(self._journal, x).take(not self._dry_run)
+            for x in self._sources()}
+
+    ## Decides which sources are transferred from their journals
+    #  \param sources List of source directories
+    #  \param link Name of the backup to use as link-dest (or None)
+    #  \returns Dictionary mapping each source with a journal to a tuple of the
+    #  journal, its epoch, the changes since `link` (None to walk the whole
+    #  source) and the number of backups made from the journal since the last
+    #  full walk
+    #
+    # The last backup recorded in every journal is forgotten until the new
+    # backup has been created, so the source is walked whole if it isn't.
+    def _plan_journals(self, sources, link):
+        taken, self._journals_taken = self._journals_taken, None
+        if taken is None:
+            taken = self._take_journals()
+        plan = {}
+        for x, (epoch, changes) in taken.items():
+            j = change_journal(self._journal, x)
+            last = j.last(self._location())
+            runs = last[2] + 1 if last is not None else 0
+            reason = None
+            if epoch is None:
+                reason = 'no watcher is running'
+            elif link is None or last is None or last[:2] != (epoch, link):
+                reason = 'changes since {0} are unknown'.format(link)
+            elif self._journal_full_every and runs > self._journal_full_every:
+                reason = 'periodic full walk'
+            elif len(changes) > self._journal_max:
+                reason = '{0} changes'.format(len(changes))
+            elif self._source_subdir(x) == '' and len(sources) > 1:
+                reason = 'the source has no directory of its own'
+            if reason is None:
+                self._out.info('Source: {0}: transferring {1} change(s) from '
+                    'its journal\n'.format(x, len(changes)))
+                plan[x] = (j, epoch, changes, runs)
+            else:
+                self._out.info('Source: {0}: walking the whole source ({1})'
+                    '\n'.format(x, reason))
+                plan[x] = (j, epoch, None, 0)
+            if not self._dry_run:
+                j.set_last(self._location(), None)
+        return plan
+
+    ## Records backup `name` as the last one made from the sources' journals
+    def _finish_journals(self, name):
+        if self._dry_run:
+            return
+        for j, epoch, changes, runs in self._journal_plan.values():
+            j.set_last(self._location(), epoch, name, runs)
+
+    ## Changes to `src` since link-dest (None if it is walked whole)
+    def _journal_changes(self, src):
+        return self._journal_plan.get(src, (None, None, None, 0))[2]
+
+    ## List of source directories
+    def _sources(self):
+        if isinstance(self._src, str):
+            return [self._src]
+        return list(self._src)
+
+    ## Name of the subdirectory of a backup that `src` is stored in
+    #
+    # Follows rsync's rules: a source with a trailing slash has its contents
+    # copied into the backup itself.
+    def _source_subdir(self, src):
+        if src.endswith('/'):
+            return ''
+        return os.path.basename(os.path.normpath(src))
+
+    ## Creates the directory for backup `name` (and `subdirs` in it) remotely
+    def _make_backup_dirs(self, name, subdirs=()):
+        paths = [os.path.join(self._staging_path(name), x)
+            for x in [''] + list(subdirs)]
+        e = self._transport.makedirs(paths)
+        if e is not None:
+            raise DestDirError('Cannot create backup directory: {}'.format(e))
+
+    ## Splits sources into units of work
+    #  \param sources List of source directories
+    #  \returns List of `(source, shard index, shard count, entries)` tuples
+    #
+    # Each unit is transferred by its own rsync process. Unless `shards` is
+    # greater than 1 every source is a single unit (with `entries` None),
+    # otherwise each source directory is split into balanced shards of its
+    # top-level entries.
+    def _transfer_units(self, sources):
+        units = []
+        for x in sources:
+            shards = []
+            if (self._shards > 1 and os.path.isdir(x) and
+                    self._journal_changes(x) is None):
+                shards = shard_source(x, self._shards, self._shard_weight,
+                    self._workers)
+            if len(shards) < 2:
+                units.append((x, 0, 1, None))
+                continue
+            self._out.info('Source: {0} split into {1} shards\n'.format(x,
+                len(shards)))
+            units.extend((x, i, len(shards), tuple(s))
+                for i, s in enumerate(shards))
+        return units
+
+    ## Human readable name of a unit of work
+    def _unit_label(self, unit):
+        if unit[3] is None:
+            return unit[0]
+        return '{0} (shard {1}/{2})'.format(unit[0], unit[1] + 1, unit[2])
+
+    ## Transfers all sources into backup `name`
+    #  \param sources List of source directories
+    #  \param units List of units of work to transfer (see `_transfer_units()`)
+    #  \param name Name of the backup to transfer into
+    #  \param link Name of the backup to use as link-dest (or None)
+    #  \returns Dictionary mapping each source to None (success) or its error
+    #
+    # Runs up to `workers` rsync processes at a time. Units that fail are
+    # retried (on their own) up to `shard_retries` times. A sharded source only
+    # succeeds once every one of its shards has, and then its top directory is
+    # transferred once more so its metadata matches the source.
+    def _transfer(self, sources, units, name, link):
+        errors = {}
+        pending = units
+        for attempt in range(self._shard_retries + 1):
+            if attempt > 0:
+                self._out.info('Retrying {0} failed transfer(s)\n'.format(
+                    len(pending)))
+            errors.update(self._run_units(pending, name, link))
+            pending = [u for u in pending if errors[u] is not None]
+            if not pending:
+                break
+
+        results = {}
+        for x in sources:
+            failed = [u for u in units if u[0] == x and errors[u] is not None]
+            results[x] = ''.join(errors[u] for u in failed) if failed else None
+            sharded = any(u[0] == x and u[3] is not None for u in units)
+            if results[x] is None and sharded and not self._dry_run:
+                results[x] = self._rsync_top_dir(x, name)
+            if results[x] is None:
+                self._out.info('Source: {0} transferred\n'.format(x))
+            else:
+                self._out.error('Source: {0} failed: {1}\n'.format(x,
+                    results[x]))
+        return results
+
+    ## Runs the rsync processes for a list of units of work
+    #  \returns Dictionary mapping each unit to None (success) or its error
+    def _run_units(self, units, name, link):
+        if len(units) == 1:
+            return {units[0]: self._rsync_source(units[0], name, link)}
+        errors = {}
+        workers = min(self._workers, len(units))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(self._rsync_source, u, name, link): u
+                for u in units}
+            for f in concurrent.futures.as_completed(futures):
+                u = futures[f]
+                errors[u] = f.result()
+                if errors[u] is not None:
+                    self._out.debug('Transfer of {0} failed\n'.format(
+                        self._unit_label(u)))
+        return errors
+
+    ## Transfers a single unit of work into backup `name`
+    #  \param unit Unit of work (see `_transfer_units()`)
+    #  \param name Name of the backup to transfer into
+    #  \param link Name of the backup to use as link-dest (or None)
+    #  \returns None on success, rsync's (trailing) error output otherwise
+    #
+    # A shard is transferred with `--files-from` relative to the directory
+    # containing its source, so its files end up in the same place (and match
+    # the same exclude patterns and link-dest files) as when the source is
+    # transferred whole.
+    def _rsync_source(self, unit, name, link):
+        src, _, _, entries = unit
+
         # Build the rsync command for the backup
         rsync_backup = self._rsync_cmd()
 
+        # A resumed backup may hold files that have since been deleted from
+        # (or excluded from) the source. A source without a directory of its
+        # own is transferred into the backup itself, where the other sources'
+        # directories must be protected from the deletion (ahead of the
+        # excludes, which would otherwise match in them first)
+        if self._resumed:
+            rsync_backup.append('--delete')
+            if self._exclude is not None:
+                rsync_backup.append('--delete-excluded')
+            if self._source_subdir(src) == '':
+                rsync_backup.extend('--filter=P /{0}/'.format(x)
+                    for x in map(self._source_subdir, self._sources()) if x)
+
         # Exclude
         if self._exclude is not None:
             rsync_backup.append('--exclude-from={0}'.format(self._exclude))
 
-        # Link-dest (feed in list of backups from above to avoid extra ssh)
-        link = self.most_recent_backup(backups)
+        # Link-dest, the most recent backup first (rsync links to the first
+        # one with an identical file)
         if link is not None:
-            lp = os.path.join(self._dest, link)
-            self._out.info('Most recent backup (link-dest): {0}\n'.format(lp))
-            rsync_backup.append('--link-dest={0}'.format(lp))
-        else:
-            self._out.info('No backups were found, creating initial backup\n')
+            rsync_backup.extend('--link-dest={0}'.format(os.path.join(
+                self._dest, x)) for x in [link] + self._link_extra)
 
-        # Source and destination
-        rsync_backup.append(self._src)
-        if self._user is not None:
-            rsync_backup.append('{0}@{1}:{2}'.format(self._user, self._host,
-                os.path.join(self._dest, name)))
+        # Keep partially transferred files for an interrupted backup to resume
+        # (rsync refuses a partial directory when updating files in place)
+        if not self._in_place():
+            rsync_backup.append('--partial-dir={0}'.format(partial_dir))
+
+        target = self._transport.rsync_target(self._staging_path(name))
+
+        # Only the changes recorded in the source's journal (if possible)
+        changes = self._journal_changes(src) if entries is None else None
+        if changes is not None and self._clone_backup(src, name, link, changes):
+            return self._rsync_changes(rsync_backup, src, target, name, changes)
+
+        # Execute the rsync command (its file list can be huge, keep only the
+        # end of its output for error reporting)
+        on_line = self._transfer_watcher(src, name)
+        if entries is None:
+            res, o, e = self._run_cmd(rsync_backup + [src, target],
+                tail=self._tail_lines, throttled=True, on_line=on_line)
         else:
-            rsync_backup.append('{0}:{1}'.format(self._host,
-                os.path.join(self._dest, name)))
+            sub = self._source_subdir(src)
+            parent = src if sub == '' else os.path.dirname(os.path.normpath(src))
+            with tempfile.NamedTemporaryFile(prefix='backup-shard-') as f:
+                f.write(b''.join(os.fsencode(os.path.join(sub, x)) + b'\0'
+                    for x in entries))
+                f.flush()
+                res, o, e = self._run_cmd(rsync_backup + ['-r', '--from0',
+                    '--files-from={0}'.format(f.name), parent or '.',
+                    target + '/'], tail=self._tail_lines, throttled=True,
+                    on_line=on_line)
+        if res != 0:
+            return e
+        self._metrics.add_rsync(name, parse_rsync_stats(o))
+        return None
+
+    ## Function following what rsync transfers from `src` into backup `name`
+    #  \returns The function, to be called with every line of rsync's output
+    #  (None if none of `verify`, `space_index` and `link_dest_stats` is used)
+    #
+    # Collects the transferred files (for `verify`) and the files linked to a
+    # link-dest (for `link_dest_stats`), and counts the entries rsync created
+    # as the backup's `new_inodes` and `new_bytes` (for `space_index`). rsync
+    # names the files relative to the backup directory, and relative to the
+    # directory containing `src` (or `src` itself if its contents are
+    # transferred) on this end.
+    def _transfer_watcher(self, src, name):
+        watch_links = self._link_dest_stats and self._link_extra
+        if ((self._verify is None and not self._space_index and
+                not watch_links) or self._dry_run):
+            return None
+        sub = self._source_subdir(src)
+        parent = src if sub == '' else os.path.dirname(os.path.normpath(src))
+        def watch(line):
+            if self._space_index:
+                size = created_size(line)
+                if size is not None:
+                    self._metrics.add_rsync(name, {'new_inodes': 1,
+                        'new_bytes': size})
+            if self._verify is not None:
+                rel = transferred_file(line)
+                if rel is not None:
+                    self._transferred[rel] = os.path.join(parent, rel)
+            if watch_links:
+                linked = linked_file(line)
+                if linked is not None:
+                    self._linked[linked[0]] = linked[1]
+        return watch
 
-        # Execute the rsync command
-        res, o, e = self._run_cmd(rsync_backup)
+    ## Backups used as link-dest after the most recent one
+    #  \param backups List of backups in dest (sorted)
+    #  \param link Name of the most recent backup used as link-dest (or None)
+    #  \returns List of the names of the backups, the most recent first
+    #
+    # The `link_dests` most recent backups, followed (with `link_dest_tiers`)
+    # by the oldest backup of each retention bucket, newest first, up to
+    # `max_link_dests` in all.
+    def _link_candidates(self, backups, link):
+        if link is None:
+            return []
+        extra = [b for b in reversed(backups) if b != link]
+        extra = extra[:self._link_dests - 1]
+        if self._link_dest_tiers:
+            tiers = self._retention_policy().bucket_oldest([(b,
+                self._backup_timestamp(b)) for b in backups])
+            extra.extend(b for b in reversed(tiers)
+                if b != link and b not in extra)
+        return extra[:max_link_dests - 1]
+
+    ## Counts the bytes each extra link-dest saved backup `name`
+    #  \param name Name of the backup
+    #  \param link Name of the most recent backup used as link-dest
+    #
+    # The files rsync linked are compared with the same files in each
+    # link-dest in turn. Those only found in an extra one would otherwise have
+    # been transferred (and stored) again, and are added to the backup's
+    # `link_dest_saved_bytes` and `link_dest_N_saved_bytes` (N being the
+    # link-dest's position, the most recent being 1) counters.
+    def _link_savings(self, name, link):
+        linked, self._linked = self._linked, {}
+        candidates = [link] + self._link_extra
+        found, errors = self._transport.link_sources(self._staging_path(name),
+            [os.path.join(self._dest, x) for x in candidates], list(linked))
+        for e in errors:
+            self._out.debug('Checking links failed: {0}\n'.format(e))
+        saved = [0] * len(candidates)
+        files = [0] * len(candidates)
+        for p, i in found.items():
+            saved[i] += linked[p]
+            files[i] += 1
+        stats = {'link_dest_saved_bytes': sum(saved[1:])}
+        for i in range(1, len(candidates)):
+            stats['link_dest_{0}_saved_bytes'.format(i + 1)] = saved[i]
+            self._out.info('Link-dest: {0} saved {1} byte(s) in {2} '
+                'file(s)\n'.format(candidates[i], saved[i], files[i]))
+        self._metrics.add_rsync(name, stats)
+
+    ## Compares the files transferred into backup `name` with their sources
+    #  \param name Name of the backup
+    #  \param started Time the transfer started (seconds since the epoch)
+    #
+    # The files to verify (see `verify`) are hashed on both ends at once, each
+    # end hashing `workers` files at a time. Source files modified since the
+    # transfer started (or removed) can't be compared and are skipped. Raises
+    # a `BackupError` naming the files that differ.
+    def _verify_backup(self, name, started):
+        files = self._transferred
+        self._transferred = {}
+        rels = pick_files(files, self._verify, self._verify_sample)
+        if not rels:
+            self._out.info('No transferred files to verify\n')
+            return
+        self._out.info('Verifying {0} of {1} transferred file(s)\n'.format(
+            len(rels), len(files)))
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            local = pool.submit(source_digests, [files[r] for r in rels],
+                self._verify_cache, self._workers)
+            remote = pool.submit(self._transport.hash_files,
+                self._staging_path(name), rels, self._workers)
+            local = local.result()
+            remote, errors = remote.result()
+        for e in errors:
+            self._out.debug('Hashing failed: {0}\n'.format(e))
+        skipped = 0
+        bad = []
+        for r in rels:
+            digest, st = local[files[r]]
+            if digest is None or st.st_mtime >= started:
+                skipped += 1
+            elif remote.get(r) != digest:
+                bad.append(r)
+        if bad:
+            raise BackupError('Backup: {0} failed verification, {1} of {2} '
+                'file(s) differ: {3}{4}'.format(name, len(bad), len(rels),
+                ', '.join(bad[:10]), ', ...' if len(bad) > 10 else ''))
+        self._out.info('Backup: {0} verified, {1} file(s) match{2}\n'.format(
+            name, len(rels) - skipped, '' if not skipped else ' ({0} changed '
+            'during the backup)'.format(skipped)))
+
+    ## Copies `src` from backup `link` into backup `name` with hard links
+    #  \param changes Changes to `src` since `link` (see `change_journal`)
+    #  \returns False if the copy failed (`src` is then walked whole)
+    #
+    # Paths that changed (other than directories whose own metadata changed)
+    # are removed from the copy, so rsync transfers them anew using link-dest
+    # instead of changing the files the copy shares with `link` in place.
+    def _clone_backup(self, src, name, link, changes):
+        if self._dry_run:
+            return True
+        sub = self._source_subdir(src)
+        e = self._transport.clone(os.path.join(self._dest, link, sub),
+            os.path.normpath(os.path.join(self._staging_path(name), sub)),
+            [os.fsdecode(p) for p, k in changes.items() if k != 'a'])
+        if e is None:
+            return True
+        self._out.warn('Unable to copy {0} from backup {1}, walking the whole '
+            'source: {2}\n'.format(src, link, e))
+        j, epoch, _, _ = self._journal_plan[src]
+        self._journal_plan[src] = (j, epoch, None, 0)
+        return False
+
+    ## Transfers the changes to `src` recorded in its journal
+    #  \param cmd rsync command (with the exclude and link-dest options)
+    #  \param changes Changes to `src` since link-dest (see `change_journal`)
+    #  \returns None on success, rsync's (trailing) error output otherwise
+    #
+    # Like a shard, the changed paths are given with `--files-from` relative to
+    # the directory containing `src`. Changed directory trees are transferred
+    # recursively, everything else on its own. Paths removed since the journal
+    # was taken are ignored.
+    def _rsync_changes(self, cmd, src, target, name, changes):
+        sub = self._source_subdir(src)
+        parent = src if sub == '' else os.path.dirname(os.path.normpath(src))
+        for opts, ks in ((['--no-recursive', '-d'], 'af'), (['-r'], 'd')):
+            paths = sorted(p for p, k in changes.items() if k in ks)
+            if not paths:
+                continue
+            with tempfile.NamedTemporaryFile(prefix='backup-journal-') as f:
+                f.write(b''.join(os.path.join(os.fsencode(sub), p) + b'\0'
+                    for p in paths))
+                f.flush()
+                res, o, e = self._run_cmd(cmd + opts + ['--from0',
+                    '--ignore-missing-args', '--files-from={0}'.format(f.name),
+                    parent or '.', target + '/'], tail=self._tail_lines,
+                    throttled=True, on_line=self._transfer_watcher(src, name))
+            if res != 0:
+                return e
+            self._metrics.add_rsync(name, parse_rsync_stats(o))
+        return None
+
+    ## Transfers only the top directory of `src` into backup `name`
+    #  \returns None on success, rsync's error output otherwise
+    def _rsync_top_dir(self, src, name):
+        res, o, e = self._run_cmd(self._rsync_cmd() + ['--no-recursive', '-d',
+            src, self._transport.rsync_target(self._staging_path(name))],
+            throttled=True)
         if res != 0:
-            raise RsyncError(e)
-        else:
-            if not self._dry_run:
-                self._out.info('Backup: {} created successfully\n'.format(name))
+            return e
+        self._metrics.add_rsync(name, parse_rsync_stats(o))
+        return None
 
     ## Removes old backups
-    #  \returns The number of backups removed
+    #  \returns The number of backups removed, or with `destinations` a
+    #  dictionary mapping each destination to the number removed there
     #
     # Removes the oldest backups if the number of exisiting backups is greater
-    # than the number specified to keep
+    # than the number specified to keep, or with any of the `keep_*` members
+    # set, the backups the resulting retention policy doesn't keep. With
+    # `async_prune` the backups are only renamed into the trash directory
+    # (which makes them disappear from the destination immediately) and the
+    # slow part, unlinking them, is left to a low priority background process
+    # on the remote machine. Otherwise they are deleted by up to
+    # `delete_workers` concurrent remote commands (see `backup_deleter`).
     def remove_backups(self):
+        if self._destinations:
+            return self._fan_out(lambda r: r.remove_backups())
         self._out.info('Attempting to remove old backups\n')
-        backups = self.list_dest_backups()
-        if len(backups) <= self._backups:
-            self._out.info('{0}/{1} backups exist, no removal necessary.\n'.format(
-                len(backups), self._backups))
+        backups = self._dest_backups()
+        policy = self._retention_policy()
+        keep, to_remove = policy.plan([(b, self._backup_timestamp(b))
+            for b in backups])
+        if not to_remove:
+            if policy.uses_buckets():
+                self._out.info('{0} backups exist, all kept by the retention '
+                    'policy, no removal necessary.\n'.format(len(backups)))
+            else:
+                self._out.info('{0}/{1} backups exist, no removal '
+                    'necessary.\n'.format(len(backups), self._backups))
             return 0
-        backups.reverse()
-        to_remove = backups[self._backups:]
         if self._dry_run:
             self._out.info('Would have removed backup(s): {0} '
                 '(DRY-RUN)\n'.format(' '.join(to_remove)))
             return 0
         self._out.info('Removing backup(s): {0}\n'.format(' '.join(to_remove)))
-        res, _, e = self._run_cmd(self._ssh_cmd() +
-                ['rm -r {0}'.format(
-                    ' '.join([os.path.join(self._dest,x) for x in to_remove])
-                    )
-                ]
-            )
-        if res != 0:
-            self._out.error('Unable to remove backup(s): {0}\n'.format(e))
-        self._out.info('Successfully removed {0} backup(s)\n'.format(len(to_remove)))
+        paths = [os.path.join(self._dest, x) for x in to_remove]
+        with self._metrics.timer('prune'):
+            if self._async_prune:
+                errors = self._transport.move_to_trash(paths,
+                    self._trash_dir(), self._delete_batch)
+            else:
+                inodes, size, errors = self._transport.deleter(self._out,
+                    self._delete_workers, self._delete_batch).delete(paths)
+        if errors:
+            self._out.error('Unable to remove backup(s): {0}\n'.format(
+                '; '.join(errors)))
+            # Some of them may be gone, list again when they are needed next
+            self._backups_cache = None
+            self._commit()
+            if self._catalog is not None:
+                self._catalog.set_generation(self._catalog_key(), None)
+            return len(to_remove)
+        self._backups_cache = [b for b in self._backups_cache
+            if b not in to_remove]
+        self._commit(removed=to_remove)
+        if self._space_index:
+            self._update_space_index()
+        if self._async_prune:
+            self._out.info('Moved {0} backup(s) to the trash, deleting them in '
+                'the background\n'.format(len(to_remove)))
+        else:
+            self._out.info('Successfully removed {0} backup(s), freed {1} '
+                'inode(s) and {2} byte(s)\n'.format(len(to_remove), inodes, size))
         return len(to_remove)
+
+    ## Updates the space index in dest
+    #  \param add Dictionary mapping new backups to the inodes and bytes they
+    #  introduced
+    #  \param renames Dictionary mapping renamed backups to their new names
+    #
+    # A new backup is appended to the index. Otherwise the index is rewritten
+    # with the renames applied and the backups that no longer exist (as far as
+    # the cached listing knows) left out. Failures are only warnings, the index
+    # is just missing the backup then.
+    def _update_space_index(self, add=None, renames=None):
+        path = os.path.join(self._dest, index_name)
+        if add is not None:
+            e = self._transport.append_text(path, format_index(add))
+        else:
+            text, e = self._transport.read_text(path)
+            if text is not None:
+                index = collections.OrderedDict(((renames or {}).get(n, n), v)
+                    for n, v in parse_index(text).items())
+                if self._backups_cache is not None:
+                    index = collections.OrderedDict((n, v)
+                        for n, v in index.items() if n in self._backups_cache)
+                e = self._transport.write_text(path, format_index(index))
+        if e is not None:
+            self._out.warn('Unable to update the space index: {0}\n'.format(e))
+
+    ## Space taken by each backup in dest
+    #  \returns List of tuples of each backup's name, the inodes and bytes it
+    #  introduced (None if the space index doesn't have it) and the bytes
+    #  introduced by it and every older backup (see `space_report()`), oldest
+    #  first. With `destinations` a dictionary mapping each destination to its
+    #  list.
+    #
+    # Read from the space index (see `space_index`), so it takes one remote
+    # command whatever the size of the backups. Bytes introduced by a backup
+    # that has since been removed and are still linked by newer backups aren't
+    # counted.
+    def space_report(self):
+        if self._destinations:
+            return self._fan_out(lambda r: r.space_report())
+        backups = self._dest_backups()
+        text, e = self._transport.read_text(os.path.join(self._dest,
+            index_name))
+        if text is None:
+            raise BackupError('Unable to read the space index: {0}'.format(e))
+        return space_report(parse_index(text), backups)
+
+    ## Estimates the inodes and bytes a backup will take
+    #  \param sources List of sources
+    #  \param name Name of the backup
+    #  \param link Name of the backup to use as link-dest (or None)
+    #  \returns Tuple of the inodes and bytes
+    #
+    # Taken from the most recent backups in the space index (see
+    # `space_index`) if there are any, otherwise from `rsync -n --stats` of
+    # every source against link-dest.
+    def _estimate_backup(self, sources, name, link):
+        if self._space_index:
+            text, _ = self._transport.read_text(os.path.join(self._dest,
+                index_name))
+            estimate = estimate_from_index(parse_index(text or ''),
+                self._backups_cache)
+            if estimate is not None:
+                return estimate
+        inodes = size = 0
+        target = self._transport.rsync_target(self._staging_path(name))
+        for src in sources:
+            cmd = self._rsync_cmd() + ['-n']
+            if self._exclude is not None:
+                cmd.append('--exclude-from={0}'.format(self._exclude))
+            if link is not None:
+                cmd.append('--link-dest={0}'.format(os.path.join(self._dest,
+                    link)))
+            res, o, e = self._run_cmd(cmd + [src, target],
+                tail=self._tail_lines)
+            if res != 0:
+                raise RsyncError('Unable to estimate the size of the backup: '
+                    '{0}'.format(e))
+            i, s = estimate_from_stats(o)
+            inodes += i
+            size += s
+        return inodes, size
+
+    ## Deletes the oldest backups until a new backup fits in dest
+    #  \param sources List of sources
+    #  \param name Name of the new backup
+    #  \param link Name of the backup to use as link-dest (or None)
+    #
+    # The backups are deleted one at a time (without the trash, so the space
+    # is free right away) and what each one freed is added to the free space
+    # reported by `preflight()`. The link-dest and the `min_backups` most
+    # recent backups are never deleted. If the backup still won't fit a
+    # warning is printed and the transfer goes ahead anyway.
+    def _make_room(self, sources, name, link):
+        if self._free is None:
+            self._out.warn('Free space of {0} is unknown, not pruning for '
+                'capacity\n'.format(self._location()))
+            return
+        avail, ifree = self._free
+        inodes, size = self._estimate_backup(sources, name, link)
+        need, need_inodes = size + self._min_free, inodes + self._min_free_inodes
+        self._out.info('Backup needs about {0} byte(s) and {1} inode(s), {2} '
+            'byte(s) and {3} inode(s) available\n'.format(need, need_inodes,
+            avail, 'unlimited' if ifree is None else ifree))
+        fits = lambda: avail >= need and (ifree is None or ifree >= need_inodes)
+        backups = self._backups_cache
+        candidates = [b for b in backups[:max(0, len(backups) -
+            self._min_backups)] if b != link]
+        deleter = self._transport.deleter(self._out, self._delete_workers,
+            self._delete_batch)
+        removed = []
+        for b in candidates:
+            if fits():
+                break
+            self._out.info('Removing backup: {0} to make room\n'.format(b))
+            i, s, errors = deleter.delete([os.path.join(self._dest, b)])
+            if errors:
+                self._out.error('Unable to remove backup: {0}: {1}\n'.format(b,
+                    '; '.join(errors)))
+                break
+            removed.append(b)
+            avail += s
+            if ifree is not None:
+                ifree += i
+        if removed:
+            self._backups_cache = [b for b in backups if b not in removed]
+            self._commit(removed=removed)
+            if self._space_index:
+                self._update_space_index()
+            self._out.info('Removed {0} backup(s) to make room\n'.format(
+                len(removed)))
+        self._free = (avail, ifree)
+        if not fits():
+            self._out.warn('The backup may not fit in {0}, {1} byte(s) and {2} '
+                'inode(s) are needed\n'.format(self._location(), need,
+                need_inodes))
+
+    ## Whether `rsync_flags` make rsync update files in place
+    def _in_place(self):
+        return bool(set(self._rsync_flags.split()) & {'--inplace', '--append',
+            '--append-verify'})
+
+    ## Staging directory a backup is transferred into (see `staging_prefix`)
+    #  \param name Name of the backup
+    def _staging_path(self, name):
+        return os.path.join(self._dest, staging_prefix + name)
+
+    ## Prepares the staging directory of a new backup
+    #  \param name Name of the backup
+    #  \param subdirs Subdirectories to create in it
+    #
+    # The most recent interrupted backup (if any) is renamed to the staging
+    # directory of `name`, so rsync only transfers what it hadn't yet (and
+    # picks up the files it kept in `partial_dir`), and older ones are
+    # deleted. Otherwise the staging directory is created. When `rsync_flags`
+    # make rsync update files in place all interrupted backups are deleted
+    # instead, as their files are hard-linked to older backups that rsync
+    # would overwrite. The backup is
+    # recorded as in progress in the catalog, so the next run finds it even if
+    # it doesn't list dest.
+    def _stage_backup(self, name, subdirs=()):
+        staged = list(self._staging)
+        resume = staged.pop() if staged and not self._in_place() else None
+        if staged:
+            self._out.info('Removing {0} older interrupted backup(s)\n'.format(
+                len(staged)))
+            _, _, errors = self._transport.deleter(self._out,
+                self._delete_workers, self._delete_batch).delete(
+                [self._staging_path(x) for x in staged])
+            for e in errors:
+                self._out.warn('Unable to remove interrupted backup: '
+                    '{0}\n'.format(e))
+        if resume is not None and resume != name:
+            renamed, errors = self._transport.rename(self._dest,
+                {staging_prefix + resume: staging_prefix + name},
+                self._delete_batch)
+            if not renamed:
+                self._out.warn('Unable to resume interrupted backup: {0}: '
+                    '{1}\n'.format(resume, '; '.join(errors)))
+                resume = None
+        if resume is not None:
+            self._out.info('Resuming interrupted backup: {0}\n'.format(resume))
+        self._resumed = resume is not None
+        if resume is None or subdirs:
+            self._make_backup_dirs(name, subdirs)
+        if self._catalog is not None:
+            key = self._catalog_key()
+            self._catalog.remove(key, self._staging)
+            self._catalog.add(key, name, self._backup_timestamp(name),
+                'inprogress')
+        self._staging = []
+
+    ## Directory (in dest) that pruned backups are moved to before deletion
+    #
+    # Its name starts with a dot so it is never listed as a backup.
+    def _trash_dir(self):
+        return os.path.join(self._dest, '.trash')
+
+    ## Renames backups named in a legacy format to the current `name_format`
+    #  \returns Number of backups renamed (with `destinations` a dictionary
+    #  mapping each destination to its number)
+    #
+    # Backups named by older versions (see `legacy_name_formats`) are still
+    # recognised, this is the one-time migration that renames them so every
+    # name sorts lexicographically. The renames are done in batches of at most
+    # `delete_batch` backups per remote command and never overwrite anything,
+    # then the `latest` link is pointed at the most recent backup.
+    def migrate_names(self):
+        if self._destinations:
+            return self._fan_out(lambda r: r.migrate_names())
+        backups = self._dest_backups()
+        renames = collections.OrderedDict()
+        for b in backups:
+            new = '{0}{1}'.format(self._prefix,
+                self._backup_timestamp(b).strftime(self._name_format))
+            if new != b:
+                renames[b] = new
+        if not renames:
+            self._out.info('All backup names are up to date\n')
+            return 0
+        if self._dry_run:
+            self._out.info('Would have renamed {0} backup(s) (DRY-RUN)\n'.format(
+                len(renames)))
+            return 0
+        self._out.info('Renaming {0} backup(s)\n'.format(len(renames)))
+        renamed, errors = self._transport.rename(self._dest, renames,
+            self._delete_batch)
+        for e in errors:
+            self._out.error('Unable to rename backup(s): {0}\n'.format(e))
+        self._backups_cache = self._sort_backup_names([renames[x]
+            if x in renamed else x for x in backups])
+        self._commit(added=[renames[x] for x in renamed], removed=renamed,
+            latest=self.most_recent_backup(self._backups_cache))
+        if self._space_index and renamed:
+            self._update_space_index(renames={x: renames[x] for x in renamed})
+        self._out.info('Renamed {0}/{1} backup(s)\n'.format(len(renamed),
+            len(renames)))
+        return len(renamed)
+
+    ## Builds the report of this run
+    #  \param success Whether the run succeeded
+    #  \returns Dictionary with the job's name, when the run started and
+    #  finished, whether it succeeded and, for each destination, the time spent
+    #  in each phase and the rsync counters of each backup created
+    #
+    # The phases are `preflight` (which includes establishing the ssh
+    # connection, checking the destination and listing it), `listing`,
+    # `transfer`, `commit` and `prune`.
+    def run_report(self, success=True):
+        managers = self._replicas() if self._destinations else [self]
+        destinations = []
+        for m in managers:
+            d = m._metrics.report()
+            d['destination'] = m._location()
+            destinations.append(d)
+        return {'job': self._job or ','.join(m._location() for m in managers),
+            'started': self._metrics.started, 'finished': time.time(),
+            'success': bool(success), 'destinations': destinations}
+
+    ## Writes the run report to `report_json` and `report_prom` (if set)
+    #  \param success Whether the run succeeded
+    def write_reports(self, success=True):
+        if self._report_json is None and self._report_prom is None:
+            return
+        report = self.run_report(success)
+        for path, write in ((self._report_json, write_json),
+                (self._report_prom, write_prometheus)):
+            if path is None:
+                continue
+            try:
+                write(path, report)
+            except OSError as e:
+                self._out.error('Unable to write run report: {0}: {1}\n'.format(
+                    path, e))
+                continue
+            self._out.debug('Run report written to: {0}\n'.format(path))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupMetrics
+#
+# A module that provides the `run_metrics` class, which collects the timings
+# and transfer statistics of a run, and functions to export them as a JSON
+# report or in Prometheus' text format
+
+import collections
+import contextlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+## Counters parsed from `rsync --stats` and the regex each one is read with
+#
+# Both the wording of rsync >= 3.1 and of older versions is understood.
+rsync_counters = collections.OrderedDict([
+    ('files', r'Number of files: ([\d,]+)'),
+    ('files_transferred', r'Number of (?:regular )?files transferred: ([\d,]+)'),
+    ('total_bytes', r'Total file size: ([\d,]+)'),
+    ('transferred_bytes', r'Total transferred file size: ([\d,]+)'),
+    ('literal_bytes', r'Literal data: ([\d,]+)'),
+    ('matched_bytes', r'Matched data: ([\d,]+)'),
+    ('file_list_bytes', r'File list size: ([\d,]+)'),
+    ('file_list_generation_seconds',
+        r'File list generation time: ([\d,.]+)'),
+    ('file_list_transfer_seconds', r'File list transfer time: ([\d,.]+)'),
+    ('sent_bytes', r'Total bytes sent: ([\d,]+)'),
+    ('received_bytes', r'Total bytes received: ([\d,]+)'),
+])
+
+## Parses the output of `rsync --stats`
+#  \param text rsync's output (or the end of it)
+#  \returns Dictionary of the counters in `rsync_counters` that were found
+def parse_rsync_stats(text):
+    stats = {}
+    for k, regex in rsync_counters.items():
+        m = re.search(regex, text)
+        if m is not None:
+            v = m.group(1).replace(',', '')
+            stats[k] = float(v) if k.endswith('_seconds') else int(v)
+    return stats
+
+## Adds derived figures to a set of rsync counters
+#  \param stats Dictionary of counters (as returned by `parse_rsync_stats()`)
+#  \returns Copy of `stats` with `speedup` (total size over bytes sent and
+#  received) and `matched_ratio` (share of the changed data rsync found in the
+#  link-dest) added when they can be computed
+def derive_rsync_stats(stats):
+    r = dict(stats)
+    wire = r.get('sent_bytes', 0) + r.get('received_bytes', 0)
+    if 'total_bytes' in r and wire:
+        r['speedup'] = r['total_bytes'] / wire
+    data = r.get('literal_bytes', 0) + r.get('matched_bytes', 0)
+    if data:
+        r['matched_ratio'] = r.get('matched_bytes', 0) / data
+    return r
+
+## \class backup.BackupMetrics.run_metrics
+#  Timings and transfer statistics of a run
+#
+# Collects how long each phase of a run took (phases that happen more than once
+# or concurrently add up) and the rsync counters of each backup created. It can
+# be updated from several threads at once.
+class run_metrics:
+
+    ## Creates an empty `run_metrics` object
+    def __init__(self):
+        ## time the run started (seconds since the epoch)
+        self.started = time.time()
+        ## seconds spent in each phase
+        self.phases = collections.OrderedDict()
+        ## summed rsync counters of each backup created
+        self.backups = collections.OrderedDict()
+        ## protects `phases` and `backups`
+        self._lock = threading.Lock()
+
+    ## Times a phase of the run
+    #  \param phase Name of the phase
+    #
+    # A context manager that adds the time spent in its body to `phase`.
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.monotonic() - start)
+
+    ## Adds to the time spent in a phase
+    #  \param phase Name of the phase
+    #  \param seconds Time to add
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    ## Adds the counters of one rsync to a backup's
+    #  \param backup Name of the backup
+    #  \param stats Dictionary of counters (as returned by `parse_rsync_stats()`)
+    def add_rsync(self, backup, stats):
+        with self._lock:
+            totals = self.backups.setdefault(backup, {})
+            for k, v in stats.items():
+                totals[k] = totals.get(k, 0) + v
+
+    ## Summed rsync counters of a backup (empty if it wasn't created)
+    def rsync(self, backup):
+        with self._lock:
+            return dict(self.backups.get(backup, {}))
+
+    ## Builds a report of everything collected
+    #  \returns Dictionary with the `phases` and (derived) rsync counters of
+    #  each of the `backups`
+    def report(self):
+        with self._lock:
+            return {'phases': dict(self.phases),
+                'backups': {b: derive_rsync_stats(s)
+                    for b, s in self.backups.items()}}
+
+## Writes a file atomically
+#
+# The text is written to a temporary file in the same directory which is then
+# renamed over `path`, so readers (like Prometheus' textfile collector) never
+# see a partial file.
+def _write_atomic(path, text):
+    path = os.path.expanduser(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+        prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+## Writes a run report as JSON
+#  \param path Path of the file to write
+#  \param report Run report (see `backup_manager.run_report()`)
+def write_json(path, report):
+    _write_atomic(path, json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+## Escapes a Prometheus label value
+def _label(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+## Formats a run report in Prometheus' text exposition format
+#  \param report Run report (see `backup_manager.run_report()`)
+#  \returns The metrics (string)
+#
+# The rsync counters of every destination are summed over the backups created
+# there during the run.
+def prometheus_text(report):
+    metrics = collections.OrderedDict()
+    def add(name, help, labels, value):
+        metrics.setdefault(name, (help, []))[1].append('{0}{{{1}}} {2}'.format(
+            name, ','.join('{0}="{1}"'.format(k, _label(v))
+            for k, v in labels), repr(float(value))))
+    job = [('job', report['job'])]
+    add('backup_last_run_timestamp_seconds', 'Time the last run finished', job,
+        report['finished'])
+    add('backup_last_run_success', 'Whether the last run succeeded', job,
+        1 if report['success'] else 0)
+    add('backup_last_run_duration_seconds', 'Duration of the last run', job,
+        report['finished'] - report['started'])
+    for d in report['destinations']:
+        labels = job + [('destination', d['destination'])]
+        for p, v in sorted(d['phases'].items()):
+            add('backup_phase_seconds', 'Time spent in each phase of the last '
+                'run', labels + [('phase', p)], v)
+        totals = {}
+        for s in d['backups'].values():
+            for k in rsync_counters:
+                if k in s:
+                    totals[k] = totals.get(k, 0) + s[k]
+        for k, v in derive_rsync_stats(totals).items():
+            add('backup_rsync_{0}'.format(k), 'rsync --stats {0} of the last '
+                'run'.format(k.replace('_', ' ')), labels, v)
+    lines = []
+    for name, (help, samples) in metrics.items():
+        lines.extend(['# HELP {0} {1}'.format(name, help),
+            '# TYPE {0} gauge'.format(name)] + samples)
+    return '\n'.join(lines) + '\n'
+
+## Writes a run report for Prometheus' textfile collector
+#  \param path Path of the file to write (should end in `.prom`)
+#  \param report Run report (see `backup_manager.run_report()`)
+def write_prometheus(path, report):
+    _write_atomic(path, prometheus_text(report))
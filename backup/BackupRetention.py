@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupRetention
+#
+# A module that provides the `retention_policy` class to decide which backups
+# to keep and which to remove
+
+## Names of the retention buckets (in addition to the most recent backups) and
+#  the functions that map a timestamp to its period in each bucket
+buckets = (
+    ('hourly', lambda t: (t.year, t.month, t.day, t.hour)),
+    ('daily', lambda t: (t.year, t.month, t.day)),
+    ('weekly', lambda t: t.isocalendar()[:2]),
+    ('monthly', lambda t: (t.year, t.month)),
+    ('yearly', lambda t: t.year),
+)
+
+## \class backup.BackupRetention.retention_policy
+#  A grandfather-father-son retention policy
+#
+# Keeps the `last` most recent backups plus, for each of the hourly, daily,
+# weekly, monthly and yearly buckets, the most recent backup of each of the
+# given number of most recent periods (hours, days, ...) that have a backup. A
+# backup is kept if any bucket keeps it. With only `last` set this is the
+# classic "keep the newest N backups" policy.
+class retention_policy:
+
+    ## Creates a `retention_policy` object
+    #  \param last Number of most recent backups to keep
+    #  \param hourly Number of hours to keep a backup for
+    #  \param daily Number of days to keep a backup for
+    #  \param weekly Number of (ISO) weeks to keep a backup for
+    #  \param monthly Number of months to keep a backup for
+    #  \param yearly Number of years to keep a backup for
+    def __init__(self, last=1, hourly=0, daily=0, weekly=0, monthly=0,
+            yearly=0):
+        ## number of most recent backups to keep
+        self.last = last
+        ## number of periods to keep for each bucket
+        self.periods = {'hourly': hourly, 'daily': daily, 'weekly': weekly,
+            'monthly': monthly, 'yearly': yearly}
+
+    ## Whether any of the hourly, daily, ... buckets is used
+    def uses_buckets(self):
+        return any(self.periods.values())
+
+    ## Splits backups into the ones to keep and the ones to remove
+    #  \param backups List of `(name, timestamp)` pairs sorted oldest first
+    #  \returns List of the names of the backups to keep (oldest first)
+    #  \returns List of the names of the backups to remove (newest first)
+    #
+    # Makes a single pass over the backups from newest to oldest, so together
+    # with sorting them this is O(n log n).
+    def plan(self, backups):
+        keep = []
+        remove = []
+        for i, (b, kept_by) in enumerate(self._walk(backups)):
+            if i < self.last or kept_by:
+                keep.append(b)
+            else:
+                remove.append(b)
+        keep.reverse()
+        return keep, remove
+
+    ## Oldest backup each of the hourly, daily, ... buckets keeps
+    #  \param backups List of `(name, timestamp)` pairs sorted oldest first
+    #  \returns List of the names of the backups (oldest first, each once)
+    def bucket_oldest(self, backups):
+        oldest = {}
+        for b, kept_by in self._walk(backups):
+            oldest.update((name, b) for name in kept_by)
+        names = set(oldest.values())
+        return [b for b, _ in backups if b in names]
+
+    ## Walks the backups through the hourly, daily, ... buckets
+    #  \param backups List of `(name, timestamp)` pairs sorted oldest first
+    #  \returns Generator of `(name, buckets)` pairs, newest backup first,
+    #  `buckets` being the list of the names of the buckets that keep it
+    #
+    # Each bucket keeps the most recent backup of each of its most recent
+    # periods, until it has kept as many as its number of periods.
+    def _walk(self, backups):
+        used = [(name, period, self.periods[name]) for name, period in buckets
+            if self.periods[name] > 0]
+        last_period = {name: None for name, _, _ in used}
+        count = {name: 0 for name, _, _ in used}
+        for b, t in reversed(backups):
+            kept_by = []
+            for name, period, n in used:
+                p = period(t)
+                if p != last_period[name] and count[name] < n:
+                    last_period[name] = p
+                    count[name] += 1
+                    kept_by.append(name)
+            yield b, kept_by
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupScheduler
+#
+# A module that provides the `backup_scheduler` class, which runs backup jobs on
+# their own schedules from a long-running process, and the functions to control
+# one over its Unix socket
+
+import json
+import os
+import re
+import socket
+import socketserver
+import threading
+import time
+
+## Seconds in each unit a duration can be given in
+_units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+## Parses a duration
+#  \param s Duration, a number optionally followed by a unit (s, m, h, d or w),
+#  e.g. '90', '15m' or '1.5h' (or a number of seconds)
+#  \returns Number of seconds (raises ValueError if `s` isn't a duration)
+def parse_duration(s):
+    if isinstance(s, (int, float)):
+        return float(s)
+    m = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([smhdw]?)\s*', s.lower())
+    if m is None:
+        raise ValueError('invalid duration: {0}'.format(s))
+    return float(m.group(1)) * _units[m.group(2)]
+
+## \class backup.BackupScheduler.scheduled_job
+#  A backup job and the state of its schedule
+class scheduled_job:
+
+    ## Creates a `scheduled_job` object
+    #  \param name Name of the job
+    #  \param settings Settings of the job (passed to the scheduler's `run`)
+    #  \param interval Seconds between runs
+    #  \param retries Number of times a failed run is retried before waiting
+    #  for the next scheduled run
+    #  \param retry_delay Seconds before the first retry (doubled for every
+    #  further one)
+    def __init__(self, name, settings, interval, retries=3, retry_delay=60):
+        ## name of the job
+        self.name = name
+        ## settings of the job
+        self.settings = settings
+        ## seconds between runs
+        self.interval = interval
+        ## number of times a failed run is retried
+        self.retries = retries
+        ## seconds before the first retry
+        self.retry_delay = retry_delay
+        ## time the next run is due (seconds since the epoch)
+        self.next_run = 0.0
+        ## time the next scheduled (as opposed to retried or triggered) run is
+        #  due
+        self.slot = 0.0
+        ## number of failed attempts since the last success
+        self.failures = 0
+        ## whether the job is running
+        self.running = False
+        ## time the last run started (None if it never ran)
+        self.last_start = None
+        ## time the last run finished (None if it never finished)
+        self.last_finish = None
+        ## whether the last run succeeded (None if it never finished)
+        self.last_success = None
+        ## error of the last run (None if it succeeded)
+        self.last_error = None
+
+    ## Destinations the job writes to (`host:dest` strings)
+    def destinations(self):
+        dests = self.settings.get('destinations') or [self.settings]
+        return set('{0}:{1}'.format(d.get('host', self.settings.get('host')),
+            d.get('dest', self.settings.get('dest'))) for d in dests)
+
+    ## State of the job as a dictionary (see `backup_scheduler.status()`)
+    def status(self):
+        return {'name': self.name, 'interval': self.interval,
+            'running': self.running, 'next_run': self.next_run,
+            'failures': self.failures, 'last_start': self.last_start,
+            'last_finish': self.last_finish, 'last_success': self.last_success,
+            'last_error': self.last_error}
+
+## \class backup.BackupScheduler.backup_scheduler
+#  Runs backup jobs on their own schedules
+#
+# Every job runs every `interval` seconds, in a thread of its own. A job that
+# missed runs (i.e. while the scheduler wasn't running) runs once right away.
+# Runs triggered by hand don't move the schedule. At most `max_jobs` jobs run
+# at a time, and at most `max_per_destination` of them write to the same
+# destination. A job that is due waits until both allow it to start. A failed
+# run is retried with exponential backoff (up to `max_retry_delay` seconds
+# apart) before the job waits for its next scheduled run.
+#
+# If `state_file` is given the times of every job's runs are kept in it (as
+# JSON) so a restarted scheduler resumes the schedules instead of running every
+# job at once. A job without a recorded run is due immediately.
+class backup_scheduler:
+
+    ## Creates a `backup_scheduler` object
+    #  \param jobs List of `scheduled_job` objects
+    #  \param run Function that runs a job (called with the `scheduled_job`),
+    #  raises an exception if the run fails
+    #  \param printer `backup_printer` object to use for output
+    #  \param max_jobs Maximum number of jobs running at a time
+    #  \param max_per_destination Maximum number of jobs writing to the same
+    #  destination at a time
+    #  \param max_retry_delay Maximum number of seconds between retries
+    #  \param state_file Path of the file the state of the jobs is kept in
+    #  (None to not keep it)
+    #  \param clock Function returning the current time (seconds since the
+    #  epoch)
+    def __init__(self, jobs, run, printer, max_jobs=2, max_per_destination=1,
+            max_retry_delay=3600, state_file=None, clock=time.time):
+        ## jobs by name
+        self.jobs = {j.name: j for j in jobs}
+        ## maximum number of jobs running at a time
+        self.max_jobs = max(1, max_jobs)
+        ## maximum number of jobs writing to the same destination at a time
+        self.max_per_destination = max(1, max_per_destination)
+        ## maximum number of seconds between retries
+        self.max_retry_delay = max_retry_delay
+        ## path of the file the state of the jobs is kept in
+        self.state_file = state_file
+        ## function that runs a job
+        self._run = run
+        ## `backup_printer` object used for output
+        self._out = printer
+        ## function returning the current time
+        self._clock = clock
+        ## protects the jobs' state, notified when it changes
+        self._cond = threading.Condition()
+        ## threads of the running jobs by name
+        self._threads = {}
+        ## set to stop starting jobs
+        self._stopping = False
+        self._load_state()
+
+    ## Restores the jobs' schedules from `state_file`
+    def _load_state(self):
+        now = self._clock()
+        state = {}
+        if self.state_file is not None:
+            try:
+                with open(self.state_file) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+        for j in self.jobs.values():
+            s = state.get(j.name, {})
+            j.last_start = s.get('last_start')
+            j.last_finish = s.get('last_finish')
+            j.last_success = s.get('last_success')
+            j.last_error = s.get('last_error')
+            j.slot = now
+            if j.last_start is not None:
+                j.slot = max(j.last_start + j.interval, now)
+            j.next_run = j.slot
+
+    ## Saves the jobs' state to `state_file`
+    def _save_state(self):
+        if self.state_file is None:
+            return
+        state = {j.name: {'last_start': j.last_start,
+            'last_finish': j.last_finish, 'last_success': j.last_success,
+            'last_error': j.last_error} for j in self.jobs.values()}
+        tmp = '{0}.{1}'.format(self.state_file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            self._out.error('Unable to save the state of the jobs: {0}\n'.format(
+                e))
+
+    ## Number of running jobs writing to each destination
+    def _busy_destinations(self):
+        busy = {}
+        for j in self.jobs.values():
+            if j.running:
+                for d in j.destinations():
+                    busy[d] = busy.get(d, 0) + 1
+        return busy
+
+    ## Starts the jobs that are due (and allowed to start)
+    #  \returns Seconds until the next job is due (None if none is waiting)
+    def run_pending(self):
+        with self._cond:
+            if self._stopping:
+                return None
+            now = self._clock()
+            running = sum(j.running for j in self.jobs.values())
+            busy = self._busy_destinations()
+            waiting = sorted((j for j in self.jobs.values() if not j.running),
+                key=lambda j: (j.next_run, j.name))
+            for j in waiting:
+                if j.next_run > now:
+                    break
+                if running >= self.max_jobs:
+                    break
+                dests = j.destinations()
+                if any(busy.get(d, 0) >= self.max_per_destination
+                        for d in dests):
+                    continue
+                running += 1
+                for d in dests:
+                    busy[d] = busy.get(d, 0) + 1
+                self._start(j, now)
+            later = [j.next_run for j in self.jobs.values()
+                if not j.running and j.next_run > now]
+            return min(later) - now if later else None
+
+    ## Starts a job in a thread of its own
+    def _start(self, j, now):
+        j.running = True
+        j.last_start = now
+        # This run takes the place of the scheduled one (if it is due)
+        if j.slot <= now:
+            j.slot += j.interval
+            if j.slot <= now:
+                j.slot = now + j.interval
+        self._out.info('Job: {0} started\n'.format(j.name))
+        t = threading.Thread(target=self._run_job, args=(j,),
+            name='job-{0}'.format(j.name))
+        self._threads[j.name] = t
+        t.start()
+
+    ## Runs a job and schedules its next run
+    def _run_job(self, j):
+        error = None
+        try:
+            self._run(j)
+        except Exception as e:
+            error = getattr(e, 'msg', None) or str(e) or type(e).__name__
+        with self._cond:
+            now = self._clock()
+            j.running = False
+            j.last_finish = now
+            j.last_success = error is None
+            j.last_error = error
+            del self._threads[j.name]
+            if error is None:
+                j.failures = 0
+                self._out.info('Job: {0} finished\n'.format(j.name))
+                j.next_run = max(j.slot, now)
+            elif j.failures < j.retries:
+                delay = min(j.retry_delay * 2 ** j.failures,
+                    self.max_retry_delay)
+                j.failures += 1
+                j.next_run = now + delay
+                self._out.error('Job: {0} failed: {1} (retry {2}/{3} in '
+                    '{4:.0f}s)\n'.format(j.name, error, j.failures, j.retries,
+                    delay))
+            else:
+                j.failures = 0
+                self._out.error('Job: {0} failed: {1} (giving up until its '
+                    'next run)\n'.format(j.name, error))
+                j.next_run = max(j.slot, now)
+            self._save_state()
+            self._cond.notify_all()
+
+    ## Makes a job due now
+    #  \param name Name of the job
+    #  \returns False if there is no such job
+    def trigger(self, name):
+        with self._cond:
+            j = self.jobs.get(name)
+            if j is None:
+                return False
+            if not j.running:
+                j.next_run = self._clock()
+            self._cond.notify_all()
+        return True
+
+    ## State of the jobs
+    #  \param name Name of a job (None for all of them)
+    #  \returns List of dictionaries describing each job (see
+    #  `scheduled_job.status()`), None if there is no such job
+    def status(self, name=None):
+        with self._cond:
+            if name is None:
+                return [self.jobs[n].status() for n in sorted(self.jobs)]
+            j = self.jobs.get(name)
+            return None if j is None else [j.status()]
+
+    ## Runs jobs until `stop()` is called, then waits for the running ones
+    def run_forever(self):
+        while True:
+            wait = self.run_pending()
+            with self._cond:
+                if self._stopping:
+                    break
+                self._cond.wait(wait)
+        for t in list(self._threads.values()):
+            t.join()
+
+    ## Stops starting jobs (running ones finish)
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    ## Serves commands on a Unix socket (in a thread of its own)
+    #  \param path Path of the socket (only accessible by its owner)
+    #  \returns The `socketserver` object (call its `shutdown()` to stop)
+    #
+    # Every connection sends one command line and gets one line of JSON back:
+    #
+    # - `status [JOB]`: `{"jobs": [...]}` (see `status()`)
+    # - `run JOB`: `{"triggered": "JOB"}`
+    #
+    # or `{"error": "..."}`.
+    def serve(self, path):
+        scheduler = self
+
+        class handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline(4096).decode(errors='replace')
+                reply = scheduler.command(line.split())
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        if os.path.exists(path):
+            os.remove(path)
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(path, handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='control',
+            daemon=True).start()
+        return server
+
+    ## Executes a command received on the socket
+    #  \param args The command split into words
+    #  \returns Reply (dictionary)
+    def command(self, args):
+        if args and args[0] == 'status' and len(args) <= 2:
+            jobs = self.status(args[1] if len(args) == 2 else None)
+            if jobs is None:
+                return {'error': 'no such job: {0}'.format(args[1])}
+            return {'jobs': jobs}
+        if args and args[0] == 'run' and len(args) == 2:
+            if not self.trigger(args[1]):
+                return {'error': 'no such job: {0}'.format(args[1])}
+            return {'triggered': args[1]}
+        return {'error': 'unknown command: {0}'.format(' '.join(args))}
+
+## Sends a command to a `backup_scheduler` over its Unix socket
+#  \param path Path of the socket
+#  \param args The command as a list of words (see `backup_scheduler.serve()`)
+#  \returns The reply (dictionary), raises OSError if the scheduler can't be
+#  reached
+def send_command(path, args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(30)
+        s.connect(path)
+        s.sendall(' '.join(args).encode() + b'\n')
+        with s.makefile('rb') as f:
+            return json.loads(f.readline().decode())
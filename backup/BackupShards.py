@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupShards
+#
+# A module that provides functions to split a source directory into balanced
+# shards, each of which can be transferred by its own `rsync` process
+
+import concurrent.futures
+import heapq
+import os
+
+## Ways of weighing the entries of a source directory
+weights = ('size', 'count')
+
+## Computes the weight of a directory entry
+#  \param path Path of the entry
+#  \param weight 'size' to weigh by bytes or 'count' to weigh by number of files
+#  \returns Weight of the entry (and everything below it), at least 1
+#
+# Walks the entry without following symbolic links. Entries that disappear or
+# can't be read during the walk are skipped.
+def entry_weight(path, weight='size'):
+    total = 0
+    stack = [path]
+    while stack:
+        p = stack.pop()
+        try:
+            st = os.lstat(p)
+        except OSError:
+            continue
+        total += st.st_size if weight == 'size' else 1
+        if not os.path.isdir(p) or os.path.islink(p):
+            continue
+        try:
+            with os.scandir(p) as it:
+                stack.extend(e.path for e in it)
+        except OSError:
+            continue
+    return max(total, 1)
+
+## Partitions weighted items into balanced groups
+#  \param items Dictionary mapping each item to its weight
+#  \param n Number of groups
+#  \returns List of (at most `n`) non-empty groups, each a sorted list of items
+#
+# Uses the greedy longest-processing-time rule: items are placed heaviest first
+# into the currently lightest group.
+def partition(items, n):
+    groups = [[] for i in range(n)]
+    loads = [(0, i) for i in range(n)]
+    for item in sorted(items, key=lambda x: (-items[x], x)):
+        load, i = heapq.heappop(loads)
+        groups[i].append(item)
+        heapq.heappush(loads, (load + items[item], i))
+    return [sorted(g) for g in groups if g]
+
+## Splits a source directory into shards
+#  \param src Source directory
+#  \param n Number of shards
+#  \param weight How to weigh entries (see `weights`)
+#  \param workers Number of entries to weigh concurrently
+#  \returns List of shards, each a sorted list of top-level entry names of `src`
+def shard_source(src, n, weight='size', workers=4):
+    with os.scandir(src) as it:
+        names = [e.name for e in it]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        w = pool.map(lambda x: entry_weight(os.path.join(src, x), weight), names)
+        return partition(dict(zip(names, w)), n)
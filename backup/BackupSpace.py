@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupSpace
+#
+# A module that provides functions to account for the space each backup takes:
+# the inodes and bytes it introduced (everything else in it is hard links to
+# older backups), kept in an index file next to the backups, and to tell how
+# much space the next backup needs
+
+from backup.BackupMetrics import parse_rsync_stats
+from backup.BackupVerify import unescape_name
+
+import collections
+import re
+import shlex
+
+## Name of the index file (in dest)
+#
+# Its name starts with a dot so it is never listed as a backup.
+index_name = '.space-index'
+
+## Line of rsync's `--out-format='%i %l %n'` output for an entry it created
+#  (a transferred or copied file, or a new directory, link or special file)
+_created_re = re.compile(r'^[<>c][fdLDS]\S* (\d+) ')
+
+## Line of rsync's `--out-format='%i %l %n'` output (with `-ii`) for a file it
+#  hard linked to one of the link-dest directories
+_linked_re = re.compile(r'^hf.{9} (\d+) (.+)$')
+
+## Multipliers of the suffixes sizes can be given with
+_size_suffixes = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+## Number of the most recent backups whose size predicts the next one's
+estimate_history = 3
+
+## Parses a size
+#  \param s Number of bytes, optionally with a K, M, G or T suffix (binary
+#  multiples)
+#  \returns The number of bytes
+#
+# Raises `ValueError` if `s` isn't a size.
+def parse_size(s):
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(s), re.I)
+    if m is None:
+        raise ValueError('Invalid size: {0}'.format(s))
+    return int(float(m.group(1)) * _size_suffixes[m.group(2).upper()])
+
+## Free space of a destination as reported by its probe
+#  \param status Dictionary of the destination's status (see
+#  `ssh_transport.probe()`)
+#  \returns Tuple of the bytes and inodes available (None if unknown, the
+#  inodes also for file systems without a fixed number of them), or None if
+#  neither is known
+def free_space(status):
+    try:
+        avail = int(status.get('avail_kb', '')) * 1024
+    except ValueError:
+        return None
+    try:
+        ifree = int(status['ifree']) if int(status.get('inodes', '')) else None
+    except (KeyError, ValueError):
+        ifree = None
+    return avail, ifree
+
+## Estimates the size of the next backup from the index
+#  \param index Dictionary as returned by `parse_index()`
+#  \param backups List of the backups in the destination (oldest first)
+#  \returns Tuple of the most inodes and bytes introduced by any one of the
+#  `estimate_history` most recent backups in the index (None if none of them
+#  is)
+def estimate_from_index(index, backups):
+    recent = [index[b] for b in backups if b in index][-estimate_history:]
+    if not recent:
+        return None
+    return max(i for i, _ in recent), max(b for _, b in recent)
+
+## Estimates the size of a backup from the output of a dry run
+#  \param text Output of `rsync -n --stats`
+#  \returns Tuple of the inodes (the regular files transferred and every
+#  directory) and bytes it would introduce
+def estimate_from_stats(text):
+    stats = parse_rsync_stats(text)
+    m = re.search(r'Number of files: [\d,]+ \(.*?dir: ([\d,]+)', text)
+    dirs = int(m.group(1).replace(',', '')) if m is not None else 0
+    return (stats.get('files_transferred', 0) + dirs,
+        stats.get('transferred_bytes', 0))
+
+## Size of the entry a line of rsync's output reports it created
+#  \param line Line of rsync's `--out-format='%i %l %n'` output
+#  \returns The entry's (apparent) size, None if the line isn't about a
+#  created entry
+#
+# Entries rsync hard links to the link-dest aren't reported at all (or with
+# `-ii`, as `hf` lines, see `linked_file()`).
+def created_size(line):
+    m = _created_re.match(line)
+    return int(m.group(1)) if m is not None else None
+
+## File a line of rsync's output reports it hard linked to the link-dest
+#  \param line Line of rsync's `--out-format='%i %l %n'` output (with `-ii`)
+#  \returns Tuple of the file's path (relative to the transfer's destination)
+#  and size, None if the line isn't about a linked file
+def linked_file(line):
+    m = _linked_re.match(line)
+    if m is None:
+        return None
+    return unescape_name(m.group(2)), int(m.group(1))
+
+## Shell script that lists the inode number of every file in a directory
+#  \param root Directory to list
+#
+# Prints a line for each file (but not directory) under `root`: its inode
+# number and its path relative to `root`, separated by a space.
+def inode_script(root):
+    return 'find {0} ! -type d -printf \'%i %P\\n\''.format(shlex.quote(root))
+
+## Parses a line printed by `inode_script()`
+#  \param line Line of output
+#  \returns Tuple of the file's path and inode number, None if the line is
+#  malformed
+def inode_line(line):
+    ino, _, path = line.rstrip('\n').partition(' ')
+    if not ino.isdigit() or not path:
+        return None
+    return path, int(ino)
+
+## Parses an index
+#  \param text Content of the index
+#  \returns Ordered dictionary mapping each backup to a tuple of the number of
+#  inodes and bytes it introduced
+#
+# The index has a line per backup: its name, inodes and bytes separated by
+# tabs. Malformed lines are ignored.
+def parse_index(text):
+    index = collections.OrderedDict()
+    for line in text.split('\n'):
+        fields = line.split('\t')
+        if len(fields) != 3:
+            continue
+        try:
+            index[fields[0]] = (int(fields[1]), int(fields[2]))
+        except ValueError:
+            continue
+    return index
+
+## Formats an index
+#  \param index Dictionary as returned by `parse_index()`
+#  \returns Content of the index
+def format_index(index):
+    return ''.join('{0}\t{1}\t{2}\n'.format(n, i, b)
+        for n, (i, b) in index.items())
+
+## Builds the space report of a destination
+#  \param index Dictionary as returned by `parse_index()`
+#  \param backups List of the backups in the destination (oldest first)
+#  \returns List of tuples of each backup's name, the inodes and bytes it
+#  introduced (None if it isn't in the index) and the bytes introduced by it
+#  and every older backup
+def space_report(index, backups):
+    rows = []
+    total = 0
+    for b in backups:
+        inodes, size = index.get(b, (None, None))
+        total += size or 0
+        rows.append((b, inodes, size, total))
+    return rows
+
+## Formats a space report as a table
+#  \param rows Rows as returned by `space_report()`
+#  \returns The table
+def format_report(rows):
+    width = max([len('BACKUP')] + [len(r[0]) for r in rows])
+    lines = ['{0:<{w}}  {1:>10}  {2:>15}  {3:>15}'.format('BACKUP', 'INODES',
+        'BYTES', 'CUMULATIVE', w=width)]
+    for name, inodes, size, total in rows:
+        lines.append('{0:<{w}}  {1:>10}  {2:>15}  {3:>15}'.format(name,
+            '?' if inodes is None else inodes, '?' if size is None else size,
+            total, w=width))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupThrottle
+#
+# A module that provides the `adaptive_throttle` class, which slows local
+# processes (i.e. rsync) down while the host is busy
+
+import os
+import signal
+import threading
+import time
+
+## Device name prefixes that are never real disks
+_virtual_disks = ('loop', 'ram', 'zram')
+
+## Load average (over the last minute) per CPU
+def load_per_cpu():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+## Reads the I/O counters of the host's disks
+#  \param path Path of the kernel's disk statistics
+#  \returns Tuple of the number of completed I/Os and the milliseconds spent on
+#  them, summed over all disks (None if they can't be read)
+def disk_stats(path='/proc/diskstats'):
+    ios = ms = 0
+    try:
+        with open(path) as f:
+            for line in f:
+                x = line.split()
+                if len(x) < 11 or x[2].startswith(_virtual_disks):
+                    continue
+                ios += int(x[3]) + int(x[7])
+                ms += int(x[6]) + int(x[10])
+    except (OSError, ValueError):
+        return None
+    return ios, ms
+
+## Average latency of the I/Os completed between two `disk_stats()` samples
+#  \returns Latency in milliseconds (0 if there was no I/O or no sample)
+def disk_latency(before, after):
+    if before is None or after is None or after[0] <= before[0]:
+        return 0.0
+    return (after[1] - before[1]) / (after[0] - before[0])
+
+## \class backup.BackupThrottle.adaptive_throttle
+#  Duty cycles processes according to the host's load and disk latency
+#
+# Watched processes are alternately continued and stopped (with SIGCONT and
+# SIGSTOP) so they only run for a fraction of every `period`, their duty
+# cycle. Every period the host's load average per CPU and average disk latency
+# are sampled: if either is over its limit the duty cycle is halved (down to
+# `min_duty`), otherwise it grows by a tenth until the processes run
+# unhindered again. A background thread does this while there is anything to
+# watch.
+#
+# The signals are sent to each watched process's whole process group, so the
+# processes must be started in a session of their own (`start_new_session`)
+# and their children (i.e. the ssh rsync talks to the destination through) are
+# stopped with them. The remote end of a transfer can't be signalled from here:
+# while ssh is stopped the remote rsync only finishes the I/O for the data it
+# has already received and then waits.
+class adaptive_throttle:
+
+    ## Creates an `adaptive_throttle` object
+    #  \param max_load Load average per CPU above which processes are slowed
+    #  \param max_latency Average disk latency (ms) above which processes are
+    #  slowed
+    #  \param period Length of a duty cycle in seconds
+    #  \param min_duty Smallest fraction of a period processes run for
+    #  \param printer `backup_printer` to report changes of the duty cycle to
+    def __init__(self, max_load=1.0, max_latency=50.0, period=1.0,
+            min_duty=0.1, printer=None):
+        ## load average per CPU above which processes are slowed
+        self.max_load = max_load
+        ## average disk latency (ms) above which processes are slowed
+        self.max_latency = max_latency
+        ## length of a duty cycle in seconds
+        self.period = period
+        ## smallest fraction of a period processes run for
+        self.min_duty = min_duty
+        ## current fraction of a period processes run for
+        self.duty = 1.0
+        ## `backup_printer` for debugging output (None for no output)
+        self._out = printer
+        ## watched processes (`subprocess.Popen` objects)
+        self._procs = set()
+        ## protects `_procs` and `_thread`
+        self._lock = threading.Lock()
+        ## thread doing the duty cycling (None when nothing is watched)
+        self._thread = None
+        ## last `disk_stats()` sample
+        self._disk = None
+
+    ## Starts throttling a process
+    #  \param proc `subprocess.Popen` object of the process (the leader of its
+    #  process group)
+    def watch(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    ## Stops throttling a process (leaving it running)
+    #  \param proc `subprocess.Popen` object of the process
+    def unwatch(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+        self._signal([proc], signal.SIGCONT)
+
+    ## Checks the host and adjusts the duty cycle
+    #  \returns True if the host was found to be busy
+    def adjust(self):
+        load = load_per_cpu()
+        disk = disk_stats()
+        latency = disk_latency(self._disk, disk)
+        self._disk = disk
+        busy = load > self.max_load or latency > self.max_latency
+        old = self.duty
+        if busy:
+            self.duty = max(self.min_duty, self.duty / 2)
+        else:
+            self.duty = min(1.0, self.duty + 0.1)
+        if self._out is not None and abs(self.duty - old) > 1e-9:
+            self._out.debug('Throttle: load {0:.2f}/CPU, disk latency '
+                '{1:.1f}ms, running {2:.0%} of the time\n'.format(load,
+                latency, self.duty))
+        return busy
+
+    ## Sends a signal to the process groups of processes that are still running
+    def _signal(self, procs, sig):
+        for p in procs:
+            if p.poll() is None:
+                try:
+                    os.killpg(p.pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    ## Duty cycles the watched processes until there are none left
+    def _run(self):
+        self._disk = disk_stats()
+        while True:
+            with self._lock:
+                procs = list(self._procs)
+                if not procs:
+                    self._thread = None
+                    return
+            self.adjust()
+            run = self.period * self.duty
+            self._signal(procs, signal.SIGCONT)
+            time.sleep(run)
+            if self.duty < 1.0:
+                with self._lock:
+                    procs = list(self._procs)
+                self._signal(procs, signal.SIGSTOP)
+                time.sleep(self.period - run)
+                # Processes that stopped being watched meanwhile were continued
+                # by `unwatch()`, the others are continued at the top of the loop
+                with self._lock:
+                    done = [p for p in procs if p not in self._procs]
+                self._signal(done, signal.SIGCONT)
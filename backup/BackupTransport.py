@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupTransport
+#
+# A module that provides the transports `backup_manager` reaches its
+# destination with: `ssh_transport` for remote machines and `local_transport`
+# for directories on this machine (i.e. local disks or network file systems
+# mounted here)
+
+from backup.BackupDeleter import backup_deleter, batches, local_deleter
+from backup.BackupSpace import inode_line, inode_script
+from backup.BackupVerify import file_digest, hash_script, parse_sums
+
+import concurrent.futures
+import os
+import shlex
+import shutil
+import subprocess
+
+## Names of the transports
+transports = ('ssh', 'local')
+
+## Shell script that empties the trash directory `$t` in the background
+#
+# The deletion runs detached from the session that started it (so neither that
+# session nor the run waits for it) at the lowest CPU and, where `ionice` is
+# available, idle I/O priority. It removes everything in the trash, including
+# leftovers from earlier deletions that were interrupted.
+def purge_trash_script():
+    return ('if command -v ionice >/dev/null 2>&1; then io="ionice -c3"; '
+        'else io=; fi\n'
+        'nohup nice -n 19 $io find "$t" -mindepth 1 -maxdepth 1 '
+        '-exec rm -rf -- {} + </dev/null >/dev/null 2>&1 &')
+
+## Splits the reply of a remote probe script
+#  \param o Output of the probe script
+#  \returns Dictionary of the `key=value` lines before the `--` separator
+#  \returns List of the lines after the separator
+def parse_probe(o):
+    status = {}
+    lines = o.splitlines()
+    for i, l in enumerate(lines):
+        if l == '--':
+            return status, lines[i + 1:]
+        k, _, v = l.partition('=')
+        status[k] = v
+    return status, []
+
+## \class backup.BackupTransport.ssh_transport
+#  Reaches the destination on a remote machine over ssh
+#
+# Every operation is a shell script run with a single ssh command (built by the
+# `backup_manager`, so it uses its session if one is open) and rsync is told to
+# use the same ssh command with `-e`.
+class ssh_transport:
+
+    ## Creates an `ssh_transport` object
+    #  \param bm `backup_manager` whose ssh settings and `_run_cmd()` are used
+    def __init__(self, bm):
+        ## `backup_manager` the transport belongs to
+        self._bm = bm
+
+    ## Runs a shell script on the remote machine
+    #  \param script Shell script
+    #  \param tail Number of lines of each output to keep (None keeps all)
+    #  \param on_line Function called with every line of standard output (None
+    #  for none)
+    #  \returns Tuple of the exit status, standard output and standard error
+    def run(self, script, tail=None, on_line=None):
+        return self._bm._run_cmd(self._bm._ssh_cmd() + [script], tail,
+            on_line=on_line)
+
+    ## Whether the remote machine can be reached
+    def reachable(self):
+        return self.run('exit 0')[0] == 0
+
+    ## Whether `path` is a directory
+    def is_dir(self, path):
+        return self.run('test -d {0}'.format(shlex.quote(path)))[0] == 0
+
+    ## Whether `path` is writable
+    def is_writable(self, path):
+        return self.run('test -w {0}'.format(shlex.quote(path)))[0] == 0
+
+    ## Creates directories (and their parents)
+    #  \returns Error message (None on success)
+    def makedirs(self, paths):
+        res, _, e = self.run('mkdir -p {0}'.format(
+            ' '.join(shlex.quote(x) for x in paths)))
+        return None if res == 0 else e
+
+    ## Lists a directory
+    #  \returns List of names in the directory (None on error)
+    #  \returns Error message
+    def listdir(self, path):
+        res, o, e = self.run('ls -A {0}'.format(shlex.quote(path)))
+        return (o.split() if res == 0 else None), e
+
+    ## Checks the destination and lists it
+    #  \param dest Destination directory
+    #  \param create Create `dest` if it doesn't exist
+    #  \param link Name of the link to the most recent backup (in `dest`)
+    #  \param generations None, or a tuple of the generation the caller knows
+    #  `dest` by (None if it knows none) and a new generation to mark `dest` with
+    #  if it has no marker (None to leave it unmarked)
+    #  \param space Also report the free space of the file system of `dest`
+    #  \returns Dictionary of the destination's status: `exists`, `created`,
+    #  `writable` ('1' or '0'), `latest` (the link's target), `generation`
+    #  (with `generations`), `listed` ('0' if the destination wasn't listed
+    #  because its generation is the known one) and, with `space`, `avail_kb`,
+    #  `inodes` and `ifree` (the KiB and inodes available and the total number
+    #  of inodes, empty if unknown). It has no `exists` if the destination
+    #  couldn't be reached.
+    #  \returns List of names in the destination
+    #  \returns Error message
+    #
+    # Does all of this with a single remote command, whose reply is `key=value`
+    # lines, a `--` separator and then the directory listing.
+    def probe(self, dest, create, link, generations=None, space=False):
+        script = ['d={}'.format(shlex.quote(dest)),
+            'if [ -d "$d" ]; then echo exists=1; else echo exists=0']
+        if create:
+            script.append('if mkdir -p "$d"; then echo created=1; '
+                'else echo created=0; fi')
+        script.extend(['fi',
+            'if [ -w "$d" ]; then echo writable=1; else echo writable=0; fi',
+            'echo "latest=$(readlink "$d"/{0} 2>/dev/null)"'.format(
+            shlex.quote(link))])
+        if space:
+            script.extend(['if [ -d "$d" ]; then',
+                'set -- $(df -Pk "$d" 2>/dev/null | tail -n 1); '
+                'echo "avail_kb=$4"',
+                'set -- $(df -Pi "$d" 2>/dev/null | tail -n 1); '
+                'echo "inodes=$2"; echo "ifree=$4"', 'fi'])
+        if generations is not None:
+            known, new = generations
+            script.append('g=$(cat "$d/.generation" 2>/dev/null)')
+            if new is not None:
+                script.append('if [ -z "$g" ] && [ -w "$d" ]; then g={0}; '
+                    'echo "$g" > "$d/.generation"; fi'.format(shlex.quote(new)))
+            script.extend(['echo "generation=$g"',
+                'if [ -n "$g" ] && [ "$g" = {0} ]; then echo listed=0; echo --; '
+                'exit; fi'.format(shlex.quote(known or ''))])
+        script.extend(['echo --',
+            'if [ -d "$d" ]; then ls -1A "$d"; fi'])
+        res, o, e = self.run('\n'.join(script))
+        status, listing = parse_probe(o)
+        return status, listing, e
+
+    ## Marks the destination with a new generation (and updates the latest link)
+    #  \param dest Destination directory
+    #  \param generation New generation
+    #  \param link Name of the link to the most recent backup (in `dest`)
+    #  \param latest Backup the link should point to (None leaves it alone)
+    #  \returns Error message (None on success)
+    #
+    # Both the marker and the link are replaced atomically (written under a
+    # temporary name and renamed into place).
+    def commit(self, dest, generation, link, latest=None):
+        script = ['d={0}'.format(shlex.quote(dest)),
+            'echo {0} > "$d/.generation.$$" && '
+            'mv -f "$d/.generation.$$" "$d/.generation"'.format(
+            shlex.quote(generation))]
+        if latest is not None:
+            script.extend(['s=$?',
+                'ln -sfn {0} "$d/.latest.$$" && mv -fT "$d/.latest.$$" '
+                '"$d"/{1} || s=1'.format(shlex.quote(latest),
+                shlex.quote(link)), 'exit $s'])
+        res, _, e = self.run('\n'.join(script))
+        return None if res == 0 else e
+
+    ## Moves directories into the trash and starts emptying it in the background
+    #  \param paths List of directories to move
+    #  \param trash Trash directory
+    #  \param batch_size Maximum number of directories moved by one command
+    #  \returns List of error messages (empty on success)
+    #
+    # The directories are moved in batches so the remote command lines stay
+    # short; the background deletion is started by the last batch's command.
+    def move_to_trash(self, paths, trash, batch_size):
+        errors = []
+        work = batches(paths, batch_size)
+        for i, b in enumerate(work):
+            script = ['t={0}'.format(shlex.quote(trash)),
+                'mkdir -p "$t" && mv -- {0} "$t"/'.format(
+                ' '.join(shlex.quote(x) for x in b))]
+            if i == len(work) - 1:
+                script.extend(['s=$?', purge_trash_script(), 'exit $s'])
+            res, _, e = self.run('\n'.join(script))
+            if res != 0:
+                errors.append(e.strip())
+        return errors
+
+    ## Builds a `backup_deleter` that deletes directories on the remote machine
+    def deleter(self, printer, workers, batch_size):
+        return backup_deleter(self.run, printer, workers, batch_size)
+
+    ## Renames entries of a directory, never overwriting anything
+    #  \param dest Directory the entries are in
+    #  \param renames Dictionary mapping old names to new ones
+    #  \param batch_size Maximum number of entries renamed by one command
+    #  \returns List of the (old) names that were renamed
+    #  \returns List of error messages (empty on success)
+    def rename(self, dest, renames, batch_size):
+        renamed = []
+        errors = []
+        for b in batches(list(renames), batch_size, 32 * 1024):
+            script = ['cd {0} || exit 1'.format(shlex.quote(dest)), 's=0']
+            for old in b:
+                script.append('if [ ! -e {1} ] && mv -T -- {0} {1}; then echo '
+                    '{0}; else s=1; fi'.format(shlex.quote(old),
+                    shlex.quote(renames[old])))
+            script.append('exit $s')
+            res, o, e = self.run('\n'.join(script))
+            renamed.extend(x for x in o.splitlines() if x in renames)
+            if res != 0:
+                errors.append(e.strip() or 'names already taken')
+        return renamed, errors
+
+    ## Makes a copy of a directory out of hard links and removes paths from it
+    #  \param src Directory to copy
+    #  \param dst Path of the copy (replaced if it exists)
+    #  \param remove List of paths (relative to `dst`) to remove from the copy
+    #  \returns Error message (None on success)
+    #
+    # The paths are removed in batches so the remote command lines stay short.
+    def clone(self, src, dst, remove):
+        res, _, e = self.run('s={0}\nd={1}\nrm -rf -- "$d" && mkdir -p -- '
+            '"$(dirname -- "$d")" && cp -al -- "$s" "$d"'.format(
+            shlex.quote(src), shlex.quote(dst)))
+        if res != 0:
+            return e.strip() or 'exit status {0}'.format(res)
+        for b in batches(remove, 1024, 32 * 1024):
+            res, _, e = self.run('cd {0} && rm -rf -- {1}'.format(
+                shlex.quote(dst), ' '.join(shlex.quote(x) for x in b)))
+            if res != 0:
+                return e.strip() or 'exit status {0}'.format(res)
+        return None
+
+    ## Reads a text file
+    #  \returns Content of the file ('' if it doesn't exist, None on error)
+    #  \returns Error message
+    def read_text(self, path):
+        res, o, e = self.run('p={0}\nif [ -e "$p" ]; then cat -- "$p"; '
+            'fi'.format(shlex.quote(path)))
+        return (o if res == 0 else None), e
+
+    ## Appends to a text file (creating it if necessary)
+    #  \returns Error message (None on success)
+    def append_text(self, path, text):
+        res, _, e = self.run('printf %s {0} >> {1}'.format(shlex.quote(text),
+            shlex.quote(path)))
+        return None if res == 0 else (e.strip() or 'exit status {0}'.format(
+            res))
+
+    ## Replaces a text file atomically
+    #  \returns Error message (None on success)
+    #
+    # The text is written to a temporary file in pieces, so the remote command
+    # lines stay short, which is then renamed over `path`.
+    def write_text(self, path, text):
+        tmp = '{0}.tmp'.format(path)
+        pieces = [text[i:i + 32 * 1024] for i in range(0, len(text),
+            32 * 1024)] or ['']
+        for i, p in enumerate(pieces):
+            script = 'printf %s {0} {1} {2}'.format(shlex.quote(p),
+                '>>' if i else '>', shlex.quote(tmp))
+            if i == len(pieces) - 1:
+                script += ' && mv -f -- {0} {1}'.format(shlex.quote(tmp),
+                    shlex.quote(path))
+            res, _, e = self.run(script)
+            if res != 0:
+                return e.strip() or 'exit status {0}'.format(res)
+        return None
+
+    ## Hashes files
+    #  \param root Directory the paths are relative to
+    #  \param paths List of paths of the files
+    #  \param workers Number of commands hashing files at a time
+    #  \param batch_size Maximum number of files hashed by one command
+    #  \returns Dictionary mapping each path that could be hashed to its hex
+    #  SHA-256 digest
+    #  \returns List of error messages
+    #
+    # The files are hashed by `sha256sum` in batches, several of which run on
+    # the remote machine at once.
+    def hash_files(self, root, paths, workers, batch_size=256):
+        digests = {}
+        errors = []
+        def run(b):
+            return self.run(hash_script(root, b))
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+            for res, o, e in pool.map(run, batches(paths, batch_size)):
+                digests.update(parse_sums(o))
+                if res != 0:
+                    errors.append(e.strip() or 'exit status {0}'.format(res))
+        return digests, errors
+
+    ## Finds the directories files are hard links into
+    #  \param root Directory the paths are relative to
+    #  \param candidates List of directories to look for the files in
+    #  \param paths List of paths of the files
+    #  \returns Dictionary mapping each path that is the same file as the one
+    #  at the same path in a candidate to the index of the first such candidate
+    #  \returns List of error messages
+    #
+    # `root` and then each candidate in turn are listed with their inode
+    # numbers by a single remote `find` (see `inode_script()`), until every
+    # file has been found. Only the inodes of the files still looked for are
+    # kept, so usually (when most files are links into the first candidate)
+    # just two listings are needed, however many files there are.
+    def link_sources(self, root, candidates, paths):
+        errors = []
+        inodes = self._inodes(root, set(paths), errors)
+        errors.extend('{0}: not found'.format(p) for p in paths
+            if p not in inodes)
+        found = {}
+        for i, c in enumerate(candidates):
+            if len(found) == len(inodes):
+                break
+            left = {p: ino for p, ino in inodes.items() if p not in found}
+            found.update((p, i) for p, ino in self._inodes(c, left,
+                errors).items() if left[p] == ino)
+        return found, errors
+
+    ## Lists the inode numbers of some of the files in a directory
+    #  \param root Directory
+    #  \param wanted Paths (relative to `root`) of the files to keep
+    #  \param errors List the error message is appended to if listing fails
+    #  \returns Dictionary mapping each wanted path found to its inode number
+    def _inodes(self, root, wanted, errors):
+        inodes = {}
+        def keep(line):
+            entry = inode_line(line)
+            if entry is not None and entry[0] in wanted:
+                inodes[entry[0]] = entry[1]
+        res, o, e = self.run(inode_script(root), tail=1, on_line=keep)
+        if res != 0:
+            errors.append(e.strip() or 'exit status {0}'.format(res))
+        return inodes
+
+    ## Options that make rsync reach the remote machine the same way
+    def rsync_shell(self):
+        opts = self._bm._ssh_opts()
+        if opts:
+            return ['-e', ' '.join([self._bm._ssh_bin] + opts)]
+        return []
+
+    ## Path as an rsync destination (`[user@]host:path`)
+    def rsync_target(self, path):
+        return '{0}:{1}'.format(self._bm._ssh_target(), path)
+
+    ## Human readable location of `path`
+    def location(self, path):
+        return self.rsync_target(path)
+
+## \class backup.BackupTransport.local_transport
+#  Reaches a destination directory on this machine
+#
+# Every operation is done in-process with `os` and `shutil` calls (no shell and
+# no ssh) and rsync copies between two local paths, which saves the encryption
+# and a process per remote operation when the destination is a local disk or a
+# network file system mounted here. Only emptying the trash in the background
+# starts a (detached) process, so it outlives the run.
+class local_transport:
+
+    ## Creates a `local_transport` object
+    #  \param printer `backup_printer` object to use for output
+    def __init__(self, printer):
+        ## `backup_printer` object used for output
+        self._out = printer
+
+    ## Whether the destination can be reached (always)
+    def reachable(self):
+        return True
+
+    ## Whether `path` is a directory
+    def is_dir(self, path):
+        return os.path.isdir(path)
+
+    ## Whether `path` is writable
+    def is_writable(self, path):
+        return os.access(path, os.W_OK)
+
+    ## Creates directories (and their parents)
+    #  \returns Error message (None on success)
+    def makedirs(self, paths):
+        try:
+            for p in paths:
+                os.makedirs(p, exist_ok=True)
+        except OSError as e:
+            return str(e)
+        return None
+
+    ## Lists a directory
+    #  \returns List of names in the directory (None on error)
+    #  \returns Error message
+    def listdir(self, path):
+        try:
+            return os.listdir(path), ''
+        except OSError as e:
+            return None, str(e)
+
+    ## Checks the destination and lists it (see `ssh_transport.probe()`)
+    def probe(self, dest, create, link, generations=None, space=False):
+        flag = lambda x: '1' if x else '0'
+        status = {'exists': flag(os.path.isdir(dest))}
+        err = ''
+        if status['exists'] == '0' and create:
+            err = self.makedirs([dest]) or ''
+            status['created'] = flag(not err)
+        status['writable'] = flag(os.access(dest, os.W_OK))
+        try:
+            status['latest'] = os.readlink(os.path.join(dest, link))
+        except OSError:
+            status['latest'] = ''
+        if space and os.path.isdir(dest):
+            st = os.statvfs(dest)
+            status['avail_kb'] = str(st.f_bavail * st.f_frsize // 1024)
+            status['inodes'] = str(st.f_files)
+            status['ifree'] = str(st.f_favail)
+        if generations is not None:
+            known, new = generations
+            marker = os.path.join(dest, '.generation')
+            try:
+                with open(marker) as f:
+                    g = f.read().strip()
+            except OSError:
+                g = ''
+            if not g and new is not None and status['writable'] == '1':
+                g = new
+                self._write(marker, g)
+            status['generation'] = g
+            if g and g == known:
+                status['listed'] = '0'
+                return status, [], err
+        listing, e = self.listdir(dest) if os.path.isdir(dest) else ([], '')
+        return status, listing or [], err or e
+
+    ## Replaces a file atomically
+    def _write(self, path, text):
+        tmp = '{0}.{1}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text + '\n')
+        os.replace(tmp, path)
+
+    ## Marks the destination with a new generation (see `ssh_transport.commit()`)
+    def commit(self, dest, generation, link, latest=None):
+        try:
+            self._write(os.path.join(dest, '.generation'), generation)
+            if latest is not None:
+                tmp = os.path.join(dest, '.latest.{0}'.format(os.getpid()))
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                os.symlink(latest, tmp)
+                os.replace(tmp, os.path.join(dest, link))
+        except OSError as e:
+            return str(e)
+        return None
+
+    ## Moves directories into the trash and starts emptying it in the background
+    #  (see `ssh_transport.move_to_trash()`)
+    def move_to_trash(self, paths, trash, batch_size):
+        errors = []
+        try:
+            os.makedirs(trash, exist_ok=True)
+        except OSError as e:
+            return [str(e)]
+        for p in paths:
+            try:
+                os.rename(p, os.path.join(trash, os.path.basename(p)))
+            except OSError as e:
+                errors.append(str(e))
+        subprocess.Popen(['sh', '-c', 't={0}\n{1}'.format(shlex.quote(trash),
+            purge_trash_script())], stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True).wait()
+        return errors
+
+    ## Builds a `local_deleter`
+    def deleter(self, printer, workers, batch_size):
+        return local_deleter(printer, workers, batch_size)
+
+    ## Renames entries of a directory, never overwriting anything (see
+    #  `ssh_transport.rename()`)
+    def rename(self, dest, renames, batch_size):
+        renamed = []
+        errors = []
+        for old, new in renames.items():
+            if os.path.lexists(os.path.join(dest, new)):
+                errors.append('{0}: name already taken'.format(new))
+                continue
+            try:
+                os.rename(os.path.join(dest, old), os.path.join(dest, new))
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            renamed.append(old)
+        return renamed, errors
+
+    ## Makes a copy of a directory out of hard links and removes paths from it
+    #  (see `ssh_transport.clone()`)
+    #
+    # The copy is made by `cp -al`, which (unlike a walk in Python) also keeps
+    # the ownership of the copied directories.
+    def clone(self, src, dst, remove):
+        try:
+            if os.path.lexists(dst):
+                shutil.rmtree(dst)
+            os.makedirs(os.path.dirname(os.path.normpath(dst)), exist_ok=True)
+        except OSError as e:
+            return str(e)
+        res = subprocess.run(['cp', '-al', '--', src, dst],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        if res.returncode != 0:
+            return res.stderr.decode(errors='replace').strip()
+        for p in remove:
+            path = os.path.join(dst, p)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                return str(e)
+        return None
+
+    ## Reads a text file (see `ssh_transport.read_text()`)
+    def read_text(self, path):
+        try:
+            with open(path) as f:
+                return f.read(), ''
+        except FileNotFoundError:
+            return '', ''
+        except OSError as e:
+            return None, str(e)
+
+    ## Appends to a text file (creating it if necessary)
+    #  \returns Error message (None on success)
+    def append_text(self, path, text):
+        try:
+            with open(path, 'a') as f:
+                f.write(text)
+        except OSError as e:
+            return str(e)
+        return None
+
+    ## Replaces a text file atomically
+    #  \returns Error message (None on success)
+    def write_text(self, path, text):
+        tmp = '{0}.tmp'.format(path)
+        try:
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError as e:
+            return str(e)
+        return None
+
+    ## Hashes files (see `ssh_transport.hash_files()`)
+    #
+    # The files are hashed in-process by `workers` threads.
+    def hash_files(self, root, paths, workers, batch_size=256):
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+            results = pool.map(file_digest, [os.path.join(root, p)
+                for p in paths])
+            digests = {p: d for p, d in zip(paths, results) if d is not None}
+        return digests, ['{0}: cannot be read'.format(p) for p in paths
+            if p not in digests]
+
+    ## Finds the directories files are hard links into (see
+    #  `ssh_transport.link_sources()`)
+    #
+    # The files are compared in-process by their device and inode numbers.
+    def link_sources(self, root, candidates, paths):
+        found = {}
+        errors = []
+        for p in paths:
+            try:
+                st = os.lstat(os.path.join(root, p))
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            for i, c in enumerate(candidates):
+                try:
+                    if os.path.samestat(st, os.lstat(os.path.join(c, p))):
+                        found[p] = i
+                        break
+                except OSError:
+                    pass
+        return found, errors
+
+    ## Options that make rsync reach the destination (none)
+    def rsync_shell(self):
+        return []
+
+    ## Path as an rsync destination (the path itself)
+    def rsync_target(self, path):
+        return path
+
+    ## Human readable location of `path`
+    def location(self, path):
+        return path
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupTuning
+#
+# A module that provides functions to pick the fastest ssh cipher and rsync
+# compression for a destination host and to keep the choice for each host in a
+# JSON file
+
+from backup.BackupMetrics import write_json
+
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+
+## ssh ciphers tried (if ssh supports them), in order of preference
+cipher_candidates = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com', 'aes128-ctr')
+
+## rsync compression algorithms tried (if rsync supports them) and the levels
+#  tried for each one (empty for algorithms without levels)
+compress_candidates = (('zlib', (1, 6)), ('zstd', (1, 3, 9)), ('lz4', ()))
+
+## Share of the tuned throughput below which a transfer makes a tuning stale
+drift_ratio = 0.5
+
+## Results within this share of the fastest are as good as it (the earlier,
+#  preferred candidate is picked)
+_margin = 0.05
+
+## Serializes updates of tuning files by the threads of this process
+_lock = threading.Lock()
+
+## Output of a command
+#  \returns Standard output ('' if the command couldn't be run)
+def _output(cmd):
+    try:
+        return subprocess.run(cmd, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    except OSError:
+        return ''
+
+## Ciphers to try with an ssh binary
+#  \param ssh_bin Path to `ssh` binary
+#  \returns List of the `cipher_candidates` it supports (empty if it can't be
+#  asked)
+def ssh_ciphers(ssh_bin):
+    supported = set(_output([ssh_bin, '-Q', 'cipher']).split())
+    return [c for c in cipher_candidates if c in supported]
+
+## Compression settings to try with an rsync binary
+#  \param rsync_bin Path to `rsync` binary
+#  \returns List of tuples of a label and the rsync flags of each setting,
+#  starting with no compression
+#
+# rsync >= 3.2 lists the algorithms it supports in its version output, older
+# versions only have zlib (and no `--compress-choice`).
+def rsync_compressions(rsync_bin):
+    r = [('none', [])]
+    m = re.search(r'Compress list:\s*\n\s*(.+)', _output([rsync_bin,
+        '--version']))
+    if m is None:
+        return r + [('zlib-{0}'.format(l), ['-z', '--compress-level={0}'.format(
+            l)]) for l in compress_candidates[0][1]]
+    supported = m.group(1).split()
+    for name, levels in compress_candidates:
+        if name not in supported:
+            continue
+        flags = ['-z', '--compress-choice={0}'.format(name)]
+        if not levels:
+            r.append((name, flags))
+        for l in levels:
+            r.append(('{0}-{1}'.format(name, l),
+                flags + ['--compress-level={0}'.format(l)]))
+    return r
+
+## Removes compression from a group of rsync flags
+#  \param flags Group of flags (i.e. '-az')
+#  \returns The group without -z (None if nothing is left)
+#
+# Only a group of single letter flags is changed.
+def strip_compression(flags):
+    if flags is None or not flags.startswith('-') or flags.startswith('--'):
+        return flags
+    flags = flags.replace('z', '')
+    return None if flags == '-' else flags
+
+## Picks a sample of the data in some directories
+#  \param sources List of directories
+#  \param size Number of bytes to pick (about)
+#  \returns List of the absolute paths of the regular files picked
+#  \returns Their total size
+#
+# Files are picked in the order the directories are walked (sorted), skipping
+# files bigger than what is left to pick.
+def sample_files(sources, size):
+    files = []
+    total = 0
+    for src in sources:
+        for root, dirs, names in os.walk(os.path.abspath(src)):
+            dirs.sort()
+            for n in sorted(names):
+                path = os.path.join(root, n)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if (not os.path.isfile(path) or os.path.islink(path) or
+                        st.st_size > size - total or
+                        not os.access(path, os.R_OK)):
+                    continue
+                files.append(path)
+                total += st.st_size
+                if total >= size:
+                    return files, total
+    return files, total
+
+## Picks the fastest of a number of candidates
+#  \param candidates Candidates, in order of preference
+#  \param speeds Dictionary mapping candidates to their throughput (None if
+#  they failed)
+#  \returns The fastest candidate (None if they all failed)
+#
+# A candidate has to be faster than the preferred ones by more than a few
+# percent to be picked, so noise doesn't flip the choice between equals.
+def pick_fastest(candidates, speeds):
+    best = None
+    for c in candidates:
+        if speeds.get(c) is None:
+            continue
+        if best is None or speeds[c] > speeds[best] * (1 + _margin):
+            best = c
+    return best
+
+## Reads the tunings of every host from a file
+#  \param path Path of the file
+#  \returns Dictionary mapping each host to its tuning (empty if the file is
+#  missing or can't be parsed)
+def load_tunings(path):
+    try:
+        with open(os.path.expanduser(path)) as f:
+            tunings = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return tunings if isinstance(tunings, dict) else {}
+
+## Updates the tuning of a host in a file
+#  \param path Path of the file
+#  \param host Host (`[user@]host`)
+#  \param fn Function called with the host's current tuning (None if it has
+#  none) that returns the new one
+#  \returns The new tuning
+def _update(path, host, fn):
+    with _lock:
+        tunings = load_tunings(path)
+        tunings[host] = fn(tunings.get(host))
+        write_json(path, tunings)
+        return tunings[host]
+
+## Stores the tuning of a host in a file
+#  \param path Path of the file
+#  \param host Host (`[user@]host`)
+#  \param cipher ssh cipher (None for ssh's default)
+#  \param compression Label of the rsync compression setting
+#  \param rsync_flags rsync flags of the compression setting
+#  \param throughput Bytes per second of the sample with both
+#  \param results Dictionary of the throughput of each candidate tried
+#  \returns The tuning, a dictionary of the above and the time it was `tuned`
+def save_tuning(path, host, cipher, compression, rsync_flags, throughput,
+        results):
+    return _update(path, host, lambda t: {'cipher': cipher,
+        'compression': compression, 'rsync_flags': rsync_flags,
+        'throughput': throughput, 'results': results, 'tuned': time.time()})
+
+## Marks the tuning of a host stale (to be tuned again)
+#  \param path Path of the file
+#  \param host Host (`[user@]host`)
+#  \param throughput Throughput that was measured (bytes per second)
+def mark_stale(path, host, throughput):
+    def stale(t):
+        t = dict(t or {})
+        t['stale'] = True
+        t['measured'] = throughput
+        return t
+    _update(path, host, stale)
+
+## Whether a transfer drifted too far below the tuned throughput
+#  \param tuning Tuning of the host
+#  \param throughput Throughput of the transfer (bytes per second)
+def drifted(tuning, throughput):
+    return throughput < tuning.get('throughput', 0) * drift_ratio
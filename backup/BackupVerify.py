@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \package backup.BackupVerify
+#
+# A module that provides functions to verify the files of a backup against
+# their sources by content hash, and the `hash_cache` class that keeps the
+# hashes of source files so unchanged ones aren't hashed again
+
+import concurrent.futures
+import hashlib
+import os
+import random
+import re
+import shlex
+import sqlite3
+
+## What `verify` can be set to
+#
+# 'sample' verifies a random sample of the files transferred into a backup,
+# 'full' every one of them.
+verify_modes = ('sample', 'full')
+
+## Size of the chunks files are hashed in
+_chunk_size = 1 << 20
+
+## Line of rsync's `--out-format='%i %l %n'` output for a transferred file
+_transferred_re = re.compile(r'^[<>]f\S* \d+ (.+)$')
+
+## \class backup.BackupVerify.hash_cache
+#  A local SQLite cache of the hashes of files
+#
+# Keyed by the device and inode of a file, a hash is only used while the
+# file's size and modification time are the ones it was computed for.
+#
+# Every operation uses its own short-lived connection, so a cache can be shared
+# by several threads (and processes).
+class hash_cache:
+
+    ## Creates a `hash_cache` object, creating the database if necessary
+    #  \param path Path of the SQLite database
+    def __init__(self, path):
+        ## path of the SQLite database
+        self.path = os.path.expanduser(path)
+        with self._connect() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, '
+                'ino INTEGER, size INTEGER, mtime INTEGER, digest TEXT, '
+                'PRIMARY KEY (dev, ino))')
+
+    ## Opens a connection to the database
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    ## Hashes of files that are still valid
+    #  \param stats List of the files' `os.stat_result`s
+    #  \returns Dictionary mapping the index (in `stats`) of each file with a
+    #  valid hash to the hash
+    def lookup(self, stats):
+        r = {}
+        with self._connect() as c:
+            for i, st in enumerate(stats):
+                row = c.execute('SELECT digest FROM hashes WHERE dev=? AND '
+                    'ino=? AND size=? AND mtime=?', (st.st_dev, st.st_ino,
+                    st.st_size, st.st_mtime_ns)).fetchone()
+                if row is not None:
+                    r[i] = row[0]
+        return r
+
+    ## Records the hashes of files
+    #  \param entries List of tuples of a file's `os.stat_result` and its hash
+    def store(self, entries):
+        with self._connect() as c:
+            c.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                [(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, d)
+                for st, d in entries])
+
+## Hashes a file
+#  \param path Path of the file
+#  \returns Hex SHA-256 digest of its content (None if it can't be read)
+def file_digest(path):
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_chunk_size), b''):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+## Hashes source files, using a cache for the unchanged ones
+#  \param paths List of paths of the files
+#  \param cache `hash_cache` to use (None for none)
+#  \param workers Number of files hashed at a time
+#  \returns Dictionary mapping each path to a tuple of its hash and its
+#  `os.stat_result` from before it was hashed (both None if it is gone or
+#  isn't a regular file)
+#
+# New hashes are added to the cache.
+def source_digests(paths, cache=None, workers=4):
+    r = {}
+    stats = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            r[p] = (None, None)
+            continue
+        stats.append((p, st))
+    cached = cache.lookup([st for _, st in stats]) if cache is not None else {}
+    todo = []
+    for i, (p, st) in enumerate(stats):
+        if i in cached:
+            r[p] = (cached[i], st)
+        else:
+            todo.append((p, st))
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+        digests = list(pool.map(file_digest, [p for p, _ in todo]))
+    for (p, st), d in zip(todo, digests):
+        r[p] = (d, st) if d is not None else (None, None)
+    if cache is not None:
+        cache.store([(st, d) for (p, st), d in zip(todo, digests)
+            if d is not None])
+    return r
+
+## Path of a file rsync transferred
+#  \param line Line of rsync's `--out-format='%i %l %n'` output
+#  \returns The path (relative to the transfer's destination), None if the
+#  line isn't about a transferred regular file
+#
+# rsync writes unprintable characters of names as `\#ooo` (octal).
+def transferred_file(line):
+    m = _transferred_re.match(line)
+    if m is None:
+        return None
+    return unescape_name(m.group(1))
+
+## Decodes a name as rsync writes it in its output
+#  \param name The name, with unprintable characters written as `\#ooo`
+#  (octal)
+#  \returns The name
+def unescape_name(name):
+    return os.fsdecode(re.sub(rb'\\#([0-7]{3})', lambda x: bytes([int(
+        x.group(1), 8)]), os.fsencode(name)))
+
+## Shell script that hashes files
+#  \param root Directory the paths are relative to
+#  \param paths List of paths
+def hash_script(root, paths):
+    return 'cd {0} && sha256sum -- {1}'.format(shlex.quote(root),
+        ' '.join(shlex.quote(p) for p in paths))
+
+## Parses the output of `sha256sum`
+#  \param text The output
+#  \returns Dictionary mapping each path to its hex digest
+#
+# Lines of names with a backslash, newline (or carriage return) start with a
+# backslash and have those characters escaped.
+def parse_sums(text):
+    r = {}
+    for line in text.split('\n'):
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        digest, sep, path = line.partition('  ')
+        if not sep or len(digest) != 64:
+            continue
+        if escaped:
+            path = re.sub(r'\\(.)', lambda m: {'n': '\n', 'r': '\r'}.get(
+                m.group(1), m.group(1)), path)
+        r[path] = digest
+    return r
+
+## Picks the files to verify
+#  \param paths List of the files transferred into a backup
+#  \param mode How many to verify (see `verify_modes`)
+#  \param sample Size of a sample
+#  \returns Sorted list of the files to verify
+def pick_files(paths, mode, sample):
+    paths = sorted(paths)
+    if mode == 'sample' and len(paths) > sample:
+        paths = sorted(random.sample(paths, sample))
+    return paths
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \file backup_daemon.py
+#
+# A script that runs the backup jobs of `create_backup.py` on their own
+# schedules from a single long-running process (instead of cron), or controls
+# a running one
+
+from backup.BackupPrinter import backup_printer
+from backup.BackupScheduler import (backup_scheduler, parse_duration,
+    scheduled_job, send_command)
+from create_backup import (daemon_options, job_settings, parse_config_files,
+    run_backup, stop_sessions)
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+## Parses the command line into a dictionary
+#  \param l list of command-line arguments
+def parse_command_line(l):
+    parser = argparse.ArgumentParser(description='Runs backup jobs on their '
+        'own schedules, or controls a running daemon (with --run/--status)')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='Verbose output')
+    parser.add_argument('-c', '--config-file', type=str, metavar='FILE',
+            help='Configuration file to use')
+    parser.add_argument('--socket', type=str, metavar='PATH',
+            help='Unix socket the daemon is controlled with')
+    parser.add_argument('--state-file', type=str, metavar='FILE',
+            help='File to keep the times of the runs of the jobs in')
+    parser.add_argument('--max-jobs', type=int, metavar='N',
+            help='Number of jobs to run at a time')
+    parser.add_argument('--max-per-destination', type=int, metavar='N',
+            help='Number of jobs writing to the same destination at a time')
+    parser.add_argument('--run', type=str, metavar='JOB',
+            help='Ask the running daemon to run JOB now')
+    parser.add_argument('--status', type=str, metavar='JOB', nargs='?',
+            const='', help='Show the state of the jobs of the running daemon')
+    args = parser.parse_args(l)
+    return {key: value for key, value in vars(args).items()
+            if value is not None}
+
+## Default path of the control socket
+def default_socket():
+    return os.path.expanduser('~/.backup-daemon.sock')
+
+## Builds the scheduled jobs from the settings
+#  \param settings Settings (as returned by `parse_config_files()`)
+#  \param out `backup_printer` object to use for output
+#  \returns List of `scheduled_job` objects
+#
+# Every `job:NAME` section with a `schedule` (a duration, see
+# `parse_duration()`) is a job. `retries` and `retry_delay` set how failed runs
+# are retried.
+def build_jobs(settings, out):
+    jobs = []
+    for name, s in sorted(settings.get('jobs', {}).items()):
+        if 'schedule' not in s:
+            out.warn('Job: {0} has no schedule, ignoring it\n'.format(name))
+            continue
+        try:
+            interval = parse_duration(s['schedule'])
+            retry_delay = parse_duration(s.get('retry_delay', 60))
+        except ValueError as e:
+            out.error('Job: {0}: {1}, ignoring it\n'.format(name, e))
+            continue
+        if interval <= 0:
+            out.error('Job: {0}: the schedule must be positive, ignoring '
+                'it\n'.format(name))
+            continue
+        jobs.append(scheduled_job(name, job_settings(settings, name), interval,
+            s.get('retries', 3), retry_delay))
+    return jobs
+
+## Runs the daemon until it is terminated (SIGTERM or SIGINT)
+#  \param settings Settings (as returned by `parse_config_files()`, merged with
+#  the command-line)
+#
+# All of the jobs' ssh connections are made through a session directory shared
+# by the whole daemon, so a destination's master connection stays up between
+# runs (for `session_persist` seconds, an hour by default) and across jobs.
+# Running jobs are allowed to finish when the daemon is terminated.
+def daemon(settings):
+    out = settings['printer']
+    d = settings.get('daemon', {})
+    jobs = build_jobs(settings, out)
+    if not jobs:
+        out.fatal('No jobs with a schedule found ([job:NAME] sections)\n', 1)
+
+    session_dir = tempfile.mkdtemp(prefix='backup-daemon-ssh-')
+    for j in jobs:
+        j.settings['printer'] = out
+        j.settings.setdefault('session_dir', session_dir)
+        j.settings.setdefault('session_persist', d.get('session_persist', 3600))
+
+    try:
+        max_retry_delay = parse_duration(d.get('max_retry_delay', 3600))
+    except ValueError as e:
+        out.error('{0}, using 3600 instead\n'.format(e))
+        max_retry_delay = 3600
+    scheduler = backup_scheduler(jobs, lambda j: run_backup(j.settings), out,
+        max_jobs=d.get('max_jobs', 2),
+        max_per_destination=d.get('max_per_destination', 1),
+        max_retry_delay=max_retry_delay, state_file=d.get('state_file'))
+    path = d.get('socket', default_socket())
+    server = scheduler.serve(path)
+    out.info('Running {0} job(s), controlled through: {1}\n'.format(len(jobs),
+        path))
+
+    stop = lambda signum, frame: scheduler.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        scheduler.run_forever()
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(path)
+        # End the warm ssh sessions
+        stop_sessions(j.settings for j in jobs)
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+## Runs the daemon, or sends a command to a running one
+def main():
+    cl_settings = parse_command_line(sys.argv[1:])
+    verbose = cl_settings.pop('verbose')
+    out = backup_printer(warn=sys.stdout,
+        info=sys.stdout if verbose > 0 else None,
+        debug=sys.stdout if verbose > 1 else None, error=sys.stderr,
+        fatal=sys.stderr)
+
+    config_files = ['/etc/backup.conf', os.path.expanduser('~/.backup.conf')]
+    if 'config_file' in cl_settings:
+        config_files.append(cl_settings.pop('config_file'))
+    settings, cf_read = parse_config_files(config_files, out)
+    out.info('Configuration file(s) read: {0}\n'.format(' '.join(cf_read)))
+    settings['printer'] = out
+
+    # The daemon's settings given on the command line
+    d = settings.setdefault('daemon', {})
+    for k in ('max_jobs',) + daemon_options:
+        if k in cl_settings:
+            d[k] = cl_settings.pop(k)
+
+    # Control a running daemon
+    command = None
+    if 'run' in cl_settings:
+        command = ['run', cl_settings['run']]
+    elif 'status' in cl_settings:
+        command = ['status'] + ([cl_settings['status']]
+            if cl_settings['status'] else [])
+    if command is not None:
+        try:
+            reply = send_command(d.get('socket', default_socket()), command)
+        except OSError as e:
+            out.fatal('Unable to reach the daemon: {0}\n'.format(e), 1)
+        print(json.dumps(reply, indent=2, sort_keys=True))
+        sys.exit(1 if 'error' in reply else 0)
+
+    daemon(settings)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \file benchmarks/compare_results.py
+#
+# A script that compares two sets of results of `run_benchmark.py` (i.e. of
+# two releases) and reports regressions
+
+import argparse
+import json
+import sys
+
+## Measurements compared for each phase (all of them are better when lower)
+measurements = ('wall_seconds', 'cpu_seconds', 'commands', 'bytes_written')
+
+## Sums the measurements of each phase over all of the runs
+#  \param results Results of `run_benchmark.py`
+#  \returns Dictionary mapping `(phase, measurement)` to its total
+def totals(results):
+    r = {}
+    for run in results['runs']:
+        for phase, m in run['phases'].items():
+            for k in measurements:
+                r[(phase, k)] = r.get((phase, k), 0) + m.get(k, 0)
+    return r
+
+## Compares two sets of results
+#  \param old Results to compare against
+#  \param new Results to compare
+#  \param threshold Relative increase that counts as a regression
+#  \returns List of `(phase, measurement, old, new, regression)` tuples
+def compare(old, new, threshold):
+    a = totals(old)
+    b = totals(new)
+    r = []
+    for key in sorted(set(a) & set(b)):
+        regression = b[key] > a[key] * (1 + threshold)
+        r.append(key + (a[key], b[key], regression))
+    return r
+
+## Compare the results given on the command-line
+#
+# Prints a line for each measurement and exits with status 1 if any of them
+# regressed.
+def main():
+    parser = argparse.ArgumentParser(description='Compares two benchmark '
+        'results')
+    parser.add_argument('old', help='Results to compare against')
+    parser.add_argument('new', help='Results to compare')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+            help='Relative increase that counts as a regression (default 0.1)')
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old['settings'] != new['settings']:
+        sys.stderr.write('Warning: the results were run with different '
+            'settings\n')
+    failed = False
+    for phase, k, a, b, regression in compare(old, new, args.threshold):
+        change = '{0:+.1%}'.format(b / a - 1) if a else 'n/a'
+        print('{0:<10} {1:<14} {2:>14.6g} {3:>14.6g} {4:>8}{5}'.format(phase, k,
+            a, b, change, '  REGRESSION' if regression else ''))
+        failed = failed or regression
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
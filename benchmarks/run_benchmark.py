@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \file benchmarks/run_benchmark.py
+#
+# A script that measures `backup_manager` end to end against a local stand-in
+# for the remote machine
+#
+# Generates a synthetic source tree, then runs a number of consecutive backups
+# (each followed by pruning) with real rsync processes, using `ssh_shim.py` in
+# place of ssh so the "remote" destination is a local directory. Between runs a
+# share of the tree is changed. Each phase of each run is measured (wall time,
+# commands run, peak RSS and bytes written) and the results are written as
+# JSON so they can be compared between releases.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from backup.BackupExceptions import Error
+
+import argparse
+import json
+import math
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+## Path of the ssh stand-in
+ssh_shim = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'ssh_shim.py')
+
+## Parses the command-line
+#  \param l List of command-line arguments
+#  \returns `argparse.Namespace` of the settings
+def parse_command_line(l):
+    parser = argparse.ArgumentParser(description='Benchmarks backup_manager '
+        'against a local stand-in for the remote machine')
+    parser.add_argument('-o', '--output', type=str, metavar='FILE',
+            help='Write the results to FILE (default: stdout)')
+    parser.add_argument('-w', '--workdir', type=str, metavar='DIR',
+            help='Directory to create the trees in (default: a temporary one, '
+            'removed afterwards)')
+    parser.add_argument('-r', '--runs', type=int, default=5, metavar='N',
+            help='Number of consecutive backups')
+    parser.add_argument('-f', '--files', type=int, default=1000, metavar='N',
+            help='Number of files in the source tree')
+    parser.add_argument('--dirs', type=int, default=10, metavar='N',
+            help='Number of directories the files are spread over')
+    parser.add_argument('--sizes', type=str, default='lognormal:4096:1.5',
+            metavar='DIST', help='File size distribution: fixed:SIZE, '
+            'uniform:MIN:MAX or lognormal:MEDIAN:SIGMA')
+    parser.add_argument('--churn', type=float, default=0.05, metavar='F',
+            help='Share of the files changed between runs')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Seed of the random generator (for repeatable trees)')
+    parser.add_argument('-b', '--num-backups', type=int, default=3,
+            metavar='N', help='Number of backups to keep')
+    parser.add_argument('-j', '--workers', type=int, default=4, metavar='N',
+            help='Number of concurrent rsync processes')
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+            help='Number of shards to split the source into')
+    parser.add_argument('--async-prune', action='store_true',
+            help='Delete old backups in the background')
+    parser.add_argument('--rsync-bin', type=str, default='rsync',
+            metavar='PATH', help='rsync binary to use')
+    return parser.parse_args(l)
+
+## Builds a function that draws file sizes from a distribution
+#  \param spec Distribution: `fixed:SIZE`, `uniform:MIN:MAX` or
+#  `lognormal:MEDIAN:SIGMA`
+#  \param rng `random.Random` object to draw with
+#  \returns Function returning a size in bytes
+def size_sampler(spec, rng):
+    kind, _, params = spec.partition(':')
+    p = [float(x) for x in params.split(':') if x]
+    if kind == 'fixed' and len(p) == 1:
+        return lambda: int(p[0])
+    if kind == 'uniform' and len(p) == 2:
+        return lambda: rng.randint(int(p[0]), int(p[1]))
+    if kind == 'lognormal' and len(p) == 2:
+        mu = math.log(p[0])
+        return lambda: int(rng.lognormvariate(mu, p[1]))
+    raise ValueError('invalid size distribution: {0}'.format(spec))
+
+## Writes a file of random content
+def write_file(path, size, rng):
+    with open(path, 'wb') as f:
+        f.write(rng.getrandbits(8 * size).to_bytes(size, 'little')
+            if size else b'')
+
+## Generates a source tree
+#  \param root Directory to create the tree in
+#  \param files Number of files
+#  \param dirs Number of directories to spread them over
+#  \param sizes Function returning file sizes (see `size_sampler()`)
+#  \param rng `random.Random` object to draw with
+#  \returns List of the files' paths (relative to `root`)
+def generate_tree(root, files, dirs, sizes, rng):
+    paths = []
+    for i in range(files):
+        p = os.path.join('d{0:04d}'.format(i % max(dirs, 1)),
+            'f{0:07d}'.format(i))
+        os.makedirs(os.path.join(root, os.path.dirname(p)), exist_ok=True)
+        write_file(os.path.join(root, p), sizes(), rng)
+        paths.append(p)
+    return paths
+
+## Changes a share of a source tree
+#  \param root Directory of the tree
+#  \param paths List of the tree's files (relative to `root`)
+#  \param churn Share of the files to change
+#  \param sizes Function returning file sizes (see `size_sampler()`)
+#  \param rng `random.Random` object to draw with
+#  \returns List of the tree's files after the change
+#
+# Of the files changed half are rewritten, a quarter are deleted and as many
+# new ones are created.
+def churn_tree(root, paths, churn, sizes, rng):
+    n = int(len(paths) * churn)
+    changed = rng.sample(paths, min(n, len(paths)))
+    deleted = set(changed[:n // 4])
+    for p in changed[n // 4:n // 4 + n // 2]:
+        write_file(os.path.join(root, p), sizes(), rng)
+    for p in deleted:
+        os.remove(os.path.join(root, p))
+    paths = [p for p in paths if p not in deleted]
+    top = max([int(os.path.basename(p)[1:]) for p in paths] or [0])
+    for i in range(top + 1, top + 1 + len(deleted)):
+        p = os.path.join(os.path.dirname(rng.choice(paths or ['d0000/x'])),
+            'f{0:07d}'.format(i))
+        os.makedirs(os.path.join(root, os.path.dirname(p)), exist_ok=True)
+        write_file(os.path.join(root, p), sizes(), rng)
+        paths.append(p)
+    return paths
+
+## Space used by a directory tree
+#  \returns Bytes allocated to the tree, counting hard linked files once
+def tree_bytes(root):
+    seen = set()
+    total = 0
+    for d, dirs, files in os.walk(root):
+        for x in dirs + files:
+            st = os.lstat(os.path.join(d, x))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+## Measures one phase of a run
+#  \param fn Function doing the work of the phase
+#  \param counter Single item list counting the commands run
+#  \returns Dictionary of the measurements
+#
+# Bytes written are taken from the block output counters of this process and
+# its (finished) children, so they include the "remote" rsync started through
+# the shim. Peak RSS is the largest of any single child so far (the kernel
+# doesn't keep it per phase).
+def measure(fn, counter):
+    before = (resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN))
+    commands = counter[0]
+    start = time.monotonic()
+    fn()
+    wall = time.monotonic() - start
+    after = (resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN))
+    return {'wall_seconds': wall,
+        'commands': counter[0] - commands,
+        'bytes_written': 512 * sum(a.ru_oublock - b.ru_oublock
+            for a, b in zip(after, before)),
+        'cpu_seconds': sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime
+            for a, b in zip(after, before)),
+        'peak_rss_kb': {'self': after[0].ru_maxrss,
+            'children': after[1].ru_maxrss}}
+
+## Runs the benchmark
+#  \param args Settings (see `parse_command_line()`)
+#  \param work Directory to create the trees in
+#  \returns Dictionary of the results
+def benchmark(args, work):
+    rng = random.Random(args.seed)
+    sizes = size_sampler(args.sizes, rng)
+    src = os.path.join(work, 'src')
+    dest = os.path.join(work, 'dest')
+    os.makedirs(src)
+    paths = generate_tree(src, args.files, args.dirs, sizes, rng)
+    results = {'settings': vars(args), 'environment': {
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'rsync': subprocess.run([args.rsync_bin, '--version'],
+            stdout=subprocess.PIPE, universal_newlines=True).stdout.split(
+            '\n')[0], 'cpus': os.cpu_count()},
+        'source_bytes': tree_bytes(src), 'runs': []}
+    start = datetime(2000, 1, 1)
+    for i in range(args.runs):
+        if i:
+            paths = churn_tree(src, paths, args.churn, sizes, rng)
+        bm = backup_manager(src, 'localhost', dest, ssh_bin=ssh_shim,
+            rsync_bin=args.rsync_bin, prefix='', printer=backup_printer(
+            error=sys.stderr), num_backups=args.num_backups,
+            workers=args.workers, shards=args.shards,
+            async_prune=args.async_prune)
+        counter = [0]
+        run_cmd = bm._run_cmd
+        def counted(*a, **kw):
+            counter[0] += 1
+            return run_cmd(*a, **kw)
+        bm._run_cmd = counted
+        # Consecutive runs are an hour apart as far as their names go
+        name = (start + timedelta(hours=i)).strftime(bm.name_format)
+        run = {'run': i, 'files': len(paths), 'phases': {}}
+        begin = time.monotonic()
+        with bm:
+            run['phases']['preflight'] = measure(bm.preflight, counter)
+            run['phases']['create'] = measure(
+                lambda: bm.create_backup(name), counter)
+            run['phases']['prune'] = measure(bm.remove_backups, counter)
+        run['wall_seconds'] = time.monotonic() - begin
+        run['dest_bytes'] = tree_bytes(dest)
+        run['report'] = bm.run_report()['destinations'][0]
+        results['runs'].append(run)
+    return results
+
+## Run the benchmark and write its results
+def main():
+    args = parse_command_line(sys.argv[1:])
+    if shutil.which(args.rsync_bin) is None:
+        sys.exit('rsync not found: {0}'.format(args.rsync_bin))
+    work = args.workdir or tempfile.mkdtemp(prefix='backup-benchmark-')
+    try:
+        results = benchmark(args, work)
+    except Error as e:
+        sys.exit('Benchmark failed: {0}'.format(e.msg))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(work, ignore_errors=True)
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \file benchmarks/ssh_shim.py
+#
+# A stand-in for `ssh` that runs the "remote" command on this machine
+#
+# Takes the same command-line as ssh, ignores the options and the destination
+# and runs the command the way sshd would: its words joined with spaces and
+# passed to the shell. Control master requests (`-O`) succeed without doing
+# anything. This lets `backup_manager` (and rsync's `-e`) run against a local
+# directory as if it were on a remote machine, without an ssh server.
+
+import os
+import sys
+
+## ssh options that take an argument
+_options_with_args = set('BbcDEeFIiJLlmOoPpQRSWw')
+
+## Runs the command given on an ssh command-line
+#  \param args ssh's command-line arguments (without the program name)
+def main(args):
+    control = False
+    i = 0
+    while i < len(args) and args[i].startswith('-'):
+        opt = args[i]
+        if opt == '--':
+            i += 1
+            break
+        if opt[-1] in _options_with_args and len(opt) == 2:
+            control = control or opt == '-O'
+            i += 1
+        i += 1
+    command = args[i + 1:]
+    if control:
+        sys.exit(0)
+    if not command:
+        sys.stderr.write('ssh_shim: no command given\n')
+        sys.exit(255)
+    os.execvp('sh', ['sh', '-c', ' '.join(command)])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
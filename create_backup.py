@@ -34,11 +34,31 @@
 
 from backup.BackupManager import backup_manager
 from backup.BackupPrinter import backup_printer
+from backup.BackupSpace import format_report
 
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import configparser
 import os
+import shutil
 import sys
+import tempfile
+import time
+
+## Parses a destination given on the command-line
+#  \param s Destination in the form `[USER@]HOST:DIR`
+#  \returns Dictionary describing the destination (see
+#  `backup_manager.destinations`)
+def parse_destination(s):
+    host, sep, dest = s.partition(':')
+    user, at, host = host.rpartition('@')
+    if not sep or not host or not dest or (at and not user):
+        raise argparse.ArgumentTypeError("invalid destination: '{0}' (expected "
+            "[USER@]HOST:DIR)".format(s))
+    d = {'host': host, 'dest': dest}
+    if at:
+        d['user'] = user
+    return d
 
 # Parses the command line into a dictionary. Does not include anything with a
 # value of None
@@ -57,10 +77,22 @@ def parse_command_line(l):
             help='Do not actually create backup')
     parser.add_argument('-c', '--config-file', type=str, metavar='FILE',
             help='Configuration file to use')
+    parser.add_argument('--job', type=str, metavar='NAME', action='append',
+            dest='job_names',
+            help='Run the job of the [job:NAME] section of the configuration '
+            '(labeling its run report with NAME), may be given more than '
+            'once. Without it every job of the configuration is run')
+    parser.add_argument('--max-jobs', type=int, metavar='N',
+            help='Number of jobs to run at a time (default 2)')
     parser.add_argument('-b', '--num-backups', type=int, metavar='N',
             help='Number of backups to keep')
+    for b in ('hourly', 'daily', 'weekly', 'monthly', 'yearly'):
+        parser.add_argument('--keep-{}'.format(b), type=int, metavar='N',
+                help='Also keep the newest backup of each of the last N {} '
+                'periods'.format(b))
     parser.add_argument('-s', '--source-dir', type=str, dest='src',
-            metavar='DIR', help='Source directory (local)')
+            metavar='DIR', nargs='+',
+            help='Source directory or directories (local)')
     parser.add_argument('-d', '--dest-dir', type=str, metavar='DIR',
             dest='dest', help='Destination directory (remote)')
     parser.add_argument('-m', '--remote-machine', type=str, metavar='MACHINE',
@@ -75,35 +107,353 @@ def parse_command_line(l):
             help='Store a log of the excluded files')
     parser.add_argument('-p', '--prefix', type=str, dest='prefix',
             help='String to use as prefix for backup')
+    parser.add_argument('--name-format', type=str, metavar='FORMAT',
+            help='strftime format of the timestamp in backup names')
+    parser.add_argument('--migrate-names', action='store_true', default=None,
+            help='Rename backups named in the old format to the current one')
+    parser.add_argument('-D', '--destination', type=parse_destination,
+            action='append', dest='destinations', metavar='[USER@]HOST:DIR',
+            help='Replicate the backup to this destination (can be repeated)')
+    parser.add_argument('-j', '--workers', type=int, metavar='N',
+            help='Number of sources to transfer concurrently')
+    parser.add_argument('--shards', type=int, metavar='N',
+            help='Split each source directory into N concurrent transfers')
+    parser.add_argument('--shard-weight', choices=('size', 'count'),
+            help='Balance shards by total size or by number of files')
+    parser.add_argument('--shard-retries', type=int, metavar='N',
+            help='Retry failed transfers (i.e. shards) up to N times')
+    parser.add_argument('--sync-prune', action='store_false', default=None,
+            dest='async_prune',
+            help='Wait for old backups to be deleted instead of deleting them '
+            'in the background')
+    parser.add_argument('--delete-workers', type=int, metavar='N',
+            help='Number of concurrent remote deletions (with --sync-prune)')
+    parser.add_argument('--nice', type=int, metavar='N',
+            help='Run rsync with niceness N')
+    parser.add_argument('--ionice', choices=('idle', 'best-effort'),
+            help='Run rsync in this I/O scheduling class')
+    parser.add_argument('--bwlimit', type=str, metavar='RATE',
+            help="Limit rsync's bandwidth (see rsync's --bwlimit)")
+    parser.add_argument('--nocache', action='store_true', default=None,
+            help="Keep rsync's reads out of the page cache (needs nocache)")
+    parser.add_argument('--throttle', action='store_true', default=None,
+            help='Slow rsync down while the host is busy')
+    parser.add_argument('--report-json', type=str, metavar='FILE',
+            help='Write a JSON report of the run (timings and rsync stats)')
+    parser.add_argument('--report-prom', type=str, metavar='FILE',
+            help="Write the run report for Prometheus' textfile collector")
+    parser.add_argument('--catalog', type=str, metavar='FILE',
+            help='Keep a local catalog of backups to avoid listing the '
+            'destination')
+    parser.add_argument('--unchanged', choices=('reuse', 'redate'),
+            help='Skip rsync when the sources are unchanged since the most '
+            'recent backup, keeping it or renaming it (needs --catalog)')
+    parser.add_argument('--journal', type=str, metavar='DIR',
+            help='Transfer only the changes recorded by watch_sources.py in '
+            'the change journals in DIR')
+    parser.add_argument('--journal-full-every', type=int, metavar='N',
+            help='Walk the whole sources after N backups made from journals')
+    parser.add_argument('--journal-max', type=int, metavar='N',
+            help='Walk the whole source if its journal has more than N '
+            'changes')
+    parser.add_argument('--transport', choices=('ssh', 'local'),
+            help='Reach the destination over ssh or as a local directory')
+    parser.add_argument('--verify', choices=('sample', 'full'),
+            help='Compare the hashes of a sample of (or all) the files '
+            'transferred into the backup with their sources')
+    parser.add_argument('--verify-sample', type=int, metavar='N',
+            help='Number of files verified with --verify sample')
+    parser.add_argument('--verify-cache', type=str, metavar='FILE',
+            help='Keep the hashes of source files in a local cache')
+    parser.add_argument('--space-index', action='store_true', default=None,
+            help='Record the inodes and bytes each new backup introduced in '
+            'an index in the destination')
+    parser.add_argument('--space-report', action='store_true', default=None,
+            help='Print the space each backup takes (from the index) and '
+            'exit')
+    parser.add_argument('--capacity-prune', action='store_true',
+            default=None,
+            help='Remove the oldest backups if the new one would not fit in '
+            'the destination')
+    parser.add_argument('--min-free', type=str, metavar='SIZE',
+            help='Bytes (or K, M, G, T) to keep free with --capacity-prune')
+    parser.add_argument('--min-free-inodes', type=int, metavar='N',
+            help='Inodes to keep free with --capacity-prune')
+    parser.add_argument('--min-backups', type=int, metavar='N',
+            help='Number of backups --capacity-prune always keeps')
+    parser.add_argument('--link-dests', type=int, metavar='N',
+            help='Look for unchanged files in the N most recent backups')
+    parser.add_argument('--link-dest-tiers', action='store_true',
+            default=None,
+            help='Also look for unchanged files in the oldest backup each '
+            'retention bucket keeps')
+    parser.add_argument('--link-dest-stats', action='store_true',
+            default=None,
+            help='Print the bytes each extra link-dest backup saved (an '
+            'expensive diagnostic: lists the new backup and every link-dest '
+            'on the destination after the transfer)')
+    parser.add_argument('--tune', action='store_true', default=None,
+            help='Measure the fastest ssh cipher and rsync compression for '
+            'the destination(s), store them in the tune file and exit')
+    parser.add_argument('--tune-file', type=str, metavar='FILE',
+            help='Use the ssh cipher and rsync compression tuned for the '
+            'destination in FILE')
+    parser.add_argument('--autotune', action='store_true', default=None,
+            help='Tune the destination before the backup if it has no '
+            'tuning or its tuning is stale (needs --tune-file)')
+    parser.add_argument('--no-multiplex', action='store_false', default=None,
+            dest='multiplex',
+            help='Open a new ssh connection for every remote command')
     args = parser.parse_args(l)
     return {key: value for key, value in vars(args).items()
             if value is not None}
 
+## Settings that are read from configuration files as integers
+int_options = ('num_backups', 'workers', 'shards', 'shard_retries',
+    'delete_workers', 'delete_batch', 'keep_hourly', 'keep_daily',
+    'keep_weekly', 'keep_monthly', 'keep_yearly', 'nice',
+    'journal_full_every', 'journal_max', 'session_persist', 'retries',
+    'max_jobs', 'max_per_destination', 'tune_sample', 'verify_sample',
+    'min_free_inodes', 'min_backups', 'link_dests')
+
+## Settings that are read from configuration files as booleans
+bool_options = ('dry_run', 'log_excludes', 'multiplex', 'async_prune',
+    'migrate_names', 'nocache', 'throttle', 'autotune', 'space_index',
+    'capacity_prune', 'link_dest_tiers', 'link_dest_stats')
+
+## Settings that are read from configuration files as floats
+float_options = ('throttle_load', 'throttle_latency')
+
+## Settings of a job that are only used to schedule it (see backup_daemon.py)
+job_options = ('schedule', 'retries', 'retry_delay')
+
+## Settings that are only used by the daemon (see backup_daemon.py)
+daemon_options = ('max_per_destination', 'socket', 'state_file',
+    'max_retry_delay')
+
+## Settings that are read from configuration files as lists (one item per line)
+list_options = ('src',)
+
+## Settings that are read from configuration files without interpolation
+raw_options = ('name_format',)
+
 ## Parses a list of configuration files
 #  \param list of config files to parse
 #  \param `backup_printer` to use for output
 #
 # Parses a list of configuration files (in order). Each configuration file
-# overrides settings from previously read files, so they can cascade.
+# overrides settings from previously read files, so they can cascade. Sections
+# named `destination:NAME` each describe one of the destinations to replicate
+# backups to. Sections named `job:NAME` each describe a job (settings that
+# override the others, see `job_settings()`) and are returned as `jobs`, and
+# the `daemon` section holds the settings of backup_daemon.py.
 def parse_config_files(files, out):
     config = configparser.SafeConfigParser()
     config_files = config.read(files)
     settings = dict()
     for s in config.sections():
-        for o in config.options(s):
-            #if config.get(s, o) is not None:
-            if o == 'num_backups':
-                try:
-                    settings[o] = config.getint(s, o)
-                except ValueError:
-                    out.error('Invalid int value specified in configuration'
-                        ' file: {0} using 1 instead\n'.format(config.get(s, o)))
-                    settings[o] = 1
+        if s.lower().startswith(('destination:', 'job:')) or s.lower() == 'daemon':
+            d = {o: parse_option(config, s, o, out) for o in config.options(s)}
+            d = {k: v for k, v in d.items() if v is not None}
+            if s.lower().startswith('destination:'):
+                settings.setdefault('destinations', []).append(d)
+            elif s.lower() == 'daemon':
+                settings['daemon'] = d
             else:
-                settings[o] = config.get(s, o)
+                settings.setdefault('jobs', {})[s[len('job:'):]] = d
+            continue
+        for o in config.options(s):
+            settings[o] = parse_option(config, s, o, out)
     # Remove anything with a value of None before returning
     return {k: v for k, v in settings.items() if v is not None}, config_files
 
+## Parses a single option from a configuration file
+#  \param config `configparser` object the configuration files were read into
+#  \param s Section the option is in
+#  \param o Name of the option
+#  \param `backup_printer` to use for output
+#  \returns The option's value converted to the proper type (or None)
+def parse_option(config, s, o, out):
+    if o in int_options:
+        try:
+            return config.getint(s, o)
+        except ValueError:
+            out.error('Invalid int value specified in configuration'
+                ' file: {0} using 1 instead\n'.format(config.get(s, o)))
+            return 1
+    elif o in bool_options:
+        try:
+            return config.getboolean(s, o)
+        except ValueError:
+            out.error('Invalid boolean value specified in configuration'
+                ' file: {0} ignoring it\n'.format(config.get(s, o)))
+            return None
+    elif o in float_options:
+        try:
+            return config.getfloat(s, o)
+        except ValueError:
+            out.error('Invalid float value specified in configuration'
+                ' file: {0} ignoring it\n'.format(config.get(s, o)))
+            return None
+    elif o in list_options:
+        return [x.strip() for x in config.get(s, o).splitlines() if x.strip()]
+    elif o in raw_options:
+        return config.get(s, o, raw=True)
+    return config.get(s, o)
+
+## Settings of a job
+#  \param settings Settings (as returned by `parse_config_files()`)
+#  \param name Name of the job (None for no job)
+#  \returns Settings for `run_backup()`, without the jobs, the daemon's settings
+#  (wherever they are given) and the settings only used to schedule jobs (or
+#  run several of them)
+#
+# The settings of the job's section override the others and the job's name
+# labels its run report (unless `job` is set in its section).
+def job_settings(settings, name):
+    s = {k: v for k, v in settings.items()
+        if k not in ('jobs', 'daemon', 'max_jobs')}
+    if name is not None:
+        if name not in settings.get('jobs', {}):
+            raise KeyError(name)
+        s.update(settings['jobs'][name])
+        s['job'] = settings['jobs'][name].get('job', name)
+    for o in job_options + daemon_options:
+        s.pop(o, None)
+    return s
+
+## Creates a backup and removes old ones
+#  \param settings Settings to construct the `backup_manager` with (plus
+#  `migrate_names`)
+#
+# Raises the `backup_manager`'s exceptions if anything fails. The run report
+# (if any) is written either way.
+def run_backup(settings):
+    settings = dict(settings)
+
+    # Renaming old backups is a separate step, not a backup_manager setting
+    migrate = settings.pop('migrate_names', False)
+
+    # Create a backup object to work with, all of its remote commands share one
+    # ssh connection which is closed when we are done (or something fails)
+    with backup_manager(**settings) as bck:
+
+        if bck.dry_run:
+            settings['printer'].info('Performing a dry run...\n')
+
+        # The run report (if any) is written even if the run fails
+        success = False
+        try:
+            # Make sure we can get to host, check that the destination
+            # directory exists (if this isn't a dry run, have it created) and
+            # list the existing backups, all with a single remote command
+            bck.preflight()
+
+            # Rename backups created by older versions
+            if migrate:
+                bck.migrate_names()
+
+            # Create the new backup
+            bck.create_backup()
+
+            # Get rid of old backups
+            bck.remove_backups()
+            success = True
+        finally:
+            bck.write_reports(success)
+
+## Tunes the transport to the destination(s) of a job
+#  \param settings Settings to construct the `backup_manager` with (plus
+#  `migrate_names`)
+#  \returns Dictionary mapping each destination to its tuning
+def tune_transport(settings):
+    settings = {k: v for k, v in settings.items() if k != 'migrate_names'}
+    with backup_manager(**settings) as bck:
+        if bck.destinations:
+            return bck.tune()
+        return {bck._location(): bck.tune()}
+
+## Reports the space taken by the backups of a job
+#  \param settings Settings to construct the `backup_manager` with (plus
+#  `migrate_names`)
+#  \returns Dictionary mapping each destination to its rows (see
+#  `backup_manager.space_report()`)
+def report_space(settings):
+    settings = {k: v for k, v in settings.items() if k != 'migrate_names'}
+    with backup_manager(**settings) as bck:
+        bck.preflight()
+        if bck.destinations:
+            return bck.space_report()
+        return {bck._location(): bck.space_report()}
+
+## Ends the ssh sessions of jobs
+#  \param jobs Settings of the jobs (as given to `run_backup()`)
+#
+# Only useful for jobs that share a `session_dir`, whose master connections
+# outlive their runs. Jobs whose settings are invalid (so they never ran) are
+# skipped.
+def stop_sessions(jobs):
+    for s in jobs:
+        s = {k: v for k, v in s.items() if k != 'migrate_names'}
+        try:
+            bm = backup_manager(**s)
+        except Exception:
+            continue
+        with bm:
+            bm.stop_master()
+
+## Runs several jobs, a few at a time
+#  \param jobs Dictionary mapping the name of each job to its settings (as given
+#  to `run_backup()`)
+#  \param max_jobs Number of jobs to run at a time
+#  \returns Dictionary mapping the name of each job to a tuple (error, seconds)
+#  where error is None if the job succeeded
+#
+# The jobs share their ssh sessions (one master connection per destination
+# host, see `backup_manager.session_dir`) which are ended once all of them are
+# done. A failing job does not stop the others.
+def run_jobs(jobs, max_jobs=2):
+    session_dir = tempfile.mkdtemp(prefix='backup-ssh-')
+    for s in jobs.values():
+        s.setdefault('session_dir', session_dir)
+
+    def run(name):
+        start = time.monotonic()
+        error = None
+        try:
+            run_backup(jobs[name])
+        except Exception as e:
+            # The backup exceptions carry their message in msg
+            error = getattr(e, 'msg', None) or str(e) or type(e).__name__
+        if error is not None:
+            jobs[name]['printer'].error('Job: {0} failed: {1}\n'.format(name,
+                error.rstrip()))
+        return error, time.monotonic() - start
+
+    try:
+        with ThreadPoolExecutor(max(1, max_jobs)) as pool:
+            return dict(zip(jobs, pool.map(run, jobs)))
+    finally:
+        stop_sessions(jobs.values())
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+## Formats the results of `run_jobs()` as a table
+#  \param results Results as returned by `run_jobs()`
+#  \returns The table, one line per job (in the order of results)
+#
+# Only the last line of an error is shown.
+def format_summary(results):
+    width = max([len('JOB')] + [len(n) for n in results])
+    lines = ['{0:<{w}}  {1:<6}  {2:>8}  {3}'.format('JOB', 'RESULT', 'SECONDS',
+        'ERROR', w=width).rstrip()]
+    for name, (error, seconds) in results.items():
+        if error is not None:
+            error = ([l for l in error.splitlines() if l.strip()] or [''])[-1]
+        lines.append('{0:<{w}}  {1:<6}  {2:>8.1f}  {3}'.format(name,
+            'ok' if error is None else 'FAILED', seconds, error or '',
+            w=width).rstrip())
+    return '\n'.join(lines) + '\n'
+
 ## Create and rotate a backup according to settings
 #
 # Creates a single backup and removes oldest backups according to the settings
@@ -158,38 +508,58 @@ def main():
     # Merge and output the settings and the files read to get them -------------
     # Merge the command line settings with the configuration file settings
     # (command-line overrides configuration values if both specified)
-    settings.update(cl_settings)
+    # (the command line also overrides the settings of jobs)
+    out = cl_settings['printer']
+    names = cl_settings.pop('job_names', None) or sorted(settings.get('jobs', {}))
+    max_jobs = cl_settings.pop('max_jobs', settings.get('max_jobs', 2))
+    tune = cl_settings.pop('tune', False)
+    space = cl_settings.pop('space_report', False)
+    jobs = {}
+    for name in names or [None]:
+        try:
+            s = job_settings(settings, name)
+        except KeyError:
+            out.fatal('No such job: {0}\n'.format(name), 1)
+        s.update(cl_settings)
+        # With replicas the destination can be given by them alone
+        if 'destinations' in s:
+            s.setdefault('host', None)
+            s.setdefault('dest', None)
+        jobs[name] = s
 
     # List any configuration files used before checking settings so if there is
     # an error the user has some recourse to find it
-    settings['printer'].info('Configuration file(s) read: {0}\n'.format(' '.join(cf_read)))
+    out.info('Configuration file(s) read: {0}\n'.format(' '.join(cf_read)))
 
     # Output all settings for debugging (sorted for sanity)
-    settings['printer'].debug('SETTINGS DUMP:\n{0}\n'.format(
-            '\n'.join(sorted(['{0}={1}'.format(x, settings[x]) for x in settings]))
-            )
-            )
+    for name, s in jobs.items():
+        out.debug('SETTINGS DUMP{0}:\n{1}\n'.format(
+                '' if name is None else ' (job: {0})'.format(name),
+                '\n'.join(sorted(['{0}={1}'.format(x, s[x]) for x in s]))
+                )
+                )
 
     # Do work ------------------------------------------------------------------
-
-    # Create a backup object to work with
-    bck = backup_manager(**settings)
-
-    if bck.dry_run:
-        settings['printer'].info('Performing a dry run...\n')
-
-    # Make sure we can get to host
-    bck.check_host()
-
-    # Check that the destination directory exists and if this isn't a dry run,
-    # have it created
-    bck.check_dest()
-
-    # Create the new backup
-    bck.create_backup()
-
-    # Get rid of old backups
-    bck.remove_backups()
+    if tune:
+        for s in jobs.values():
+            for d, t in sorted(tune_transport(s).items()):
+                sys.stdout.write('{0}: {1}, {2} compression, {3:.1f} '
+                    'MB/s\n'.format(d, t['cipher'] or 'default cipher',
+                    t['compression'], t['throughput'] / 1e6))
+        return
+    if space:
+        for s in jobs.values():
+            for d, rows in sorted(report_space(s).items()):
+                sys.stdout.write('{0}:\n{1}'.format(d, format_report(rows)))
+        return
+    # A single backup runs (and fails) on its own
+    if len(jobs) == 1:
+        run_backup(jobs.popitem()[1])
+        return
+    results = run_jobs(jobs, max_jobs)
+    sys.stdout.write(format_summary(results))
+    if any(error is not None for error, seconds in results.values()):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupCatalog import backup_catalog
+from datetime import datetime
+
+################################################################################
+################################################################################
+## Backup Catalog Tests                                                       ##
+## Tests for recording backups and destination generations in the catalog.   ##
+##                                                                            ##
+################################################################################
+################################################################################
+class BackupCatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cat = backup_catalog(os.path.join(self.tmp.name, 'catalog.db'))
+        self.key = ('host', '/dest', '')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stamp(self, name):
+        return datetime.strptime(name, '%m-%d-%Y-%H:%M:%S')
+
+    def test_empty(self):
+        self.assertIsNone(self.cat.generation(self.key))
+        self.assertEqual(self.cat.snapshots(self.key), [])
+
+    def test_add_remove(self):
+        for n in ['01-02-2015-12:00:00', '01-01-2015-12:00:00']:
+            self.cat.add(self.key, n, self.stamp(n))
+        self.cat.add(self.key, '01-03-2015-12:00:00',
+            self.stamp('01-03-2015-12:00:00'), status='partial')
+        # Sorted by timestamp and only complete backups
+        self.assertEqual(self.cat.snapshots(self.key),
+            ['01-01-2015-12:00:00', '01-02-2015-12:00:00'])
+        self.cat.remove(self.key, ['01-01-2015-12:00:00'])
+        self.assertEqual(self.cat.snapshots(self.key), ['01-02-2015-12:00:00'])
+        # Other destinations are unaffected
+        self.assertEqual(self.cat.snapshots(('host', '/other', '')), [])
+
+    def test_update(self):
+        n = '01-01-2015-12:00:00'
+        self.cat.add(self.key, n, self.stamp(n))
+        self.cat.update(self.key, n, 1024, 10)
+        s = self.cat.snapshot(self.key, n)
+        self.assertEqual((s['size'], s['files']), (1024, 10))
+        self.assertIsNone(self.cat.snapshot(self.key, 'missing'))
+
+    def test_reconcile(self):
+        n = '01-01-2015-12:00:00'
+        self.cat.add(self.key, n, self.stamp(n), size=1)
+        self.cat.add(self.key, '01-02-2015-12:00:00',
+            self.stamp('01-02-2015-12:00:00'))
+        self.cat.reconcile(self.key, [n, '01-03-2015-12:00:00'], self.stamp,
+            'abc')
+        self.assertEqual(self.cat.snapshots(self.key),
+            [n, '01-03-2015-12:00:00'])
+        # Known backups keep what was recorded about them
+        self.assertEqual(self.cat.snapshot(self.key, n)['size'], 1)
+        self.assertEqual(self.cat.generation(self.key), 'abc')
+
+    def test_persistent(self):
+        self.cat.set_generation(self.key, 'abc')
+        other = backup_catalog(self.cat.path)
+        self.assertEqual(other.generation(self.key), 'abc')
+        other.set_generation(self.key, None)
+        self.assertIsNone(self.cat.generation(self.key))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupDeleter import backup_deleter, batches, local_deleter
+from backup.BackupPrinter import backup_printer
+
+################################################################################
+################################################################################
+## Deleter Tests                                                              ##
+## Tests for batching and deleting directories (the "remote" scripts are run  ##
+## locally).                                                                  ##
+##                                                                            ##
+################################################################################
+################################################################################
+class BatchesTestCase(unittest.TestCase):
+    def test_size(self):
+        self.assertEqual(batches(['a', 'b', 'c'], 2), [['a', 'b'], ['c']])
+
+    def test_max_bytes(self):
+        self.assertEqual(batches(['aaaa', 'bbbb', 'c'], 10, max_bytes=10),
+            [['aaaa', 'bbbb'], ['c']])
+
+    def test_empty(self):
+        self.assertEqual(batches([], 2), [])
+
+class DeleterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dest = tempfile.mkdtemp()
+        self.scripts = []
+        self.snaps = []
+        for s in range(3):
+            self.snaps.append(os.path.join(self.dest, 'snap{}'.format(s)))
+            for d in range(2):
+                os.makedirs(os.path.join(self.snaps[-1], 'd{}'.format(d)))
+                with open(os.path.join(self.snaps[-1], 'd{}'.format(d), 'f'),
+                        'wb') as f:
+                    f.write(b'x' * 8192)
+        # Still linked from outside of the deleted directories
+        os.link(os.path.join(self.snaps[0], 'd0', 'f'),
+            os.path.join(self.dest, 'keep'))
+
+    def run_script(self, script):
+        self.scripts.append(script)
+        p = subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        return p.returncode, p.stdout.decode(), p.stderr.decode()
+
+    def deleter(self, workers):
+        return backup_deleter(self.run_script, backup_printer(), workers, 2)
+
+    def test_delete(self):
+        inodes, size, errors = self.deleter(2).delete(self.snaps)
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.dest), ['keep'])
+        # 3 snapshots, 6 directories and 5 files that had no other links
+        self.assertEqual(inodes, 14)
+        self.assertGreaterEqual(size, 5 * 8192)
+        self.assertEqual(len(self.scripts), 2)
+
+    def test_delete_subtrees(self):
+        inodes, size, errors = self.deleter(8).delete(self.snaps[:1])
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 4)
+        self.assertFalse(os.access(self.snaps[0], os.F_OK))
+        # Two listings (the snapshot holds single files two levels down), one
+        # batch of subtrees, one for the snapshot itself
+        self.assertEqual(len(self.scripts), 4)
+
+    def test_delete_subtrees_max_depth(self):
+        d = backup_deleter(self.run_script, backup_printer(), 8, 2, max_depth=1)
+        inodes, size, errors = d.delete(self.snaps[:1])
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 4)
+        self.assertEqual(len(self.scripts), 3)
+
+    def test_links_between_deleted(self):
+        # Only linked from another deleted snapshot
+        os.link(os.path.join(self.snaps[1], 'd0', 'f'),
+            os.path.join(self.snaps[2], 'g'))
+        inodes, size, errors = self.deleter(1).delete(self.snaps)
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 14)
+
+    def test_missing(self):
+        inodes, size, errors = self.deleter(2).delete([
+            os.path.join(self.dest, 'missing')])
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 0)
+
+    def test_failed_batch(self):
+        d = self.deleter(1)
+        d._run = lambda script: (1, '', 'failed\n')
+        inodes, size, errors = d.delete(self.snaps)
+        self.assertEqual(errors, ['failed', 'failed'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+class LocalDeleterTestCase(DeleterTestCase):
+    def deleter(self, workers):
+        return local_deleter(backup_printer(), workers, 2)
+
+    def test_delete(self):
+        inodes, size, errors = self.deleter(2).delete(self.snaps)
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.dest), ['keep'])
+        self.assertEqual(inodes, 14)
+        self.assertGreaterEqual(size, 5 * 8192)
+
+    def test_delete_subtrees(self):
+        inodes, size, errors = self.deleter(8).delete(self.snaps[:1])
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 4)
+        self.assertFalse(os.access(self.snaps[0], os.F_OK))
+
+    def test_delete_subtrees_max_depth(self):
+        d = local_deleter(backup_printer(), 8, 2, max_depth=1)
+        inodes, size, errors = d.delete(self.snaps[:1])
+        self.assertEqual(errors, [])
+        self.assertEqual(inodes, 4)
+
+    def test_failed_batch(self):
+        d = self.deleter(1)
+        d._delete_batch = lambda batch: (0, 0, 'failed')
+        inodes, size, errors = d.delete(self.snaps)
+        self.assertEqual(errors, ['failed', 'failed'])
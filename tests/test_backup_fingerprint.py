@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupFingerprint import source_fingerprint, tree_digest
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from unittest.mock import patch
+
+################################################################################
+################################################################################
+## Fingerprint Tests                                                          ##
+## Tests for detecting changes to source directories without rsync.          ##
+##                                                                            ##
+################################################################################
+################################################################################
+class FingerprintTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        os.makedirs(os.path.join(self.src, 'a', 'b'))
+        self.write('a/b/file', 'x')
+        self.write('top', 'y')
+        os.symlink('top', os.path.join(self.src, 'link'))
+        self.fp = source_fingerprint([self.src])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, rel, text):
+        with open(os.path.join(self.src, rel), 'w') as f:
+            f.write(text)
+
+    def test_stable(self):
+        self.assertIsNotNone(self.fp)
+        self.assertEqual(source_fingerprint([self.src], workers=1), self.fp)
+
+    def test_content_changed(self):
+        self.write('a/b/file', 'xx')
+        self.assertNotEqual(source_fingerprint([self.src]), self.fp)
+
+    def test_metadata_changed(self):
+        os.utime(os.path.join(self.src, 'top'), ns=(0, 0))
+        self.assertNotEqual(source_fingerprint([self.src]), self.fp)
+
+    def test_entry_added(self):
+        self.write('a/new', '')
+        self.assertNotEqual(source_fingerprint([self.src]), self.fp)
+
+    def test_extra(self):
+        self.assertNotEqual(source_fingerprint([self.src], ['-az']), self.fp)
+
+    def test_missing_source(self):
+        self.assertIsNone(source_fingerprint([self.src, '/nonexistent/src']))
+        self.assertIsNone(tree_digest('/nonexistent/src'))
+
+################################################################################
+################################################################################
+## Unchanged Sources Tests                                                    ##
+## Tests for skipping rsync when the sources are unchanged since the most     ##
+## recent backup.                                                             ##
+################################################################################
+################################################################################
+class UnchangedSourcesTestCase(unittest.TestCase):
+    old = '2015-01-01T12:00:00'
+    new = '2015-01-02T12:00:00'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        os.makedirs(self.src)
+        os.makedirs(os.path.join(self.dest, self.old))
+        self.bm = backup_manager(self.src, None, self.dest, transport='local',
+            catalog=os.path.join(self.tmp.name, 'catalog.db'),
+            unchanged='redate', printer=backup_printer())
+        self.bm.preflight()
+        self.key = self.bm._catalog_key()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def record(self, fp):
+        self.bm._catalog.update(self.key, self.old, 100, 2)
+        self.bm._catalog.set_fingerprint(self.key, self.old, fp)
+
+    def test_redate(self):
+        self.record(source_fingerprint([self.src], [self.bm.rsync_flags,
+            'False']))
+        with patch.object(self.bm, '_transfer') as mm:
+            self.bm.create_backup(self.new)
+            mm.assert_not_called()
+        self.assertEqual(sorted(os.listdir(self.dest)),
+            ['.generation', self.new, 'latest'])
+        s = self.bm._catalog.snapshot(self.key, self.new)
+        self.assertEqual((s['size'], s['files']), (100, 2))
+        self.assertIsNotNone(s['fingerprint'])
+
+    def test_reuse(self):
+        self.bm.unchanged = 'reuse'
+        self.record(source_fingerprint([self.src], [self.bm.rsync_flags,
+            'False']))
+        with patch.object(self.bm, '_transfer') as mm:
+            self.bm.create_backup(self.new)
+            mm.assert_not_called()
+        self.assertEqual(self.bm.preflight(), [self.old])
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'latest')),
+            self.old)
+
+    def test_changed(self):
+        self.record('stale')
+        with patch.object(self.bm, '_transfer',
+                return_value={self.src: None}) as mm:
+            self.bm.create_backup(self.new)
+            mm.assert_called_once()
+        self.assertEqual(self.bm._catalog.snapshot(self.key,
+            self.new)['fingerprint'], source_fingerprint([self.src],
+            [self.bm.rsync_flags, 'False']))
+
+    def test_bad_action(self):
+        self.bm.unchanged = 'skip'
+        self.assertIsNone(self.bm.unchanged)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupExceptions import JournalError
+from backup.BackupJournal import change_journal, parse_log, source_watcher
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from unittest.mock import patch
+
+################################################################################
+################################################################################
+## Change Journal Tests                                                       ##
+## Tests for recording and taking the changes made to a source.              ##
+##                                                                            ##
+################################################################################
+################################################################################
+class ChangeJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.j = change_journal(os.path.join(self.tmp.name, 'journal'), '/src')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_no_watcher(self):
+        self.assertEqual(self.j.take(), (None, {}))
+
+    def test_take(self):
+        epoch = self.j.start()
+        self.j.record({b'a': 'f', b'b': 'a'})
+        self.j.record({b'b': 'f', b'a': 'a'})
+        self.assertEqual(self.j.take(False), (epoch, {b'a': 'f', b'b': 'f'}))
+        self.assertEqual(self.j.take(), (epoch, {b'a': 'f', b'b': 'f'}))
+        self.assertEqual(self.j.take(), (epoch, {}))
+
+    def test_invalid(self):
+        self.j.start(False)
+        self.assertIsNone(self.j.epoch())
+
+    def test_dead_watcher(self):
+        self.j.start()
+        with open(self.j.path + '.state', 'w') as f:
+            f.write('abc 999999999\n')
+        self.assertIsNone(self.j.epoch())
+
+    def test_log_too_big(self):
+        self.j.max_log = 10
+        epoch = self.j.start()
+        self.j.record({b'some/long/path': 'f'})
+        self.assertNotEqual(self.j.epoch(), epoch)
+        self.assertEqual(self.j.take()[1], {})
+
+    def test_last(self):
+        self.assertIsNone(self.j.last('host:/dest'))
+        self.j.set_last('host:/dest', 'e', 'b', 3)
+        self.assertEqual(self.j.last('host:/dest'), ('e', 'b', 3))
+        self.assertIsNone(self.j.last('host:/other'))
+        self.j.set_last('host:/dest', None)
+        self.assertIsNone(self.j.last('host:/dest'))
+
+    def test_parse_log(self):
+        self.assertEqual(parse_log(b'fx/y\0dx\0ax\0fz\0?bad\0f\0'),
+            {b'x': 'd', b'z': 'f'})
+
+################################################################################
+################################################################################
+## Source Watcher Tests                                                       ##
+## Tests for recording changes with inotify.                                  ##
+##                                                                            ##
+################################################################################
+################################################################################
+class SourceWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        os.makedirs(os.path.join(self.src, 'old', 'sub'))
+        self.write('file')
+        j = change_journal(os.path.join(self.tmp.name, 'journal'), self.src)
+        try:
+            self.w = source_watcher(j, backup_printer())
+        except JournalError:
+            self.skipTest('inotify is not available')
+
+    def tearDown(self):
+        self.w.close()
+        self.tmp.cleanup()
+
+    def write(self, rel):
+        with open(os.path.join(self.src, rel), 'w') as f:
+            f.write('x')
+
+    def changes(self):
+        self.w.read_events()
+        self.w.flush()
+        return self.w.journal.take()[1]
+
+    def test_changes(self):
+        self.write('file')
+        self.write('old/sub/new')
+        os.chmod(os.path.join(self.src, 'old'), 0o700)
+        self.assertEqual(self.changes(), {b'file': 'f', b'old/sub/new': 'f',
+            b'old': 'a'})
+
+    def test_new_directory(self):
+        os.makedirs(os.path.join(self.src, 'new', 'sub'))
+        self.assertEqual(self.changes(), {b'new': 'd'})
+        # The new directories are watched too
+        self.write('new/sub/file')
+        self.assertEqual(self.changes(), {b'new/sub/file': 'f'})
+
+    def test_moved_directory(self):
+        os.rename(os.path.join(self.src, 'old'), os.path.join(self.src, 'moved'))
+        self.write('file2')
+        os.remove(os.path.join(self.src, 'file'))
+        self.assertEqual(self.changes(), {b'old': 'd', b'moved': 'd',
+            b'file': 'f', b'file2': 'f'})
+        self.write('moved/sub/file')
+        self.assertEqual(self.changes(), {b'moved/sub/file': 'f'})
+
+################################################################################
+################################################################################
+## Journal Backup Tests                                                       ##
+## Tests for transferring only the changes recorded in a source's journal.   ##
+##                                                                            ##
+################################################################################
+################################################################################
+class JournalBackupTestCase(unittest.TestCase):
+    old = '2015-01-01T12:00:00'
+    new = '2015-01-02T12:00:00'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        for d in [self.src, os.path.join(self.dest, self.old, 'src', 'dir')]:
+            os.makedirs(d)
+        for f in ['same', 'changed', 'dir/file']:
+            with open(os.path.join(self.dest, self.old, 'src', f), 'w') as f:
+                f.write('x')
+        jdir = os.path.join(self.tmp.name, 'journal')
+        self.bm = backup_manager(self.src, None, self.dest, transport='local',
+            journal=jdir, printer=backup_printer())
+        self.j = change_journal(jdir, self.src)
+        self.epoch = self.j.start()
+        self.j.record({b'changed': 'f', b'dir': 'd', b'dir/file': 'f'})
+        self.bm.preflight()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def create(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.new)
+        return [c[0][0] for c in mm.call_args_list]
+
+    def test_changes(self):
+        self.j.set_last(self.bm._location(), self.epoch, self.old, 0)
+        cmds = self.create()
+        self.assertEqual(len(cmds), 2)
+        self.assertIn('--no-recursive', cmds[0])
+        self.assertIn('-r', cmds[1])
+        self.assertTrue(all(any(x.startswith('--files-from=') for x in c)
+            for c in cmds))
+        # Unchanged files are hard links to the previous backup's
+        new = os.path.join(self.dest, self.new, 'src')
+        self.assertEqual(sorted(os.listdir(new)), ['same'])
+        self.assertTrue(os.path.samefile(os.path.join(new, 'same'),
+            os.path.join(self.dest, self.old, 'src', 'same')))
+        self.assertEqual(self.j.last(self.bm._location()),
+            (self.epoch, self.new, 1))
+
+    def test_unknown_changes(self):
+        self.j.set_last(self.bm._location(), self.epoch, 'other', 0)
+        cmds = self.create()
+        self.assertEqual(len(cmds), 1)
+        self.assertFalse(any(x.startswith('--files-from=') for x in cmds[0]))
+        self.assertEqual(self.j.last(self.bm._location()),
+            (self.epoch, self.new, 0))
+
+    def test_periodic_full_walk(self):
+        self.bm.journal_full_every = 2
+        self.j.set_last(self.bm._location(), self.epoch, self.old, 2)
+        self.assertEqual(len(self.create()), 1)
+
+    def test_too_many_changes(self):
+        self.bm.journal_max = 1
+        self.j.set_last(self.bm._location(), self.epoch, self.old, 0)
+        self.assertEqual(len(self.create()), 1)
+
+    def test_failure_forgets_last(self):
+        self.j.set_last(self.bm._location(), self.epoch, self.old, 0)
+        with patch.object(self.bm, '_run_cmd', return_value=(1, '', 'err')):
+            self.assertRaises(Exception, self.bm.create_backup, self.new)
+        self.assertIsNone(self.j.last(self.bm._location()))
@@ -28,21 +28,25 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import inspect
 import os
 import random
 import shutil
 import sys
+import tempfile
 import time
 import unittest
 
 sys.path.append('../')
 
-from backup.BackupManager import backup_manager
+from backup.BackupManager import backup_manager, staging_prefix
 from backup.BackupPrinter import backup_printer
 from backup.BackupExceptions import *
+from datetime import datetime
 
 # To fake datetime objects for testing
 from testfixtures import Replacer,test_datetime
+import unittest.mock
 from unittest.mock import patch
 
 random.seed(4083)
@@ -238,6 +242,162 @@ class CmdBldingBackupManagerSSHBinKeyTestCase(BackupManagerTestCase):
         self.assertEqual(r[3], '-e')
         self.assertEqual(r[4], 'SSH_BIN -i {}'.format(self.bm.ssh_key))
 
+class CmdBldingBackupManagerSessionTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.bm.open_session()
+
+    def test_ssh_cmd(self):
+        r = self.bm._ssh_cmd()
+        self.assertEqual(r[0], 'ssh')
+        self.assertIn('ControlMaster=auto', r)
+        self.assertIn('ControlPath={}'.format(self.bm._control_path()), r)
+        self.assertEqual(r[-1], self.bm.host)
+
+    def test_rsync_cmd(self):
+        r = self.bm._rsync_cmd()
+        self.assertEqual(r[0], 'rsync')
+        self.assertEqual(r[3], '-e')
+        self.assertIn('ControlPath={}'.format(self.bm._control_path()), r[4])
+
+    def test_close_session(self):
+        d = self.bm._control_dir
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.close_session()
+            self.assertIn('-O', mm.call_args[0][0])
+        self.assertIsNone(self.bm._control_dir)
+        self.assertFalse(os.access(d, os.F_OK))
+        self.assertNotIn('-o', self.bm._ssh_cmd())
+
+    def tearDown(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')):
+            self.bm.close_session()
+
+class CmdBldingPriorityTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+
+    def test_defaults_unchanged(self):
+        r = self.bm._rsync_cmd()
+        self.assertEqual(r[0], 'rsync')
+        self.assertFalse([x for x in r if x.startswith('--bwlimit')])
+
+    def test_priority(self):
+        self.bm.nice = 19
+        self.bm.bwlimit = '10M'
+        with patch('shutil.which', return_value='/usr/bin/ionice'):
+            self.bm.ionice = 'idle'
+            r = self.bm._rsync_cmd()
+        self.assertEqual(r[:6], ['nice', '-n', '19', 'ionice', '-c3', 'rsync'])
+        self.assertIn('--bwlimit=10M', r)
+
+    def test_missing_tools_ignored(self):
+        self.bm.ionice = 'idle'
+        self.bm.nocache = True
+        with patch('shutil.which', return_value=None):
+            self.assertEqual(self.bm._rsync_cmd()[0], 'rsync')
+
+    def test_unknown_ionice_class(self):
+        self.bm.ionice = 'fast'
+        self.assertIsNone(self.bm.ionice)
+
+    def test_throttle_shared_with_replicas(self):
+        self.bm.throttle = True
+        self.bm.destinations = [{'host': 'h1'}, {'host': 'h2', 'bwlimit': 100}]
+        self.assertTrue(all(r._throttle is self.bm._throttle
+            for r in self.bm._replicas()))
+        self.assertEqual(self.bm._replicas()[1].bwlimit, '100')
+
+    def test_rsync_throttled(self):
+        self.bm.throttle = True
+        with patch.object(self.bm._throttle, 'watch') as w, \
+                patch.object(self.bm._throttle, 'unwatch') as u:
+            self.assertEqual(self.bm._run_cmd(['true'], throttled=True)[0], 0)
+            self.assertEqual(self.bm._run_cmd(['true'])[0], 0)
+        self.assertEqual((w.call_count, u.call_count), (1, 1))
+
+class SessionContextManagerTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+
+    def test_context_manager(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            with self.bm as bm:
+                d = bm._control_dir
+                self.assertTrue(os.access(d, os.F_OK))
+            self.assertFalse(os.access(d, os.F_OK))
+            self.assertEqual(mm.call_count, 1)
+
+    def test_context_manager_error(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')):
+            with self.assertRaises(BackupError):
+                with self.bm as bm:
+                    d = bm._control_dir
+                    raise BackupError('failure')
+        self.assertFalse(os.access(d, os.F_OK))
+
+    def test_no_multiplex(self):
+        self.bm.multiplex = False
+        with self.bm as bm:
+            self.assertIsNone(bm._control_dir)
+            self.assertEqual(bm._ssh_cmd(), ['ssh', bm.host])
+
+    def test_shared_session(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.bm.session_dir = d
+            self.bm.session_persist = 3600
+            with patch.object(self.bm, '_run_cmd',
+                    return_value=(0, '', '')) as mm:
+                with self.bm as bm:
+                    r = bm._ssh_cmd()
+                    self.assertIn('ControlPath={}'.format(
+                        os.path.join(d, '%C')), r)
+                    self.assertIn('ControlPersist=3600', r)
+                # The session outlives the object
+                self.assertEqual(mm.call_count, 0)
+                self.assertTrue(os.access(d, os.F_OK))
+                with self.bm as bm:
+                    bm.stop_master()
+                self.assertIn('-O', mm.call_args[0][0])
+
+################################################################################
+################################################################################
+## Run Command Tests                                                          ##
+## Tests related to _run_cmd() streaming and bounding command output.         ##
+##                                                                            ##
+################################################################################
+################################################################################
+class RunCmdTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+
+    def test_full_output(self):
+        res, o, e = self.bm._run_cmd(['sh', '-c', 'echo a; echo b; echo c >&2'])
+        self.assertEqual(res, 0)
+        self.assertEqual(o, 'a\nb\n')
+        self.assertEqual(e, 'c\n')
+
+    def test_exit_status(self):
+        res, o, e = self.bm._run_cmd(['sh', '-c', 'printf partial; exit 3'])
+        self.assertEqual(res, 3)
+        self.assertEqual(o, 'partial\n')
+
+    def test_tail(self):
+        res, o, e = self.bm._run_cmd(['sh', '-c',
+            'i=0; while [ $i -lt 5000 ]; do echo $i; echo e$i >&2; '
+            'i=$((i+1)); done'], tail=3)
+        self.assertEqual(res, 0)
+        self.assertEqual(o, '4997\n4998\n4999\n')
+        self.assertEqual(e, 'e4997\ne4998\ne4999\n')
+
+    def test_lines_forwarded(self):
+        lines = []
+        self.bm.printer = backup_printer(debug=unittest.mock.Mock(
+            write=lines.append))
+        self.bm._run_cmd(['sh', '-c', 'echo a; echo b >&2'], tail=1)
+        self.assertIn('DEBUG: OUT : a\n', lines)
+        self.assertIn('DEBUG: ERR : b\n', lines)
+
 ################################################################################
 ################################################################################
 ## Check Host Tests                                                           ##
@@ -312,6 +472,98 @@ class CheckDestTestCase(BackupManagerTestCase):
         self.cleanup_test_src_dir()
         self.cleanup_test_dest_dir()
 
+################################################################################
+################################################################################
+## Preflight Tests                                                            ##
+## Tests related to the preflight() function and the cached list of backups   ##
+## it produces (remote replies are mocked).                                   ##
+##                                                                            ##
+################################################################################
+################################################################################
+class PreflightTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+
+    def probe_reply(self, listing=[], **status):
+        lines = ['{}={}'.format(k, v) for k, v in status.items()]
+        return (0, '\n'.join(lines + ['--'] + listing) + '\n', '')
+
+    def test_single_round_trip(self):
+        reply = self.probe_reply(['2015-01-01T11:00:00', 'junk'], exists=1,
+            writable=1)
+        with patch.object(self.bm, '_run_cmd', return_value=reply) as mm:
+            self.assertEqual(self.bm.preflight(), ['2015-01-01T11:00:00'])
+            self.assertEqual(mm.call_count, 1)
+
+    def test_unreachable(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(255, '', 'err')):
+            self.assertRaises(HostError, self.bm.preflight)
+
+    def test_dest_created(self):
+        reply = self.probe_reply(exists=0, created=1, writable=1)
+        with patch.object(self.bm, '_run_cmd', return_value=reply) as mm:
+            self.assertEqual(self.bm.preflight(), [])
+            self.assertIn('mkdir -p', mm.call_args[0][0][-1])
+
+    def test_dest_create_fail(self):
+        reply = self.probe_reply(exists=0, created=0, writable=0)
+        with patch.object(self.bm, '_run_cmd', return_value=reply):
+            self.assertRaises(DestDirError, self.bm.preflight)
+
+    def test_dest_not_writable(self):
+        reply = self.probe_reply(exists=1, writable=0)
+        with patch.object(self.bm, '_run_cmd', return_value=reply):
+            self.assertRaises(DestDirError, self.bm.preflight)
+
+    def test_dest_missing_dry_run(self):
+        self.bm.dry_run = True
+        reply = self.probe_reply(exists=0, writable=0)
+        with patch.object(self.bm, '_run_cmd', return_value=reply) as mm:
+            self.assertEqual(self.bm.preflight(), [])
+            self.assertNotIn('mkdir', mm.call_args[0][0][-1])
+
+    def test_catalog_skips_listing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.bm.catalog = os.path.join(tmp, 'catalog.db')
+            reply = self.probe_reply(['2015-01-01T11:00:00'], exists=1,
+                writable=1, generation='abc')
+            with patch.object(self.bm, '_run_cmd', return_value=reply):
+                self.bm.preflight()
+            self.assertEqual(self.bm._catalog.generation(
+                self.bm._catalog_key()), 'abc')
+            # Same generation, the destination isn't listed again
+            reply = self.probe_reply(exists=1, writable=1, generation='abc',
+                listed=0)
+            with patch.object(self.bm, '_run_cmd', return_value=reply) as mm:
+                self.assertEqual(self.bm.preflight(), ['2015-01-01T11:00:00'])
+                self.assertIn("= abc ]", mm.call_args[0][0][-1])
+            # Our own changes keep the catalog up to date
+            with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')):
+                self.bm.create_backup()
+            self.assertEqual(self.bm._catalog.snapshots(self.bm._catalog_key()),
+                ['2015-01-01T11:00:00', '2015-01-01T12:00:00'])
+            self.assertNotEqual(self.bm._catalog.generation(
+                self.bm._catalog_key()), 'abc')
+
+    def test_cache_updated_by_create_and_remove(self):
+        self.bm.num_backups = 1
+        reply = self.probe_reply(['2015-01-01T11:00:00'], exists=1, writable=1)
+        with patch.object(self.bm, '_run_cmd', return_value=reply):
+            self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup()
+            self.assertEqual(self.bm._dest_backups(),
+                ['2015-01-01T11:00:00', '2015-01-01T12:00:00'])
+            self.assertEqual(self.bm.remove_backups(), 1)
+            self.assertEqual(self.bm._dest_backups(), ['2015-01-01T12:00:00'])
+            # One mkdir, rsync and rename (of the staging directory) and one
+            # rm (each followed by a generation marker update), no listings
+            self.assertEqual(mm.call_count, 6)
+
+    def tearDown(self):
+        self.restore_datetime()
+
 ################################################################################
 ################################################################################
 ## List Backups Tests                                                         ##
@@ -337,7 +589,7 @@ class ListDestBackupsTestCase(BackupManagerTestCase):
         for i in range(self.bm.num_backups):
             self.bm.create_backup()
         self.assertEqual(self.bm.list_dest_backups(),
-            ['01-01-2015-12:00:00', '01-01-2015-12:00:01'])
+            ['2015-01-01T12:00:00', '2015-01-01T12:00:01'])
 
     def test_dest_dir_mixed_content(self):
         self.bm.prefix = 'test-'
@@ -346,7 +598,7 @@ class ListDestBackupsTestCase(BackupManagerTestCase):
         self.create_named_files(self.bm.dest, [self.bm.prefix])
         self.create_random_files(self.bm.dest, 3)
         self.assertEqual(self.bm.list_dest_backups(),
-            ['test-01-01-2015-12:00:00', 'test-01-01-2015-12:00:01',])
+            ['test-2015-01-01T12:00:00', 'test-2015-01-01T12:00:01',])
 
     def tearDown(self):
         self.cleanup_test_dest_dir()
@@ -369,9 +621,9 @@ class MostRecentBackupTestCase(BackupManagerTestCase):
 
     def test_backup_list_populated(self):
         self.assertEqual(self.bm.most_recent_backup(
-            ['01-01-2015-12:00:00', '01-01-2015-12:00:01'
-            '01-01-2015-12:00:02', '01-01-2015-12:00:03']
-        ), '01-01-2015-12:00:03')
+            ['2015-01-01T12:00:00', '2015-01-01T12:00:01'
+            '2015-01-01T12:00:02', '2015-01-01T12:00:03']
+        ), '2015-01-01T12:00:03')
 
 ################################################################################
 ################################################################################
@@ -409,7 +661,7 @@ class CreateBackupTestCase(BackupManagerTestCase):
     def test_empty_dest_dir(self):
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00'])
+        self.assertEqual(ret, ['2015-01-01T12:00:00'])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -427,8 +679,8 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret,
-            ['01-01-2015-12:00:00', '01-01-2015-12:00:01',
-            '01-01-2015-12:00:02',]
+            ['2015-01-01T12:00:00', '2015-01-01T12:00:01',
+            '2015-01-01T12:00:02',]
         )
         for d in ret:
             self.check_backup_dir(d)
@@ -440,8 +692,8 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret,
-            ['01-01-2015-12:00:00', '01-01-2015-12:00:01',
-            '01-01-2015-12:00:02', '01-01-2015-12:00:03',
+            ['2015-01-01T12:00:00', '2015-01-01T12:00:01',
+            '2015-01-01T12:00:02', '2015-01-01T12:00:03',
             ]
         )
         for d in ret:
@@ -456,8 +708,8 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret,
-            ['test-01-01-2015-12:00:00', 'test-01-01-2015-12:00:01',
-            'test-01-01-2015-12:00:02',]
+            ['test-2015-01-01T12:00:00', 'test-2015-01-01T12:00:01',
+            'test-2015-01-01T12:00:02',]
         )
         for d in ret:
             self.check_backup_dir(d)
@@ -468,7 +720,7 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         self.assertRaises(BackupError, self.bm.create_backup)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00',])
+        self.assertEqual(ret, ['2015-01-01T12:00:00',])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -480,29 +732,34 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret,
-            ['01-01-2015-12:00:00', '01-01-2015-12:00:01',
-            '01-01-2015-12:00:02', '01-01-2015-12:00:03',
-            '01-01-2015-12:00:04',]
+            ['2015-01-01T12:00:00', '2015-01-01T12:00:01',
+            '2015-01-01T12:00:02', '2015-01-01T12:00:03',
+            '2015-01-01T12:00:04',]
         )
         for d in ret:
             self.check_backup_dir(d)
 
+    # Path of an exclude file in a directory removed after the test
+    def exclude_path(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        return os.path.join(tmp.name, 'test_exclude')
+
     def test_exclude_file(self):
-        self.bm.exclude = os.path.join(os.getcwd(), 'test_exclude')
+        self.bm.exclude = self.exclude_path()
         with open(self.bm.exclude, 'w') as f:
             f.write('rand_3\n')
             f.write('rand_4\n')
         self.bm.create_backup()
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00'])
+        self.assertEqual(ret, ['2015-01-01T12:00:00'])
         files = sorted(os.listdir(os.path.join(self.bm.dest, ret[0], 'test_src')))
         self.assertEqual(files, ['rand_0', 'rand_1', 'rand_2',])
-        os.remove(self.bm.exclude)
 
     # FIXME: Not implemented yet!
     @unittest.skip
     def test_exclude_logging(self):
-        self.bm.exclude = os.path.join(os.getcwd(), 'test_exclude')
+        self.bm.exclude = self.exclude_path()
         with open(self.bm.exclude, 'w') as f:
             f.write('rand_3\n')
             f.write('rand_4\n')
@@ -513,12 +770,11 @@ class CreateBackupTestCase(BackupManagerTestCase):
         files = sorted(os.listdir(os.path.join(backup, 'test_src')))
         self.assertEqual(files, ['rand_0', 'rand_1', 'rand_2',])
         files = os.listdir(backup)
-        self.assertIn('01-01-2015-12:00:00.excluded', files)
+        self.assertIn('2015-01-01T12:00:00.excluded', files)
         # Check content of excluded file to make sure it listed everything
-        os.remove(self.bm.exclude)
 
     def test_exclude_doesnt_exist(self):
-        self.bm.exclude = os.path.join(os.getcwd(), 'test_exclude')
+        self.bm.exclude = self.exclude_path()
         self.assertRaises(RsyncError, self.bm.create_backup)
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret, [])
@@ -528,6 +784,397 @@ class CreateBackupTestCase(BackupManagerTestCase):
         self.cleanup_test_src_dir()
         self.restore_datetime()
 
+class CreateBackupMultiSourceTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+        self.bm.src = ['/data/a', '/data/b', '/other/c/']
+        self.bm._backups_cache = ['2015-01-01T11:00:00']
+        self.cmds = []
+
+    # Fake remote: every rsync of a source in `fail` fails
+    def fake_run_cmd(self, fail=()):
+        def run(cmd, tail=None, throttled=False, on_line=None):
+            self.cmds.append(cmd)
+            if cmd[0] == 'rsync' and cmd[-2] in fail:
+                return 23, '', 'rsync failed\n'
+            return 0, '', ''
+        return run
+
+    def rsyncs(self):
+        return [x for x in self.cmds if x[0] == 'rsync']
+
+    def test_all_sources_transferred(self):
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd()):
+            res = self.bm.create_backup()
+        self.assertEqual(res, {x: None for x in self.bm.src})
+        self.assertIn('mkdir -p', self.cmds[0][-1])
+        self.assertEqual(sorted(x[-2] for x in self.rsyncs()), sorted(self.bm.src))
+        for x in self.rsyncs():
+            self.assertIn('--link-dest={}'.format(
+                os.path.join(self.bm.dest, '2015-01-01T11:00:00')), x)
+            self.assertTrue(x[-1].endswith('2015-01-01T12:00:00'))
+        self.assertEqual(self.bm._dest_backups(),
+            ['2015-01-01T11:00:00', '2015-01-01T12:00:00'])
+
+    def test_failed_source_reported(self):
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd(['/data/b'])):
+            with self.assertRaises(RsyncError) as cm:
+                self.bm.create_backup()
+        self.assertIn('1/3', cm.exception.msg)
+        self.assertIn('/data/b', cm.exception.msg)
+        self.assertEqual(len(self.rsyncs()), 3)
+        self.assertEqual(self.bm._dest_backups(), ['2015-01-01T11:00:00'])
+
+    def test_duplicate_names(self):
+        self.bm.src = ['/data/a', '/other/a']
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd()):
+            self.assertRaises(BackupError, self.bm.create_backup)
+        self.assertEqual(self.cmds, [])
+
+    def test_dry_run_no_mkdir(self):
+        self.bm.dry_run = True
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd()):
+            self.bm.create_backup()
+        self.assertEqual(len(self.cmds), 3)
+        self.assertEqual(len(self.rsyncs()), 3)
+
+    def tearDown(self):
+        self.restore_datetime()
+
+class CreateBackupShardedTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+        self.create_test_src_dir(rand_files=4)
+        for d in ('a', 'b'):
+            self.create_test_src_dir(os.path.join(self.bm.src, d), rand_files=2)
+        self.bm.shards = 3
+        self.bm.shard_weight = 'count'
+        self.bm._backups_cache = ['2015-01-01T11:00:00']
+        self.cmds = []
+        self.shards = []
+        self.fail = 0
+
+    # Fake remote: records shard file lists, the first `self.fail` shards fail
+    def fake_run_cmd(self, cmd, tail=None, throttled=False, on_line=None):
+        self.cmds.append(cmd)
+        files = [x for x in cmd if x.startswith('--files-from=')]
+        if files:
+            with open(files[0].split('=', 1)[1], 'rb') as f:
+                self.shards.append(sorted(f.read().decode().split('\0')[:-1]))
+            if self.fail > 0:
+                self.fail -= 1
+                return 23, '', 'shard failed\n'
+        return 0, '', ''
+
+    def test_sharded_transfer(self):
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd):
+            self.bm.create_backup()
+        self.assertEqual(self.cmds[0][-1].count('mkdir -p'), 1)
+        self.assertIn('test_src', self.cmds[0][-1])
+        self.assertEqual(len(self.shards), 3)
+        self.assertEqual(sorted(sum(self.shards, [])), sorted(
+            os.path.join('test_src', x) for x in os.listdir(self.bm.src)))
+        for c in self.cmds[1:4]:
+            self.assertEqual(c[-2], os.getcwd())
+            self.assertIn('--link-dest={}'.format(
+                os.path.join(self.bm.dest, '2015-01-01T11:00:00')), c)
+        # Top directory last, then the staging directory is renamed and the
+        # generation marker updated
+        self.assertIn('--no-recursive', self.cmds[-3])
+        self.assertIn(staging_prefix, self.cmds[-2][-1])
+        self.assertIn('.generation', self.cmds[-1][-1])
+        self.assertEqual(self.bm._dest_backups()[-1], '2015-01-01T12:00:00')
+
+    def test_retry_failed_shards(self):
+        self.fail = 1
+        self.bm.shard_retries = 1
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd):
+            self.bm.create_backup()
+        self.assertEqual(len(self.shards), 4)
+
+    def test_failed_shard(self):
+        self.fail = 1
+        with patch.object(self.bm, '_run_cmd', self.fake_run_cmd):
+            self.assertRaises(RsyncError, self.bm.create_backup)
+        self.assertNotIn('--no-recursive', self.cmds[-1])
+        self.assertEqual(self.bm._dest_backups(), ['2015-01-01T11:00:00'])
+
+    def tearDown(self):
+        self.cleanup_test_src_dir()
+        self.restore_datetime()
+
+class CreateBackupLinkDestTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+        self.bm._backups_cache = ['2014-12-01T00:00:00', '2014-12-31T00:00:00',
+            '2015-01-01T06:00:00', '2015-01-01T11:00:00']
+        self.cmds = []
+
+    def run_cmd(self, cmd, tail=None, throttled=False, on_line=None):
+        self.cmds.append(cmd)
+        return 0, '', ''
+
+    def link_dests(self):
+        rsync = [x for x in self.cmds if x[0] == 'rsync'][0]
+        return [x.split('=', 1)[1] for x in rsync
+            if x.startswith('--link-dest=')]
+
+    def test_most_recent(self):
+        self.bm.link_dests = 3
+        with patch.object(self.bm, '_run_cmd', self.run_cmd):
+            self.bm.create_backup()
+        self.assertEqual(self.link_dests(), [os.path.join(self.bm.dest, x)
+            for x in ('2015-01-01T11:00:00', '2015-01-01T06:00:00',
+            '2014-12-31T00:00:00')])
+
+    def test_tiers(self):
+        self.bm.link_dest_tiers = True
+        self.bm.keep_monthly = 2
+        with patch.object(self.bm, '_run_cmd', self.run_cmd):
+            self.bm.create_backup()
+        # The oldest backup the monthly bucket keeps (end of December)
+        self.assertEqual(self.link_dests(), [os.path.join(self.bm.dest, x)
+            for x in ('2015-01-01T11:00:00', '2014-12-31T00:00:00')])
+
+    def test_stats_only_with_extra_link_dests(self):
+        self.bm.link_dest_stats = True
+        with patch.object(self.bm, '_run_cmd', self.run_cmd):
+            self.bm.create_backup()
+        self.assertNotIn('-ii', self.cmds[1])
+        self.bm.link_dests = 2
+        self.cmds = []
+        with patch.object(self.bm, '_run_cmd', self.run_cmd):
+            self.bm.create_backup()
+        self.assertIn('-ii', self.cmds[1])
+
+    def test_invalid(self):
+        self.bm.link_dests = 0
+        self.assertEqual(self.bm.link_dests, 1)
+        self.bm.link_dests = 50
+        self.assertEqual(self.bm.link_dests, 20)
+
+    def tearDown(self):
+        self.restore_datetime()
+
+################################################################################
+################################################################################
+## Staging Tests                                                              ##
+## Tests related to transferring backups into staging directories and         ##
+## resuming interrupted ones (rsync is mocked, dest is local).                ##
+################################################################################
+################################################################################
+class CreateBackupStagingTestCase(unittest.TestCase):
+    name = '2015-01-01T12:00:00'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        os.makedirs(self.src)
+        os.makedirs(os.path.join(self.dest, '2015-01-01T06:00:00'))
+        for b in ('2015-01-01T08:00:00', '2015-01-01T09:00:00'):
+            os.makedirs(os.path.join(self.dest, staging_prefix + b, 'src'))
+            with open(os.path.join(self.dest, staging_prefix + b, 'src', 'f'),
+                    'w') as f:
+                f.write(b)
+        self.bm = backup_manager(self.src, None, self.dest, transport='local',
+            catalog=os.path.join(self.tmp.name, 'catalog.db'),
+            printer=backup_printer(None, None, None, None, None))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_interrupted_not_listed(self):
+        self.assertEqual(self.bm.preflight(), ['2015-01-01T06:00:00'])
+        self.assertEqual(self.bm._staging, ['2015-01-01T08:00:00',
+            '2015-01-01T09:00:00'])
+
+    def test_resume(self):
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.name)
+        self.assertIn('--partial-dir=.rsync-partial', mm.call_args[0][0])
+        # The most recent interrupted backup became the new one
+        with open(os.path.join(self.dest, self.name, 'src', 'f')) as f:
+            self.assertEqual(f.read(), '2015-01-01T09:00:00')
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.generation',
+            '2015-01-01T06:00:00', self.name, 'latest'])
+        self.assertEqual(self.bm._dest_backups(), ['2015-01-01T06:00:00',
+            self.name])
+
+    def test_failure_left_staged(self):
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(23, '', 'err')):
+            self.assertRaises(RsyncError, self.bm.create_backup, self.name)
+        self.assertTrue(os.path.isdir(os.path.join(self.dest,
+            staging_prefix + self.name)))
+        # Found by the next run through the catalog without a listing
+        with patch.object(self.bm._transport, 'listdir') as mm:
+            self.assertEqual(self.bm.preflight(), ['2015-01-01T06:00:00'])
+            mm.assert_not_called()
+        self.assertEqual(self.bm._staging, [self.name])
+
+    def test_resume_deletes(self):
+        self.bm.exclude = os.path.join(self.tmp.name, 'exclude')
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.name)
+        self.assertIn('--delete', mm.call_args[0][0])
+        self.assertIn('--delete-excluded', mm.call_args[0][0])
+
+    def test_new_backup_no_delete(self):
+        shutil.rmtree(os.path.join(self.dest, staging_prefix +
+            '2015-01-01T08:00:00'))
+        shutil.rmtree(os.path.join(self.dest, staging_prefix +
+            '2015-01-01T09:00:00'))
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.name)
+        self.assertNotIn('--delete', mm.call_args[0][0])
+
+    @unittest.skipUnless(shutil.which('rsync'), 'needs rsync')
+    def test_resume_deleted_from_source(self):
+        # The staged src/f is no longer in the source
+        self.bm.preflight()
+        self.bm.create_backup(self.name)
+        self.assertEqual(os.listdir(os.path.join(self.dest, self.name, 'src')),
+            [])
+
+    # Resumes with the contents of a second source stored in the backup itself
+    def mixed_sources(self):
+        other = os.path.join(self.tmp.name, 'other')
+        os.makedirs(other)
+        for path in (os.path.join(other, 'g'), os.path.join(self.src, 'h')):
+            with open(path, 'w') as f:
+                f.write('x')
+        self.bm.src = [other + '/', self.src]
+
+    def test_resume_mixed_protects(self):
+        self.mixed_sources()
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.name)
+        rsyncs = {c[0][0][-2]: c[0][0] for c in mm.call_args_list
+            if c[0][0][0] == 'rsync'}
+        self.assertIn('--filter=P /src/',
+            rsyncs[os.path.join(self.tmp.name, 'other') + '/'])
+        self.assertFalse(any(x.startswith('--filter')
+            for x in rsyncs[self.src]))
+
+    @unittest.skipUnless(shutil.which('rsync'), 'needs rsync')
+    def test_resume_mixed_sources(self):
+        self.mixed_sources()
+        self.bm.preflight()
+        self.bm.create_backup(self.name)
+        backup = os.path.join(self.dest, self.name)
+        self.assertTrue(os.path.isfile(os.path.join(backup, 'g')))
+        self.assertEqual(os.listdir(os.path.join(backup, 'src')), ['h'])
+
+    def test_no_resume_in_place(self):
+        self.bm.rsync_flags = '-a --inplace'
+        self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup(self.name)
+        self.assertFalse(any(x.startswith('--partial-dir') or x == '--delete'
+            for x in mm.call_args[0][0]))
+        # The interrupted backups (hard-linked to older ones) were deleted
+        # rather than updated in place
+        self.assertFalse(os.path.exists(os.path.join(self.dest, self.name,
+            'src', 'f')))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.generation',
+            '2015-01-01T06:00:00', self.name, 'latest'])
+
+################################################################################
+################################################################################
+## Replication Tests                                                          ##
+## Tests related to replicating backups to several destinations (remote       ##
+## commands are mocked).                                                      ##
+##                                                                            ##
+################################################################################
+################################################################################
+class ReplicationTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+        self.bm.destinations = [{'host': 'h1', 'num_backups': 1},
+            {'host': 'h2', 'user': 'u', 'dest': '/other'}]
+        self.cmds = []
+
+    # Fake remote: every destination has one backup, h2 fails if `fail`
+    def fake_run_cmd(self, fail=False):
+        def run(bm, cmd, tail=None, throttled=False, on_line=None):
+            self.cmds.append((bm.host, cmd))
+            if fail and bm.host == 'h2':
+                return 255, '', 'unreachable'
+            return 0, 'exists=1\nwritable=1\n--\n2015-01-01T11:00:00\n', ''
+        return patch.object(backup_manager, '_run_cmd', autospec=True,
+            side_effect=run)
+
+    def test_replica_settings(self):
+        r1, r2 = self.bm._replicas()
+        self.assertEqual((r1.host, r1.dest, r1.num_backups), ('h1', self.bm.dest, 1))
+        self.assertEqual((r2.host, r2.dest, r2.user), ('h2', '/other', 'u'))
+        self.assertEqual(r2.num_backups, self.bm.num_backups)
+
+    def test_replicas_get_every_setting(self):
+        self.bm.throttle = True
+        self.bm.throttle_load = 2.5
+        self.bm.throttle_latency = 10.0
+        self.bm.report_json = '/tmp/report.json'
+        self.bm.report_prom = '/tmp/report.prom'
+        self.bm.link_dest_stats = True
+        r1, r2 = self.bm._replicas()
+        own = set(self.bm.destinations[0]) | {'destinations', 'throttle'}
+        for p in inspect.signature(backup_manager).parameters:
+            if p not in own:
+                self.assertEqual(getattr(r1, p), getattr(self.bm, p), p)
+        self.assertIsNone(r1.destinations)
+        # One throttle watches the transfers to every destination
+        self.assertIs(r1._throttle, self.bm._throttle)
+        self.assertIs(r2._throttle, self.bm._throttle)
+
+    def test_unknown_setting(self):
+        with self.assertRaises(BackupError):
+            self.bm.destinations = [{'host': 'h1', 'bogus': 1}]
+
+    def test_fan_out(self):
+        with self.fake_run_cmd():
+            self.assertEqual(self.bm.preflight(), {
+                'h1:{}'.format(self.bm.dest): ['2015-01-01T11:00:00'],
+                'u@h2:/other': ['2015-01-01T11:00:00']})
+            res = self.bm.create_backup()
+            self.assertEqual(len(res), 2)
+            self.assertEqual(self.bm.remove_backups(), {
+                'h1:{}'.format(self.bm.dest): 1, 'u@h2:/other': 0})
+        rsyncs = [c for h, c in self.cmds if c[0] == 'rsync']
+        self.assertEqual(len(rsyncs), 2)
+        self.assertEqual(sorted(c[-1] for c in rsyncs),
+            ['h1:{}'.format(os.path.join(self.bm.dest, staging_prefix +
+            '2015-01-01T12:00:00')), 'u@h2:/other/{0}2015-01-01T12:00:00'.format(
+            staging_prefix)])
+
+    def test_failed_destination(self):
+        with self.fake_run_cmd(fail=True):
+            with self.assertRaises(BackupError) as cm:
+                self.bm.preflight()
+        self.assertIn('1/2', cm.exception.msg)
+        self.assertIn('u@h2:/other', cm.exception.msg)
+        self.assertEqual(sorted(h for h, c in self.cmds), ['h1', 'h2'])
+
+    def test_sessions(self):
+        with self.fake_run_cmd():
+            with self.bm:
+                for r in self.bm._replicas():
+                    self.assertIsNotNone(r._control_dir)
+            for r in self.bm._replicas():
+                self.assertIsNone(r._control_dir)
+
+    def tearDown(self):
+        self.restore_datetime()
+
 ################################################################################
 ################################################################################
 ## Remove Backups Tests                                                       ##
@@ -559,7 +1206,7 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
         self.bm.create_backup()
         self.assertEqual(self.bm.remove_backups(), 0)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00',])
+        self.assertEqual(ret, ['2015-01-01T12:00:00',])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -568,7 +1215,7 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
             self.bm.create_backup()
         self.assertEqual(self.bm.remove_backups(), 0)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00','01-01-2015-12:00:01'])
+        self.assertEqual(ret, ['2015-01-01T12:00:00','2015-01-01T12:00:01'])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -577,7 +1224,7 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
             self.bm.create_backup()
         self.assertEqual(self.bm.remove_backups(), 1)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:01','01-01-2015-12:00:02'])
+        self.assertEqual(ret, ['2015-01-01T12:00:01','2015-01-01T12:00:02'])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -587,7 +1234,7 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
             self.bm.create_backup()
         self.assertEqual(self.bm.remove_backups(), bcks - self.bm.num_backups)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:08', '01-01-2015-12:00:09',])
+        self.assertEqual(ret, ['2015-01-01T12:00:08', '2015-01-01T12:00:09',])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -600,7 +1247,7 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
         self.assertEqual(self.bm.remove_backups(), 0)
         ret = self.bm.list_dest_backups()
         self.assertEqual(ret,
-            ['test-01-01-2015-12:00:00', 'test-01-01-2015-12:00:01',]
+            ['test-2015-01-01T12:00:00', 'test-2015-01-01T12:00:01',]
         )
         for d in ret:
             self.check_backup_dir(d)
@@ -617,8 +1264,8 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
         self.bm.dry_run = True
         self.assertEqual(self.bm.remove_backups(), 0)
         ret = self.bm.list_dest_backups()
-        self.assertEqual(ret, ['01-01-2015-12:00:00', '01-01-2015-12:00:01',
-            '01-01-2015-12:00:02', '01-01-2015-12:00:03',])
+        self.assertEqual(ret, ['2015-01-01T12:00:00', '2015-01-01T12:00:01',
+            '2015-01-01T12:00:02', '2015-01-01T12:00:03',])
         for d in ret:
             self.check_backup_dir(d)
 
@@ -626,3 +1273,224 @@ class RemoveBackupsTestCase(BackupManagerTestCase):
         self.cleanup_test_dest_dir()
         self.cleanup_test_src_dir()
         self.restore_datetime()
+
+class RemoveBackupsTrashTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.create_test_dest_dir()
+        self.backups = ['2015-01-01T12:00:0{}'.format(i) for i in range(4)]
+        for b in self.backups:
+            os.makedirs(os.path.join(self.bm.dest, b, 'test_src'))
+        self.bm._backups_cache = list(self.backups)
+        # Run the "remote" commands locally
+        self.bm._ssh_cmd = lambda: ['sh', '-c']
+
+    def test_moved_to_trash(self):
+        self.assertEqual(self.bm.remove_backups(), 2)
+        self.assertEqual(self.bm._dest_backups(), self.backups[2:])
+        self.assertEqual(sorted(os.listdir(self.bm.dest)),
+            ['.generation', '.trash'] + self.backups[2:])
+        # Deletion happens in the background
+        for i in range(50):
+            if not os.listdir(os.path.join(self.bm.dest, '.trash')):
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(os.path.join(self.bm.dest, '.trash')), [])
+
+    def test_sync_prune(self):
+        self.bm.async_prune = False
+        self.assertEqual(self.bm.remove_backups(), 2)
+        self.assertEqual(sorted(os.listdir(self.bm.dest)),
+            ['.generation'] + self.backups[2:])
+
+    def test_batched_moves(self):
+        self.bm.delete_batch = 1
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.assertEqual(self.bm.remove_backups(), 2)
+            # Two moves and the generation marker update
+            self.assertEqual(mm.call_count, 3)
+            self.assertIn('nohup', mm.call_args_list[1][0][0][-1])
+
+    def test_move_failed(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(1, '', 'err')):
+            self.bm.remove_backups()
+        self.assertIsNone(self.bm._backups_cache)
+
+    def tearDown(self):
+        self.cleanup_test_dest_dir()
+
+class RemoveBackupsRetentionTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.bm.num_backups = 1
+        self.bm.keep_daily = 2
+        self.bm._backups_cache = ['2015-01-01T12:00:00', '2015-01-02T06:00:00',
+            '2015-01-02T12:00:00', '2015-01-03T06:00:00', '2015-01-03T12:00:00']
+
+    def test_daily(self):
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.assertEqual(self.bm.remove_backups(), 3)
+        self.assertEqual(self.bm._dest_backups(),
+            ['2015-01-02T12:00:00', '2015-01-03T12:00:00'])
+
+    def test_all_kept(self):
+        self.bm.keep_daily = 3
+        self.bm.keep_hourly = 5
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.assertEqual(self.bm.remove_backups(), 0)
+            self.assertEqual(mm.call_count, 0)
+
+################################################################################
+################################################################################
+## Backup Naming Tests                                                        ##
+## Tests for generating, parsing and migrating backup names and for the       ##
+## latest link.                                                               ##
+################################################################################
+################################################################################
+class BackupNamingTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+
+    def test_default_format_sorts(self):
+        self.assertEqual(self.bm._generate_backup_name(), '2015-01-01T12:00:00')
+        names = ['2015-01-02T00:00:00', '2014-12-31T23:59:59',
+            '2015-01-01T12:00:00']
+        self.assertEqual(self.bm._sort_backup_names(list(names)), sorted(names))
+
+    def test_legacy_names(self):
+        self.bm.prefix = 'test-'
+        names = ['test-2015-01-02T00:00:00', 'test-12-31-2014-23:59:59',
+            'test-latest', 'test-01-01-2015-12:00:00.excluded', 'other']
+        self.assertEqual(self.bm._filter_backups(names),
+            ['test-12-31-2014-23:59:59', 'test-2015-01-02T00:00:00'])
+        self.assertEqual(self.bm._backup_timestamp('test-12-31-2014-23:59:59'),
+            datetime(2014, 12, 31, 23, 59, 59))
+
+    def test_prefix_is_literal(self):
+        # Neither a regex nor a set of characters to strip
+        self.bm.prefix = '1.2-'
+        self.assertEqual(self.bm._filter_backups(['1.2-2015-01-01T12:00:00',
+            '1x2-2015-01-01T12:00:00', '2015-01-01T12:00:00']),
+            ['1.2-2015-01-01T12:00:00'])
+        self.assertEqual(self.bm._backup_timestamp('1.2-2015-01-01T12:00:00'),
+            datetime(2015, 1, 1, 12, 0, 0))
+
+    def test_custom_format(self):
+        self.bm.name_format = '%Y%m%d-%H%M'
+        self.assertEqual(self.bm._generate_backup_name(), '20150101-1200')
+        self.assertEqual(self.bm._filter_backups(['20150101-1200',
+            '01-01-2015-11:00:00', '2015-01-01T12:00:00']),
+            ['01-01-2015-11:00:00', '20150101-1200'])
+
+    def test_unsupported_format(self):
+        for f in ('%Y-%m-%d %a', '%Y/%m/%d', '%H:%M:%S', '%Y-%m-%d-%d'):
+            self.bm.name_format = f
+            self.assertEqual(self.bm.name_format, '%Y-%m-%dT%H:%M:%S')
+
+    def test_latest_used_as_link_dest(self):
+        reply = (0, 'exists=1\nwritable=1\nlatest=2015-01-01T10:00:00\n--\n'
+            '2015-01-01T10:00:00\n01-01-2015-11:00:00\n', '')
+        with patch.object(self.bm, '_run_cmd', return_value=reply):
+            self.bm.preflight()
+        with patch.object(self.bm, '_run_cmd', return_value=(0, '', '')) as mm:
+            self.bm.create_backup()
+            self.assertIn('--link-dest={}'.format(os.path.join(self.bm.dest,
+                '2015-01-01T10:00:00')), mm.call_args_list[1][0][0])
+            self.assertIn('ln -sfn 2015-01-01T12:00:00', mm.call_args[0][0][-1])
+        self.assertEqual(self.bm._latest, '2015-01-01T12:00:00')
+
+    def tearDown(self):
+        self.restore_datetime()
+
+class BackupNamingRemoteTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.create_test_dest_dir()
+        self.bm.prefix = 'test-'
+        self.backups = ['test-12-31-2014-23:59:59', 'test-2015-01-01T06:00:00',
+            'test-01-01-2015-12:00:00']
+        for b in self.backups:
+            os.makedirs(os.path.join(self.bm.dest, b, 'test_src'))
+        # Run the "remote" commands locally
+        self.bm._ssh_cmd = lambda: ['sh', '-c']
+
+    def test_latest_link(self):
+        self.bm._commit(latest=self.backups[1])
+        self.bm._commit(latest=self.backups[2])
+        link = os.path.join(self.bm.dest, 'test-latest')
+        self.assertEqual(os.readlink(link), self.backups[2])
+        self.assertEqual(sorted(os.listdir(self.bm.dest)),
+            sorted(['.generation', 'test-latest'] + self.backups))
+        self.bm._latest = None
+        self.bm.preflight()
+        self.assertEqual(self.bm._latest, self.backups[2])
+
+    def test_migrate_names(self):
+        self.bm.delete_batch = 1
+        self.assertEqual(self.bm.migrate_names(), 2)
+        migrated = ['test-2014-12-31T23:59:59', 'test-2015-01-01T06:00:00',
+            'test-2015-01-01T12:00:00']
+        self.assertEqual(self.bm._dest_backups(), migrated)
+        self.assertEqual(self.bm.list_dest_backups(), migrated)
+        self.assertEqual(os.readlink(os.path.join(self.bm.dest, 'test-latest')),
+            migrated[-1])
+        self.assertEqual(self.bm.migrate_names(), 0)
+
+    def test_migrate_never_overwrites(self):
+        os.makedirs(os.path.join(self.bm.dest, 'test-2015-01-01T12:00:00'))
+        self.assertEqual(self.bm.migrate_names(), 1)
+        self.assertIn('test-01-01-2015-12:00:00', os.listdir(self.bm.dest))
+
+    def tearDown(self):
+        self.cleanup_test_dest_dir()
+
+################################################################################
+################################################################################
+## Run Report Tests                                                           ##
+## Tests for timing the phases of a run and collecting rsync's statistics.    ##
+##                                                                            ##
+################################################################################
+################################################################################
+class RunReportTestCase(BackupManagerTestCase):
+    def setUp(self):
+        self.create_def_backup_obj()
+        self.replace_datetime()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bm._backups_cache = []
+
+    def run_cmd(self, cmd, tail=None, throttled=False, on_line=None):
+        if cmd[0] == 'rsync':
+            self.assertIn('--stats', cmd)
+            return (0, 'Number of files: 3 (reg: 2, dir: 1)\n'
+                'Total file size: 8,192 bytes\nLiteral data: 8,192 bytes\n'
+                'Matched data: 0 bytes\n', '')
+        return (0, '', '')
+
+    def test_report(self):
+        self.bm.catalog = os.path.join(self.tmp.name, 'catalog.db')
+        self.bm.job = 'home'
+        self.bm.report_json = os.path.join(self.tmp.name, 'run.json')
+        self.bm.report_prom = os.path.join(self.tmp.name, 'backup.prom')
+        with patch.object(self.bm, '_run_cmd', self.run_cmd):
+            self.bm.create_backup()
+            self.bm.write_reports(True)
+        name = '2015-01-01T12:00:00'
+        s = self.bm._catalog.snapshot(self.bm._catalog_key(), name)
+        self.assertEqual((s['size'], s['files']), (8192, 3))
+        r = self.bm.run_report()
+        self.assertEqual(r['job'], 'home')
+        d = r['destinations'][0]
+        self.assertEqual(set(d['phases']), {'transfer', 'commit'})
+        self.assertEqual(d['backups'][name]['literal_bytes'], 8192)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+            ['backup.prom', 'catalog.db', 'run.json'])
+
+    def test_no_report_paths(self):
+        with patch('backup.BackupManager.write_json') as mm:
+            self.bm.write_reports(False)
+        self.assertEqual(mm.call_count, 0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        self.restore_datetime()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupMetrics import (derive_rsync_stats, parse_rsync_stats,
+    prometheus_text, run_metrics, write_json, write_prometheus)
+
+## Output of `rsync --stats` (3.1 and later)
+stats_31 = '''
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 12 (reg: 10, dir: 2)
+Number of deleted files: 0
+Number of regular files transferred: 10
+Total file size: 12,345,678 bytes
+Total transferred file size: 4,000 bytes
+Literal data: 1,000 bytes
+Matched data: 3,000 bytes
+File list size: 0
+File list generation time: 0.003 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1,567
+Total bytes received: 35
+
+sent 1,567 bytes  received 35 bytes  3,204.00 bytes/sec
+total size is 12,345,678  speedup is 7,706.42
+'''
+
+## Output of `rsync --stats` (3.0)
+stats_30 = '''
+Number of files: 7
+Number of files transferred: 5
+Total file size: 20480 bytes
+Total transferred file size: 20480 bytes
+Literal data: 20480 bytes
+Matched data: 0 bytes
+File list size: 119
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 20867
+Total bytes received: 111
+'''
+
+################################################################################
+################################################################################
+## Run Metrics Tests                                                          ##
+## Tests for parsing rsync's statistics and reporting them with the timings   ##
+## of a run.                                                                  ##
+################################################################################
+################################################################################
+class ParseRsyncStatsTestCase(unittest.TestCase):
+    def test_rsync_31(self):
+        s = parse_rsync_stats(stats_31)
+        self.assertEqual(s['files'], 1234)
+        self.assertEqual(s['files_transferred'], 10)
+        self.assertEqual(s['total_bytes'], 12345678)
+        self.assertEqual((s['literal_bytes'], s['matched_bytes']), (1000, 3000))
+        self.assertEqual(s['file_list_generation_seconds'], 0.003)
+        self.assertEqual((s['sent_bytes'], s['received_bytes']), (1567, 35))
+
+    def test_rsync_30(self):
+        s = parse_rsync_stats(stats_30)
+        self.assertEqual((s['files'], s['files_transferred']), (7, 5))
+        self.assertEqual(s['file_list_bytes'], 119)
+
+    def test_no_stats(self):
+        self.assertEqual(parse_rsync_stats('rsync error: some error\n'), {})
+
+    def test_derived(self):
+        s = derive_rsync_stats(parse_rsync_stats(stats_31))
+        self.assertAlmostEqual(s['speedup'], 12345678 / 1602)
+        self.assertEqual(s['matched_ratio'], 0.75)
+        self.assertEqual(derive_rsync_stats({}), {})
+
+class RunMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.m = run_metrics()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def report(self):
+        return {'job': 'home', 'started': 100.0, 'finished': 160.0,
+            'success': True, 'destinations': [dict(self.m.report(),
+            destination='host:/dest')]}
+
+    def test_phases_add_up(self):
+        with self.m.timer('transfer'):
+            pass
+        self.m.add_time('transfer', 2.0)
+        self.assertRaises(ValueError, self.fail_in_phase)
+        self.assertGreaterEqual(self.m.phases['transfer'], 2.0)
+        self.assertIn('prune', self.m.phases)
+
+    def fail_in_phase(self):
+        with self.m.timer('prune'):
+            raise ValueError()
+
+    def test_rsync_summed(self):
+        self.m.add_rsync('b', parse_rsync_stats(stats_31))
+        self.m.add_rsync('b', parse_rsync_stats(stats_30))
+        self.assertEqual(self.m.rsync('b')['files'], 1241)
+        self.assertEqual(self.m.rsync('other'), {})
+        self.assertIn('speedup', self.m.report()['backups']['b'])
+
+    def test_prometheus(self):
+        self.m.add_time('transfer', 1.5)
+        self.m.add_rsync('b', parse_rsync_stats(stats_31))
+        text = prometheus_text(self.report())
+        self.assertIn('# TYPE backup_phase_seconds gauge', text)
+        self.assertIn('backup_phase_seconds{job="home",'
+            'destination="host:/dest",phase="transfer"} 1.5', text)
+        self.assertIn('backup_rsync_literal_bytes{job="home",'
+            'destination="host:/dest"} 1000.0', text)
+        self.assertIn('backup_last_run_success{job="home"} 1.0', text)
+        self.assertEqual(text.count('# HELP backup_phase_seconds'), 1)
+
+    def test_write(self):
+        j = os.path.join(self.tmp.name, 'run.json')
+        p = os.path.join(self.tmp.name, 'backup.prom')
+        write_json(j, self.report())
+        write_prometheus(p, self.report())
+        with open(j) as f:
+            self.assertEqual(json.load(f)['job'], 'home')
+        with open(p) as f:
+            self.assertIn('backup_last_run_duration_seconds', f.read())
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+            ['backup.prom', 'run.json'])
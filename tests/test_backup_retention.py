@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupRetention import retention_policy
+from datetime import datetime, timedelta
+
+################################################################################
+################################################################################
+## Retention Policy Tests                                                     ##
+## Tests for splitting backups into the ones to keep and the ones to remove.  ##
+##                                                                            ##
+################################################################################
+################################################################################
+class RetentionPolicyTestCase(unittest.TestCase):
+    # One backup every 6 hours for 60 days, named after their index
+    def setUp(self):
+        start = datetime(2015, 1, 1, 0, 0, 0)
+        self.backups = [(str(i), start + timedelta(hours=6 * i))
+            for i in range(4 * 60)]
+
+    def test_last_only(self):
+        keep, remove = retention_policy(last=3).plan(self.backups)
+        self.assertEqual(keep, ['237', '238', '239'])
+        self.assertEqual(remove[0], '236')
+        self.assertEqual(len(remove), 237)
+
+    def test_nothing_to_remove(self):
+        keep, remove = retention_policy(last=10).plan(self.backups[:5])
+        self.assertEqual(keep, ['0', '1', '2', '3', '4'])
+        self.assertEqual(remove, [])
+
+    def test_daily(self):
+        keep, remove = retention_policy(last=1, daily=3).plan(self.backups)
+        # Newest backup of each of the last 3 days
+        self.assertEqual(keep, ['231', '235', '239'])
+
+    def test_overlapping_buckets(self):
+        keep, remove = retention_policy(last=2, daily=2, monthly=3).plan(
+            self.backups)
+        # Jan 31 (end of January), Feb 28 (end of February), Mar 1 (the last
+        # two days, the last two backups and March)
+        self.assertEqual(keep, ['123', '235', '238', '239'])
+        self.assertEqual(len(keep) + len(remove), len(self.backups))
+
+    def test_bucket_oldest(self):
+        policy = retention_policy(last=2, daily=2, monthly=3)
+        self.assertEqual(policy.bucket_oldest(self.backups), ['123', '235'])
+        self.assertEqual(retention_policy(last=5).bucket_oldest(self.backups),
+            [])
+
+    def test_uses_buckets(self):
+        self.assertFalse(retention_policy(last=5).uses_buckets())
+        self.assertTrue(retention_policy(last=5, yearly=1).uses_buckets())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+sys.path.append('../')
+
+from backup.BackupExceptions import BackupError
+from backup.BackupPrinter import backup_printer
+from backup.BackupScheduler import (backup_scheduler, parse_duration,
+    scheduled_job, send_command)
+import create_backup
+from create_backup import (format_summary, job_settings, parse_config_files,
+    run_jobs)
+
+################################################################################
+################################################################################
+## Scheduler Tests                                                            ##
+## Tests for running jobs on their schedules, limiting concurrency and        ##
+## retrying failed runs.                                                      ##
+################################################################################
+################################################################################
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.ran = []
+        self.fail = set()
+        self.release = threading.Event()
+        self.release.set()
+
+    def clock(self):
+        return self.now
+
+    def run_job(self, j):
+        self.ran.append(j.name)
+        self.release.wait(5)
+        if j.name in self.fail:
+            raise BackupError('failed')
+
+    def scheduler(self, jobs, **kwargs):
+        return backup_scheduler(jobs, self.run_job, backup_printer(),
+            clock=self.clock, **kwargs)
+
+    def job(self, name, dest='/d', interval=3600, **kwargs):
+        return scheduled_job(name, {'host': 'h', 'dest': dest}, interval,
+            **kwargs)
+
+    def wait(self, s):
+        for t in list(s._threads.values()):
+            t.join(5)
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('90'), 90)
+        self.assertEqual(parse_duration('15m'), 900)
+        self.assertEqual(parse_duration('1.5h'), 5400)
+        self.assertEqual(parse_duration(' 2d '), 172800)
+        self.assertRaises(ValueError, parse_duration, '1y')
+
+    def test_schedule(self):
+        s = self.scheduler([self.job('a')])
+        self.assertIsNone(s.run_pending())
+        self.wait(s)
+        self.assertEqual(self.ran, ['a'])
+        # Nothing until the next run is due
+        self.now += 1800
+        self.assertEqual(s.run_pending(), 1800)
+        self.now += 1800
+        s.run_pending()
+        self.wait(s)
+        self.assertEqual(self.ran, ['a', 'a'])
+
+    def test_limits(self):
+        self.release.clear()
+        s = self.scheduler([self.job('a'), self.job('b'), self.job('c', '/e'),
+            self.job('d', '/f')], max_jobs=2)
+        s.run_pending()
+        # b writes to the same destination as a
+        self.assertEqual(sorted(self.ran), ['a', 'c'])
+        self.release.set()
+        self.wait(s)
+        s.run_pending()
+        self.wait(s)
+        self.assertEqual(sorted(self.ran), ['a', 'b', 'c', 'd'])
+
+    def test_retries(self):
+        self.fail.add('a')
+        s = self.scheduler([self.job('a', retries=2, retry_delay=10)])
+        delays = []
+        for i in range(3):
+            s.run_pending()
+            self.wait(s)
+            delays.append(s.jobs['a'].next_run - self.now)
+            self.now = s.jobs['a'].next_run
+        # Backoff, then the next scheduled run
+        self.assertEqual(delays, [10, 20, 3600 - 30])
+        self.assertEqual(s.status('a')[0]['last_error'], 'failed')
+
+    def test_trigger(self):
+        s = self.scheduler([self.job('a')])
+        s.run_pending()
+        self.wait(s)
+        self.now += 600
+        self.assertTrue(s.trigger('a'))
+        self.assertFalse(s.trigger('x'))
+        s.run_pending()
+        self.wait(s)
+        self.assertEqual(self.ran, ['a', 'a'])
+        # The schedule is unchanged
+        self.assertEqual(s.jobs['a'].next_run, 1000 + 3600)
+
+    def test_state_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state.json')
+            s = self.scheduler([self.job('a')], state_file=path)
+            s.run_pending()
+            self.wait(s)
+            self.now += 600
+            s = self.scheduler([self.job('a'), self.job('b')], state_file=path)
+            self.assertEqual(s.jobs['a'].next_run, 1000 + 3600)
+            self.assertEqual(s.jobs['b'].next_run, self.now)
+
+    def test_socket(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sock')
+            s = self.scheduler([self.job('a')])
+            server = s.serve(path)
+            try:
+                self.assertEqual(send_command(path, ['run', 'a']),
+                    {'triggered': 'a'})
+                r = send_command(path, ['status'])
+                self.assertEqual([j['name'] for j in r['jobs']], ['a'])
+                self.assertIn('error', send_command(path, ['status', 'x']))
+                self.assertIn('error', send_command(path, ['bogus']))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+################################################################################
+################################################################################
+## Job Settings Tests                                                         ##
+## Tests for reading jobs from configuration files.                           ##
+##                                                                            ##
+################################################################################
+################################################################################
+class JobSettingsTestCase(unittest.TestCase):
+    def test_jobs(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.conf') as f:
+            f.write('[General]\nhost=h\ndest=/d\nnum_backups=2\n'
+                '[job:home]\nsrc=/home\nschedule=1h\nretries=5\n'
+                '[daemon]\nmax_jobs=3\n')
+            f.flush()
+            settings, _ = parse_config_files([f.name], backup_printer())
+        self.assertEqual(settings['daemon'], {'max_jobs': 3})
+        self.assertEqual(settings['jobs']['home']['retries'], 5)
+        self.assertNotIn('schedule', settings)
+        s = job_settings(settings, 'home')
+        self.assertEqual(s, {'host': 'h', 'dest': '/d', 'num_backups': 2,
+            'src': ['/home'], 'job': 'home'})
+        self.assertRaises(KeyError, job_settings, settings, 'other')
+
+    def test_daemon_options_outside_daemon(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.conf') as f:
+            f.write('[General]\nhost=h\ndest=/d\nmax_per_destination=2\n'
+                'state_file=/s\n[job:home]\nsrc=/home\nsocket=/sock\n')
+            f.flush()
+            settings, _ = parse_config_files([f.name], backup_printer())
+        self.assertEqual(job_settings(settings, 'home'), {'host': 'h',
+            'dest': '/d', 'src': ['/home'], 'job': 'home'})
+
+################################################################################
+################################################################################
+## Multiple Job Tests                                                         ##
+## Tests for running several jobs at a time with create_backup.               ##
+##                                                                            ##
+################################################################################
+################################################################################
+class RunJobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = self.peak = 0
+
+    def run_backup(self, settings):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            threading.Event().wait(0.05)
+            if settings['src'] == ['/fail']:
+                raise BackupError('rsync failed\nexit code 23\n')
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def test_run_jobs(self):
+        jobs = {n: {'src': [s], 'printer': backup_printer()}
+            for n, s in (('a', '/a'), ('b', '/fail'), ('c', '/c'), ('d', '/d'))}
+        with patch.object(create_backup, 'run_backup', self.run_backup), \
+                patch.object(create_backup, 'stop_sessions') as stop:
+            results = run_jobs(jobs, 2)
+        self.assertEqual(list(results), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.peak, 2)
+        self.assertIsNone(results['a'][0])
+        self.assertIn('exit code 23', results['b'][0])
+        # All of the jobs shared one (since removed) session directory
+        dirs = set(s['session_dir'] for s in jobs.values())
+        self.assertEqual(len(dirs), 1)
+        self.assertFalse(os.path.exists(dirs.pop()))
+        stop.assert_called_once()
+
+        lines = format_summary(results).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('JOB'))
+        self.assertIn(' ok ', lines[1])
+        self.assertIn('FAILED', lines[2])
+        self.assertTrue(lines[2].endswith('exit code 23'))
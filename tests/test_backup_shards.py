@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupShards import entry_weight, partition, shard_source
+
+################################################################################
+################################################################################
+## Sharding Tests                                                             ##
+## Tests for weighing the entries of a source directory and partitioning them ##
+## into balanced shards.                                                      ##
+##                                                                            ##
+################################################################################
+################################################################################
+class PartitionTestCase(unittest.TestCase):
+    def test_balanced(self):
+        items = {'a': 10, 'b': 6, 'c': 4, 'd': 1}
+        groups = partition(items, 2)
+        loads = sorted(sum(items[x] for x in g) for g in groups)
+        self.assertEqual(loads, [10, 11])
+        self.assertEqual(sorted(sum(groups, [])), sorted(items))
+
+    def test_more_groups_than_items(self):
+        self.assertEqual(partition({'a': 1, 'b': 2}, 4), [['b'], ['a']])
+
+    def test_empty(self):
+        self.assertEqual(partition({}, 3), [])
+
+class ShardSourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        for d, files in (('big', 4), ('small', 1), ('medium', 2)):
+            os.mkdir(os.path.join(self.src, d))
+            for i in range(files):
+                with open(os.path.join(self.src, d, str(i)), 'wb') as f:
+                    f.write(b'x' * 1000)
+        with open(os.path.join(self.src, 'file'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def test_entry_weight(self):
+        big = os.path.join(self.src, 'big')
+        self.assertEqual(entry_weight(big, 'count'), 5)
+        self.assertGreaterEqual(entry_weight(big, 'size'), 4000)
+        self.assertEqual(entry_weight(os.path.join(self.src, 'none')), 1)
+
+    def test_shard_source(self):
+        shards = shard_source(self.src, 2, 'count')
+        self.assertEqual(shards, [['big', 'file'], ['medium', 'small']])
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from backup.BackupSpace import (created_size, estimate_from_index,
+    estimate_from_stats, format_index, format_report, free_space, index_name,
+    linked_file, parse_index, parse_size, space_report)
+from backup.BackupTransport import local_transport, ssh_transport
+from unittest.mock import MagicMock, patch
+
+################################################################################
+################################################################################
+## Space Index Tests                                                          ##
+## Tests for counting what rsync created and reading and writing the space    ##
+## index.                                                                     ##
+################################################################################
+################################################################################
+class SpaceIndexTestCase(unittest.TestCase):
+    def test_created_size(self):
+        self.assertEqual(created_size('<f+++++++++ 1234 src/a'), 1234)
+        self.assertEqual(created_size('>f.st...... 5 src/b'), 5)
+        self.assertEqual(created_size('cd+++++++++ 4096 src/d/'), 4096)
+        self.assertEqual(created_size('cL+++++++++ 3 src/l'), 3)
+        self.assertIsNone(created_size('.d..t...... 4096 src/'))
+        self.assertIsNone(created_size('Total file size: 10 bytes'))
+        self.assertIsNone(created_size('hf          12 src/a'))
+
+    def test_linked_file(self):
+        self.assertEqual(linked_file('hf          12 src/a\\#040b'),
+            ('src/a b', 12))
+        self.assertIsNone(linked_file('.f          12 src/a'))
+        self.assertIsNone(linked_file('>f+++++++++ 12 src/a'))
+
+    def test_index(self):
+        text = 'b1\t3\t300\nbroken\nb2\t1\tx\nb3\t2\t20\n'
+        index = parse_index(text)
+        self.assertEqual(list(index.items()), [('b1', (3, 300)),
+            ('b3', (2, 20))])
+        self.assertEqual(parse_index(format_index(index)), index)
+
+    def test_report(self):
+        rows = space_report(parse_index('b1\t3\t300\nb3\t2\t20\ngone\t1\t1\n'),
+            ['b1', 'b2', 'b3'])
+        self.assertEqual(rows, [('b1', 3, 300, 300), ('b2', None, None, 300),
+            ('b3', 2, 20, 320)])
+        lines = format_report(rows).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn('?', lines[2])
+
+    def test_ssh_write_text(self):
+        bm = MagicMock()
+        t = ssh_transport(bm)
+        t.run = MagicMock(return_value=(0, '', ''))
+        self.assertIsNone(t.write_text('/d/.space-index', 'x' * (40 * 1024)))
+        scripts = [c[0][0] for c in t.run.call_args_list]
+        self.assertEqual(len(scripts), 2)
+        self.assertIn("> /d/.space-index.tmp", scripts[0])
+        self.assertIn(">> /d/.space-index.tmp && mv", scripts[1])
+
+################################################################################
+################################################################################
+## Space Accounting Tests                                                     ##
+## Tests for recording the space of new backups and reporting it.             ##
+##                                                                            ##
+################################################################################
+################################################################################
+class SpaceAccountingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+        self.index = os.path.join(self.dest, index_name)
+        self.bm = backup_manager('/src', None, self.dest, transport='local',
+            space_index=True, num_backups=5,
+            printer=backup_printer(None, None, None, None, None))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self):
+        with open(self.index) as f:
+            return parse_index(f.read())
+
+    def test_watcher(self):
+        watch = self.bm._transfer_watcher('/src', 'new')
+        for line in ('cd+++++++++ 4096 src/', '<f+++++++++ 10 src/a',
+                'Number of files: 2'):
+            watch(line)
+        stats = self.bm._metrics.rsync('new')
+        self.assertEqual((stats['new_inodes'], stats['new_bytes']), (2, 4106))
+
+    def test_update(self):
+        self.bm._update_space_index(add={'2015-01-01T00:00:00': (2, 20)})
+        self.bm._update_space_index(add={'2015-01-02T00:00:00': (1, 10)})
+        self.assertEqual(len(self.read()), 2)
+        # Removed backups are left out, renamed ones renamed
+        self.bm._backups_cache = ['2015-01-03T00:00:00']
+        self.bm._update_space_index(renames={
+            '2015-01-02T00:00:00': '2015-01-03T00:00:00'})
+        self.assertEqual(list(self.read().items()),
+            [('2015-01-03T00:00:00', (1, 10))])
+
+    def test_space_report(self):
+        for b in ('2015-01-01T00:00:00', '2015-01-02T00:00:00'):
+            os.mkdir(os.path.join(self.dest, b))
+        self.bm._update_space_index(add={'2015-01-01T00:00:00': (2, 20),
+            '2015-01-02T00:00:00': (1, 10)})
+        self.assertEqual(self.bm.space_report(), [
+            ('2015-01-01T00:00:00', 2, 20, 20),
+            ('2015-01-02T00:00:00', 1, 10, 30)])
+
+################################################################################
+################################################################################
+## Capacity Pruning Tests                                                     ##
+## Tests for estimating the size of a backup and removing old backups to make ##
+## room for it.                                                               ##
+################################################################################
+################################################################################
+class CapacityPruneTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+        self.backups = ['2015-01-0{0}T00:00:00'.format(i) for i in range(1, 5)]
+        for b in self.backups:
+            os.mkdir(os.path.join(self.dest, b))
+            with open(os.path.join(self.dest, b, 'f'), 'wb') as f:
+                f.write(b'x' * 1000)
+        self.bm = backup_manager('/src', None, self.dest, transport='local',
+            capacity_prune=True, min_backups=2, num_backups=10,
+            printer=backup_printer(None, None, None, None, None))
+        self.bm._backups_cache = list(self.backups)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('10G'), 10 * 1024 ** 3)
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('1.5M'), 1572864)
+        self.assertEqual(parse_size(7), 7)
+        self.assertRaises(ValueError, parse_size, '10X')
+        self.bm.min_free = 'lots'
+        self.assertEqual(self.bm.min_free, 0)
+
+    def test_free_space(self):
+        self.assertEqual(free_space({'avail_kb': '10', 'inodes': '0',
+            'ifree': '0'}), (10240, None))
+        self.assertEqual(free_space({'avail_kb': '1', 'inodes': '9',
+            'ifree': '5'}), (1024, 5))
+        self.assertIsNone(free_space({'exists': '1'}))
+        status, _, _ = local_transport(self.bm._out).probe(self.dest, False,
+            os.path.join(self.dest, 'latest'), space=True)
+        self.assertIsNotNone(free_space(status))
+
+    def test_estimates(self):
+        index = parse_index('a\t9\t900\nb\t1\t10\nc\t2\t5\nd\t3\t30\n')
+        self.assertEqual(estimate_from_index(index, ['a', 'b', 'c', 'd']),
+            (3, 30))
+        self.assertIsNone(estimate_from_index(index, ['e']))
+        text = ('Number of files: 10 (reg: 8, dir: 2)\n'
+            'Number of created files: 4 (reg: 3, dir: 1)\n'
+            'Number of regular files transferred: 3\n'
+            'Total transferred file size: 5,000 bytes\n')
+        self.assertEqual(estimate_from_stats(text)[1], 5000)
+
+    def test_make_room(self):
+        self.bm._free = (500, None)
+        with patch.object(self.bm, '_estimate_backup', return_value=(1, 2000)):
+            self.bm._make_room(['/src'], 'new', self.backups[0])
+        # The link-dest and the two most recent backups are kept
+        self.assertEqual(self.bm._backups_cache, [self.backups[0]] +
+            self.backups[2:])
+        self.assertFalse(os.path.exists(os.path.join(self.dest,
+            self.backups[1])))
+        self.assertGreaterEqual(self.bm._free[0], 1500)
+
+    def test_make_room_fits(self):
+        self.bm._free = (10 ** 9, 10 ** 6)
+        with patch.object(self.bm, '_estimate_backup', return_value=(1, 2000)):
+            self.bm._make_room(['/src'], 'new', None)
+        self.assertEqual(self.bm._backups_cache, self.backups)
+
+    def test_estimate_from_space_index(self):
+        self.bm.space_index = True
+        self.bm._update_space_index(add={self.backups[-1]: (4, 4000)})
+        self.assertEqual(self.bm._estimate_backup(['/src'], 'new', None),
+            (4, 4000))
+
+################################################################################
+################################################################################
+## Link-dest Savings Tests                                                    ##
+## Tests for telling which link-dest each file rsync linked came from.        ##
+##                                                                            ##
+################################################################################
+################################################################################
+class LinkDestSavingsTestCase(unittest.TestCase):
+    old = '2015-01-01T00:00:00'
+    recent = '2015-01-02T00:00:00'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+        self.bm = backup_manager('/src', None, self.dest, transport='local',
+            link_dests=2, link_dest_stats=True,
+            printer=backup_printer(None, None, None, None, None))
+        self.new = self.bm._staging_path('2015-01-03T00:00:00')
+        for d in (self.old, self.recent):
+            os.makedirs(os.path.join(self.dest, d, 'src'))
+        os.makedirs(os.path.join(self.new, 'src'))
+        for d, n in ((self.recent, 'x'), (self.old, 'y')):
+            path = os.path.join(self.dest, d, 'src', n)
+            with open(path, 'w') as f:
+                f.write(n)
+            os.link(path, os.path.join(self.new, 'src', n))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_link_sources(self):
+        found, errors = local_transport(self.bm._out).link_sources(self.new,
+            [os.path.join(self.dest, self.recent), os.path.join(self.dest,
+            self.old)], ['src/x', 'src/y', 'src/z'])
+        self.assertEqual(found, {'src/x': 0, 'src/y': 1})
+        self.assertEqual(len(errors), 1)
+
+    # ssh transport whose "remote" scripts are run locally
+    def ssh(self):
+        t = ssh_transport(MagicMock())
+        self.scripts = []
+        def run(script, tail=None, on_line=None):
+            self.scripts.append(script)
+            p = subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            for line in p.stdout.decode().splitlines():
+                on_line(line)
+            return p.returncode, '', p.stderr.decode()
+        t.run = run
+        return t
+
+    def test_ssh_link_sources(self):
+        found, errors = self.ssh().link_sources(self.new,
+            [os.path.join(self.dest, self.recent), os.path.join(self.dest,
+            self.old)], ['src/x', 'src/y', 'src/z'])
+        self.assertEqual(found, {'src/x': 0, 'src/y': 1})
+        self.assertEqual(len(errors), 1)
+        # One listing of the new backup and one of each candidate
+        self.assertEqual(len(self.scripts), 3)
+
+    def test_ssh_link_sources_first_candidate(self):
+        found, errors = self.ssh().link_sources(self.new,
+            [os.path.join(self.dest, self.recent), os.path.join(self.dest,
+            self.old)], ['src/x'])
+        self.assertEqual((found, errors), ({'src/x': 0}, []))
+        # The older candidate isn't listed
+        self.assertEqual(len(self.scripts), 2)
+
+    def test_savings(self):
+        self.bm._link_extra = [self.old]
+        watch = self.bm._transfer_watcher('/src', '2015-01-03T00:00:00')
+        for line in ('hf          10 src/x', 'hf          20 src/y',
+                '.d          4096 src/'):
+            watch(line)
+        self.bm._link_savings('2015-01-03T00:00:00', self.recent)
+        self.assertEqual(self.bm._linked, {})
+        stats = self.bm._metrics.rsync('2015-01-03T00:00:00')
+        self.assertEqual((stats['link_dest_saved_bytes'],
+            stats['link_dest_2_saved_bytes']), (20, 20))
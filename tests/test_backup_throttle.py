@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('../')
+
+from backup import BackupThrottle
+from backup.BackupThrottle import adaptive_throttle, disk_latency, disk_stats
+from unittest.mock import patch
+
+################################################################################
+################################################################################
+## Adaptive Throttle Tests                                                    ##
+## Tests for sampling the host's disks and duty cycling processes.            ##
+##                                                                            ##
+################################################################################
+################################################################################
+class DiskStatsTestCase(unittest.TestCase):
+    def test_disk_stats(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('   8  0 sda 100 0 800 50 200 0 1600 150 0 0 0\n'
+                '   7  0 loop0 999 0 0 999 999 0 0 999 0 0 0\n'
+                ' 259  0 nvme0n1 10 0 80 5 20 0 160 15 0 0 0\n')
+            f.flush()
+            self.assertEqual(disk_stats(f.name), (330, 220))
+        self.assertIsNone(disk_stats('/nonexistent'))
+
+    def test_disk_latency(self):
+        self.assertEqual(disk_latency((100, 1000), (110, 1200)), 20.0)
+        self.assertEqual(disk_latency((100, 1000), (100, 1000)), 0.0)
+        self.assertEqual(disk_latency(None, (100, 1000)), 0.0)
+
+class AdaptiveThrottleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.t = adaptive_throttle(max_load=1.0, max_latency=50.0,
+            period=0.2, min_duty=0.1)
+
+    def test_adjust(self):
+        with patch.object(BackupThrottle, 'disk_stats', return_value=None):
+            with patch.object(BackupThrottle, 'load_per_cpu', return_value=2.0):
+                self.assertTrue(self.t.adjust())
+                self.assertEqual(self.t.duty, 0.5)
+                for i in range(10):
+                    self.t.adjust()
+                self.assertEqual(self.t.duty, 0.1)
+            with patch.object(BackupThrottle, 'load_per_cpu', return_value=0.5):
+                self.assertFalse(self.t.adjust())
+                self.assertAlmostEqual(self.t.duty, 0.2)
+                for i in range(10):
+                    self.t.adjust()
+                self.assertEqual(self.t.duty, 1.0)
+
+    def test_disk_latency_slows(self):
+        samples = iter([(100, 1000), (110, 2000)])
+        with patch.object(BackupThrottle, 'disk_stats',
+                side_effect=lambda: next(samples)):
+            with patch.object(BackupThrottle, 'load_per_cpu', return_value=0):
+                self.t.adjust()
+                self.assertTrue(self.t.adjust())
+
+    # Returns the state letter of a process (i.e. T for stopped)
+    def state(self, proc):
+        return self.pid_state(proc.pid)
+
+    def pid_state(self, pid):
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0]
+
+    # Waits for a process to be stopped
+    def wait_stopped(self, pid):
+        for i in range(50):
+            if self.pid_state(pid) == 'T':
+                return True
+            time.sleep(0.02)
+        return False
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), 'needs /proc')
+    def test_watch(self):
+        proc = subprocess.Popen(['sleep', '30'], start_new_session=True)
+        try:
+            with patch.object(BackupThrottle, 'load_per_cpu', return_value=9):
+                self.t.watch(proc)
+                self.assertTrue(self.wait_stopped(proc.pid))
+                self.t.unwatch(proc)
+            # Unwatched processes are left running
+            for i in range(20):
+                time.sleep(0.05)
+                self.assertNotEqual(self.state(proc), 'T')
+            self.assertIsNone(self.t._thread)
+        finally:
+            proc.kill()
+            proc.wait()
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), 'needs /proc')
+    def test_watch_children(self):
+        # Like rsync and the ssh it starts
+        proc = subprocess.Popen(['sh', '-c', 'sleep 30 & echo $!; wait'],
+            stdout=subprocess.PIPE, start_new_session=True)
+        try:
+            child = int(proc.stdout.readline())
+            with patch.object(BackupThrottle, 'load_per_cpu', return_value=9):
+                self.t.watch(proc)
+                self.assertTrue(self.wait_stopped(child))
+                self.t.unwatch(proc)
+            for i in range(20):
+                time.sleep(0.05)
+                self.assertNotEqual(self.pid_state(child), 'T')
+        finally:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            proc.stdout.close()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup.BackupDeleter import local_deleter
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from backup.BackupTransport import local_transport, parse_probe
+
+################################################################################
+################################################################################
+## Local Transport Tests                                                      ##
+## Tests for reaching a destination directory on this machine without ssh.    ##
+##                                                                            ##
+################################################################################
+################################################################################
+class LocalTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        self.t = local_transport(backup_printer())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make(self, *names):
+        for n in names:
+            os.makedirs(os.path.join(self.dest, n, 'sub'))
+            with open(os.path.join(self.dest, n, 'sub', 'file'), 'w') as f:
+                f.write('x' * 5000)
+
+    def test_probe_creates_dest(self):
+        status, listing, e = self.t.probe(self.dest, True, 'latest')
+        self.assertEqual(status['exists'], '0')
+        self.assertEqual(status['created'], '1')
+        self.assertEqual(status['writable'], '1')
+        self.assertEqual(listing, [])
+        self.assertTrue(os.path.isdir(self.dest))
+
+    def test_probe_dry_run(self):
+        status, listing, e = self.t.probe(self.dest, False, 'latest')
+        self.assertEqual(status['exists'], '0')
+        self.assertNotIn('created', status)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_probe_generation(self):
+        self.make('a', 'b')
+        # A new generation is written to an unmarked destination...
+        status, listing, _ = self.t.probe(self.dest, True, 'latest',
+            (None, 'g1'))
+        self.assertEqual(status['generation'], 'g1')
+        self.assertEqual(sorted(listing), ['.generation', 'a', 'b'])
+        # ...and a known one skips the listing
+        status, listing, _ = self.t.probe(self.dest, True, 'latest',
+            ('g1', 'g2'))
+        self.assertEqual(status['listed'], '0')
+        self.assertEqual(listing, [])
+
+    def test_commit(self):
+        self.make('a')
+        self.assertIsNone(self.t.commit(self.dest, 'g1', 'latest', 'a'))
+        self.assertIsNone(self.t.commit(self.dest, 'g2', 'latest', 'a'))
+        status, _, _ = self.t.probe(self.dest, True, 'latest', (None, None))
+        self.assertEqual(status['generation'], 'g2')
+        self.assertEqual(status['latest'], 'a')
+        self.assertEqual(sorted(os.listdir(self.dest)),
+            ['.generation', 'a', 'latest'])
+
+    def test_rename(self):
+        self.make('a', 'b', 'c')
+        renamed, errors = self.t.rename(self.dest, {'a': 'x', 'b': 'c'}, 64)
+        self.assertEqual(renamed, ['a'])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(sorted(os.listdir(self.dest)), ['b', 'c', 'x'])
+
+    def test_move_to_trash(self):
+        self.make('a', 'b')
+        trash = os.path.join(self.dest, '.trash')
+        errors = self.t.move_to_trash([os.path.join(self.dest, 'a')], trash, 64)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(self.dest)), ['.trash', 'b'])
+
+    def test_deleter(self):
+        self.make('a', 'b')
+        paths = [os.path.join(self.dest, x) for x in ['a', 'b']]
+        d = self.t.deleter(backup_printer(), 2, 1)
+        self.assertIsInstance(d, local_deleter)
+        inodes, size, errors = d.delete(paths)
+        self.assertEqual(errors, [])
+        # Two directories and a file in each backup
+        self.assertEqual(inodes, 6)
+        self.assertGreater(size, 0)
+        self.assertEqual(os.listdir(self.dest), [])
+
+    def test_rsync(self):
+        self.assertEqual(self.t.rsync_shell(), [])
+        self.assertEqual(self.t.rsync_target('/d/x'), '/d/x')
+
+    def test_parse_probe(self):
+        self.assertEqual(parse_probe('a=1\nb=\n--\nx\ny\n'),
+            ({'a': '1', 'b': ''}, ['x', 'y']))
+        self.assertEqual(parse_probe('a=1\n'), ({'a': '1'}, []))
+
+################################################################################
+################################################################################
+## Local Destination Tests                                                    ##
+## Tests for managing backups in a local destination (nothing is run over     ##
+## ssh).                                                                      ##
+################################################################################
+################################################################################
+class LocalDestinationTestCase(unittest.TestCase):
+    names = ['2015-01-01T12:00:00', '2015-01-02T12:00:00', '2015-01-03T12:00:00']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, 'dest')
+        for n in self.names:
+            os.makedirs(os.path.join(self.dest, n))
+        self.bm = backup_manager(self.tmp, None, self.dest, num_backups=1,
+            transport='local', printer=backup_printer())
+
+    def tearDown(self):
+        # The trash may still be being emptied in the background
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_no_ssh(self):
+        self.bm.open_session()
+        self.assertIsNone(self.bm._control_dir)
+        self.assertFalse(any(x.startswith('-e') for x in self.bm._rsync_cmd()))
+
+    def test_preflight(self):
+        self.assertEqual(self.bm.preflight(), self.names)
+
+    def test_remove_backups(self):
+        self.bm.async_prune = False
+        self.bm.preflight()
+        self.assertEqual(self.bm.remove_backups(), 2)
+        self.assertEqual(sorted(os.listdir(self.dest)),
+            ['.generation', self.names[-1]])
+
+    def test_remove_backups_async(self):
+        self.bm.preflight()
+        self.assertEqual(self.bm.remove_backups(), 2)
+        self.assertNotIn(self.names[0], os.listdir(self.dest))
+
+    def test_migrate_names(self):
+        os.rename(os.path.join(self.dest, self.names[0]),
+            os.path.join(self.dest, '01-01-2015-12:00:00'))
+        self.bm.preflight()
+        self.assertEqual(self.bm.migrate_names(), 1)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'latest')),
+            self.names[-1])
+        self.assertIn(self.names[0], os.listdir(self.dest))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from backup import BackupTuning
+from backup.BackupManager import backup_manager
+from backup.BackupPrinter import backup_printer
+from backup.BackupTuning import (load_tunings, mark_stale, pick_fastest,
+    rsync_compressions, sample_files, save_tuning, strip_compression)
+from unittest.mock import patch
+
+################################################################################
+################################################################################
+## Tuning Tests                                                               ##
+## Tests for picking and storing the ssh cipher and rsync compression of      ##
+## each host.                                                                 ##
+################################################################################
+################################################################################
+class TuningTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'tune.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_strip_compression(self):
+        self.assertEqual(strip_compression('-az'), '-a')
+        self.assertIsNone(strip_compression('-z'))
+        self.assertEqual(strip_compression('--archive'), '--archive')
+
+    def test_pick_fastest(self):
+        self.assertEqual(pick_fastest(['a', 'b', 'c'],
+            {'a': 100, 'b': 103, 'c': 90}), 'a')
+        self.assertEqual(pick_fastest(['a', 'b'], {'a': 100, 'b': 120}), 'b')
+        self.assertEqual(pick_fastest(['a', 'b'], {'a': None, 'b': 1}), 'b')
+        self.assertIsNone(pick_fastest(['a'], {'a': None}))
+
+    def test_rsync_compressions(self):
+        version = ('rsync  version 3.2.7  protocol version 31\n'
+            'Compress list:\n    zstd lz4 zlibx zlib none\n')
+        with patch.object(BackupTuning, '_output', return_value=version):
+            c = dict(rsync_compressions('rsync'))
+        self.assertEqual(c['none'], [])
+        self.assertEqual(c['zstd-3'], ['-z', '--compress-choice=zstd',
+            '--compress-level=3'])
+        self.assertEqual(c['lz4'], ['-z', '--compress-choice=lz4'])
+        # Older versions only have zlib
+        with patch.object(BackupTuning, '_output', return_value='rsync 3.1.3'):
+            c = dict(rsync_compressions('rsync'))
+        self.assertEqual(sorted(c), ['none', 'zlib-1', 'zlib-6'])
+        self.assertEqual(c['zlib-6'], ['-z', '--compress-level=6'])
+
+    def test_sample_files(self):
+        for name, size in (('a', 10), ('b', 100), ('c', 20)):
+            with open(os.path.join(self.tmp.name, name), 'w') as f:
+                f.write('x' * size)
+        os.symlink('a', os.path.join(self.tmp.name, 'l'))
+        files, total = sample_files([self.tmp.name], 40)
+        self.assertEqual([os.path.basename(x) for x in files], ['a', 'c'])
+        self.assertEqual(total, 30)
+
+    def test_store(self):
+        self.assertEqual(load_tunings(self.path), {})
+        t = save_tuning(self.path, 'u@h', 'aes128-ctr', 'zstd-1',
+            ['-z', '--compress-choice=zstd'], 1e8, {})
+        save_tuning(self.path, 'other', None, 'none', [], 1e6, {})
+        self.assertEqual(load_tunings(self.path)['u@h'], t)
+        mark_stale(self.path, 'u@h', 1e7)
+        t = load_tunings(self.path)
+        self.assertTrue(t['u@h']['stale'])
+        self.assertEqual(t['u@h']['measured'], 1e7)
+        self.assertNotIn('stale', t['other'])
+
+################################################################################
+################################################################################
+## Tuned Command Tests                                                        ##
+## Tests for using the tuning of the host in ssh and rsync commands and for   ##
+## marking it stale.                                                          ##
+################################################################################
+################################################################################
+class TunedCommandTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'tune.json')
+        save_tuning(self.path, 'u@h', 'aes128-gcm@openssh.com', 'zstd-3',
+            ['-z', '--compress-choice=zstd', '--compress-level=3'], 1e8, {})
+        self.bm = backup_manager('/src', 'h', '/dest', user='u',
+            printer=backup_printer(None, None, None, None, None),
+            tune_file=self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_commands(self):
+        r = self.bm._rsync_cmd()
+        self.assertIn('-a', r)
+        self.assertNotIn('-az', r)
+        self.assertIn('--compress-choice=zstd', r)
+        self.assertIn('-c aes128-gcm@openssh.com', r[r.index('-e') + 1])
+        self.assertEqual(self.bm._ssh_cmd()[1:3], ['-c',
+            'aes128-gcm@openssh.com'])
+
+    def test_untuned(self):
+        for bm in (backup_manager('/src', 'other', '/dest',
+                printer=backup_printer(None, None, None, None, None),
+                tune_file=self.path),
+                backup_manager('/src', 'h', '/dest', user='u',
+                printer=backup_printer(None, None, None, None, None),
+                tune_file=self.path, transport='local')):
+            r = bm._rsync_cmd()
+            self.assertIn('-az', r)
+            self.assertNotIn('-c', bm._ssh_opts())
+
+    def test_drift(self):
+        sample = self.bm.tune_sample << 20
+        # Small transfers and ones near the tuned throughput aren't measured
+        self.bm._check_drift({'literal_bytes': 1000}, 1000)
+        self.bm._check_drift({'literal_bytes': sample}, sample / 6e7)
+        self.assertNotIn('stale', load_tunings(self.path)['u@h'])
+        self.bm._check_drift({'literal_bytes': sample}, sample / 1e7)
+        t = load_tunings(self.path)['u@h']
+        self.assertTrue(t['stale'])
+        self.assertAlmostEqual(t['measured'], 1e7)
+
+    def test_autotune(self):
+        self.bm.autotune = True
+        with patch.object(backup_manager, 'tune') as tune:
+            self.bm._autotune_host()
+            tune.assert_not_called()
+            mark_stale(self.path, 'u@h', 1)
+            self.bm.tune_file = self.path
+            self.bm._autotune_host()
+            tune.assert_called_once()
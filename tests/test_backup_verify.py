@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('../')
+
+from backup import BackupVerify
+from backup.BackupExceptions import BackupError
+from backup.BackupManager import backup_manager, staging_prefix
+from backup.BackupPrinter import backup_printer
+from backup.BackupVerify import (hash_cache, parse_sums, pick_files,
+    source_digests, transferred_file)
+from unittest.mock import patch
+
+################################################################################
+################################################################################
+## Hash Tests                                                                 ##
+## Tests for hashing source files, caching their hashes and parsing the       ##
+## hashes and transfers reported by other commands.                           ##
+################################################################################
+################################################################################
+class HashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = hash_cache(os.path.join(self.tmp.name, 'hashes.db'))
+        self.paths = [self.write(n, n * 3) for n in 'abc']
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_digests(self):
+        gone = os.path.join(self.tmp.name, 'gone')
+        d = source_digests(self.paths + [gone])
+        self.assertEqual(d[self.paths[0]][0],
+            hashlib.sha256(b'aaa').hexdigest())
+        self.assertEqual(d[self.paths[0]][1].st_size, 3)
+        self.assertEqual(d[gone], (None, None))
+
+    def test_cache(self):
+        with patch.object(BackupVerify, 'file_digest',
+                wraps=BackupVerify.file_digest) as fd:
+            first = source_digests(self.paths, self.cache)
+            self.assertEqual(fd.call_count, 3)
+            self.assertEqual(source_digests(self.paths, self.cache), first)
+            self.assertEqual(fd.call_count, 3)
+            # A modified file is hashed again
+            self.write('b', 'changed')
+            d = source_digests(self.paths, self.cache)
+            self.assertEqual(fd.call_count, 4)
+            self.assertEqual(d[self.paths[1]][0],
+                hashlib.sha256(b'changed').hexdigest())
+
+    def test_parse_sums(self):
+        a, b = 'a' * 64, 'b' * 64
+        self.assertEqual(parse_sums('{0}  x y\n\\{1}  p\\nq\\\\r\n'
+            'sha256sum: z: No such file or directory\n'.format(a, b)),
+            {'x y': a, 'p\nq\\r': b})
+
+    def test_transferred_file(self):
+        self.assertEqual(transferred_file('>f+++++++++ 3 src/a b'), 'src/a b')
+        self.assertEqual(transferred_file('>f.st...... 2 src/\\#303\\#251'),
+            'src/é')
+        self.assertIsNone(transferred_file('cd+++++++++ 4096 src/d/'))
+        self.assertIsNone(transferred_file('Number of files: 3'))
+
+    def test_pick_files(self):
+        paths = [str(i) for i in range(10)]
+        self.assertEqual(pick_files(paths, 'full', 3), sorted(paths))
+        sample = pick_files(paths, 'sample', 3)
+        self.assertEqual(len(sample), 3)
+        self.assertTrue(set(sample) <= set(paths))
+
+################################################################################
+################################################################################
+## Verify Backup Tests                                                        ##
+## Tests for comparing the files transferred into a backup with their        ##
+## sources.                                                                   ##
+################################################################################
+################################################################################
+class VerifyBackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        self.backup = os.path.join(self.dest, staging_prefix + 'new')
+        for d in (self.src, os.path.join(self.backup, 'src')):
+            os.makedirs(d)
+            for n in ('a', 'b'):
+                with open(os.path.join(d, n), 'w') as f:
+                    f.write(n)
+        self.bm = backup_manager(self.src, None, self.dest, transport='local',
+            verify='full', printer=backup_printer(None, None, None, None,
+            None))
+        self.bm._transferred = {'src/a': os.path.join(self.src, 'a'),
+            'src/b': os.path.join(self.src, 'b')}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_match(self):
+        self.bm._verify_backup('new', time.time() + 60)
+        self.assertEqual(self.bm._transferred, {})
+
+    def test_mismatch(self):
+        with open(os.path.join(self.backup, 'src', 'b'), 'w') as f:
+            f.write('corrupt')
+        with self.assertRaises(BackupError) as cm:
+            self.bm._verify_backup('new', time.time() + 60)
+        self.assertIn('src/b', cm.exception.msg)
+        self.assertNotIn('src/a', cm.exception.msg)
+
+    def test_changed_during_backup(self):
+        # Sources modified after the transfer started aren't compared
+        with open(os.path.join(self.backup, 'src', 'b'), 'w') as f:
+            f.write('older')
+        self.bm._verify_backup('new', 0)
+
+    def test_rsync_cmd(self):
+        self.assertIn('--out-format=%i %l %n', self.bm._rsync_cmd())
+        watch = self.bm._transfer_watcher(self.src, 'new')
+        watch('>f+++++++++ 1 src/c')
+        self.assertEqual(self.bm._transferred['src/c'],
+            os.path.join(self.src, 'c'))
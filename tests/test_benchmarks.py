@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append('../')
+
+from benchmarks import compare_results, run_benchmark
+
+################################################################################
+################################################################################
+## Benchmark Harness Tests                                                    ##
+## Tests for the pieces of the benchmark harness that don't need rsync.       ##
+##                                                                            ##
+################################################################################
+################################################################################
+class BenchmarkTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_size_sampler(self):
+        self.assertEqual(run_benchmark.size_sampler('fixed:10', self.rng)(), 10)
+        s = run_benchmark.size_sampler('uniform:5:8', self.rng)
+        self.assertTrue(all(5 <= s() <= 8 for i in range(20)))
+        self.assertRaises(ValueError, run_benchmark.size_sampler, 'normal:1',
+            self.rng)
+
+    def test_tree_and_churn(self):
+        sizes = run_benchmark.size_sampler('fixed:100', self.rng)
+        paths = run_benchmark.generate_tree(self.tmp.name, 40, 4, sizes,
+            self.rng)
+        self.assertEqual(len(paths), 40)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 4)
+        after = run_benchmark.churn_tree(self.tmp.name, paths, 0.5, sizes,
+            self.rng)
+        self.assertEqual(len(after), 40)
+        self.assertEqual(len(set(after) - set(paths)), 5)
+        self.assertTrue(all(os.path.exists(os.path.join(self.tmp.name, p))
+            for p in after))
+
+    def test_ssh_shim(self):
+        r = subprocess.run([sys.executable, run_benchmark.ssh_shim, '-o',
+            'ControlPath=x', '-i', 'key', 'host', 'echo', 'remote'],
+            stdout=subprocess.PIPE)
+        self.assertEqual(r.stdout, b'remote\n')
+        r = subprocess.run([sys.executable, run_benchmark.ssh_shim, '-O',
+            'exit', 'host'])
+        self.assertEqual(r.returncode, 0)
+
+    def test_compare(self):
+        old = {'runs': [{'phases': {'create': {'wall_seconds': 1.0,
+            'commands': 2}}}]}
+        new = {'runs': [{'phases': {'create': {'wall_seconds': 1.5,
+            'commands': 2}}}]}
+        r = {(p, k): x for p, k, a, b, x in
+            compare_results.compare(old, new, 0.1)}
+        self.assertTrue(r[('create', 'wall_seconds')])
+        self.assertFalse(r[('create', 'commands')])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014, Jesse Elwell
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of python-backup nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## \file watch_sources.py
+#
+# A script that records the changes made to the sources of `create_backup.py`
+# in their change journals, so backups can transfer only what changed
+
+from backup.BackupExceptions import JournalError
+from backup.BackupJournal import change_journal, source_watcher
+from backup.BackupPrinter import backup_printer
+from create_backup import parse_config_files
+
+import argparse
+import os
+import selectors
+import signal
+import sys
+import time
+
+## Parses the command line into a dictionary
+#  \param l list of command-line arguments
+def parse_command_line(l):
+    parser = argparse.ArgumentParser(description='Records the changes made to '
+        'backup sources for create_backup')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='Verbose output')
+    parser.add_argument('-c', '--config', type=str, dest='config_file',
+            help='Configuration file to use')
+    parser.add_argument('--journal', type=str, metavar='DIR',
+            help='Directory to keep the change journals in')
+    parser.add_argument('--interval', type=float, default=1.0, metavar='SEC',
+            help='Seconds between writes to the journals')
+    parser.add_argument('src', nargs='*',
+            help='Source directories to watch (default: the configured ones)')
+    args = parser.parse_args(l)
+    return {key: value for key, value in vars(args).items()
+            if value is not None and value != []}
+
+## Watches the sources until terminated
+#
+# Watches every source with its own `source_watcher` and writes the changes
+# collected by all of them to their journals every `--interval` seconds. A
+# watcher that can't be started is retried every minute, since the journal of
+# its source has no epoch (so its backups walk it whole) until then.
+def main():
+    settings = parse_command_line(sys.argv[1:])
+    info = sys.stdout if settings.pop('verbose') else None
+    out = backup_printer(info=info, debug=None, warn=sys.stdout,
+        error=sys.stderr, fatal=sys.stderr)
+    config_files = ['/etc/backup.conf', os.path.expanduser('~/.backup.conf')]
+    if 'config_file' in settings:
+        config_files.append(settings.pop('config_file'))
+    config, _ = parse_config_files(config_files, out)
+    config.update(settings)
+    # The sources of every job (see backup_daemon.py) with a journal, or just
+    # the ones given on the command line
+    jobs = [config] if 'src' in settings else [config] + [dict(config, **j)
+        for j in config.get('jobs', {}).values()]
+    sources = set()
+    for j in jobs:
+        if 'journal' not in j:
+            continue
+        src = j.get('src', [])
+        sources.update((j['journal'], x)
+            for x in ([src] if isinstance(src, str) else src))
+    if not sources:
+        out.fatal('No sources with a journal directory given (--journal or '
+            'journal=)\n', 1)
+
+    # Exit cleanly (i.e. from select()) when asked to
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    sel = selectors.DefaultSelector()
+    pending = {x: 0.0 for x in sources}
+    try:
+        while True:
+            for x in [x for x, t in pending.items() if t <= time.monotonic()]:
+                try:
+                    w = source_watcher(change_journal(*x), out)
+                except JournalError as e:
+                    out.error('Unable to watch: {0}: {1}\n'.format(x[1],
+                        e.msg))
+                    pending[x] = time.monotonic() + 60
+                    continue
+                sel.register(w, selectors.EVENT_READ)
+                del pending[x]
+            deadline = time.monotonic() + config['interval']
+            while time.monotonic() < deadline:
+                for key, _ in sel.select(deadline - time.monotonic()):
+                    key.fileobj.read_events()
+            for key in sel.get_map().values():
+                key.fileobj.flush()
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.flush()
+            key.fileobj.close()
+
+if __name__ == '__main__':
+    main()